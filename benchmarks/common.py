@@ -0,0 +1,107 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Shared by the benchmarks that run against the MongoDB at the `MONGODB` URI.
+  They write to a workspace of their own, which is removed when they finish.
+"""
+
+import datetime
+import random
+import statistics
+import time
+
+from flask import Flask
+
+from karmabot import db
+from karmabot import settings
+from karmabot.badgemap import MIGRATIONS_COLLECTION
+from karmabot.indexes import index_manager
+
+BATCH_SIZE = 10000
+
+
+def make_app():
+    """
+        A Flask app with karmabot's settings, without the background threads
+        `create_app` starts.
+    """
+    app = Flask("karmabot")
+    app.config.from_object('karmabot.settings')
+    return app
+
+
+def ensure_indexes(workspace_id):
+    index_manager.ensure_shared()
+    index_manager.ensure_workspace(workspace_id)
+
+
+def make_op(ktype, subject, quantity, gifter, now=None):
+    date = (now or datetime.datetime.utcnow()) - datetime.timedelta(seconds=random.randint(0, settings.KARMA_TTL * 86400 // 2))
+    return {
+        'type': ktype,
+        'subject': subject,
+        'quantity': quantity,
+        'gifter': gifter,
+        'date': date,
+        'expires': date + datetime.timedelta(days=settings.KARMA_TTL)
+    }
+
+
+def seed(workspace_id, ops):
+    """
+        Insert the operations from an iterable in batches of BATCH_SIZE.
+
+        Returns:
+            (int) number of operations inserted
+    """
+    collection = db.get_database()[workspace_id]
+    count = 0
+    batch = []
+    for op in ops:
+        batch.append(op)
+        if len(batch) == BATCH_SIZE:
+            collection.insert_many(batch, ordered=False)
+            count += len(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+        count += len(batch)
+    return count
+
+
+def drop(workspace_id):
+    """
+        Remove the workspace's operations and everything karmabot keeps about it.
+    """
+    mongodb = db.get_database()
+    mongodb.drop_collection(workspace_id)
+    for name in mongodb.list_collection_names():
+        if name.startswith("karma_"):
+            mongodb[name].delete_many({"workspace": workspace_id})
+    mongodb[MIGRATIONS_COLLECTION].delete_many({"_id": f"totals:{workspace_id}"})
+
+
+def timed(f, repeat):
+    """
+        Returns:
+            (tuple) (last result, median seconds, max seconds)
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        ts = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - ts)
+    return result, statistics.median(times), max(times)
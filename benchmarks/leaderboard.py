@@ -0,0 +1,71 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Memory and time of an in-process leaderboard with synthetic subjects, without MongoDB.
+
+  python benchmarks/leaderboard.py --subjects 1000000
+"""
+
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from karmabot.leaderboard import Leaderboard
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subjects", type=int, default=1000000)
+    parser.add_argument("--applies", type=int, default=1000000)
+    parser.add_argument("--reads", type=int, default=1000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    entries = [(f"U{i:09d}", random.randint(-50, 500), random.randint(1, 50)) for i in range(args.subjects)]
+    gc.collect()
+
+    ts = time.perf_counter()
+    board = Leaderboard(entries)
+    elapsed = time.perf_counter() - ts
+    print(f"build: {len(board)} subjects in {elapsed:.2f}s")
+
+    # Measured separately, tracing allocations slows the build down several times
+    del board
+    gc.collect()
+    tracemalloc.start()
+    board = Leaderboard(entries)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"memory: {current / 2**20:.0f} MiB ({peak / 2**20:.0f} MiB peak), not counting the subject strings")
+
+    subjects = [e[0] for e in entries]
+    ts = time.perf_counter()
+    for _ in range(args.applies):
+        board.apply(random.choice(subjects), random.choice((1, 1, 1, -1)), 1)
+    elapsed = time.perf_counter() - ts
+    print(f"apply: {args.applies} in {elapsed:.2f}s, {elapsed / args.applies * 1e6:.1f}us each")
+
+    ts = time.perf_counter()
+    for i in range(args.reads):
+        board.apply(random.choice(subjects), 1, 1)
+        board.top(10) if i % 2 else board.bottom(10)
+    elapsed = time.perf_counter() - ts
+    print(f"top/bottom 10: {args.reads} after a change each in {elapsed:.2f}s, {elapsed / args.reads * 1e6:.1f}us each")
+
+
+if __name__ == '__main__':
+    main()
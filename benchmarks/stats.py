@@ -0,0 +1,70 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  `/karma stats` on a synthetic workspace: the single $facet aggregation over
+  the operations, against the precomputed counters.
+
+  MONGODB=mongodb://localhost:27017 python benchmarks/stats.py --ops 5000000
+
+  Building the counters goes through `TotalsController.rebuild`, which waits
+  out 2 * KARMA_TOTALS_CHECK_INTERVAL seconds twice.
+"""
+
+import argparse
+import random
+import time
+
+from common import drop, ensure_indexes, make_app, make_op, seed, timed
+
+from karmabot.controller.totals import KARMA_TYPES, TotalsController
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ops", type=int, default=5000000)
+    parser.add_argument("--subjects", type=int, default=50000)
+    parser.add_argument("--gifters", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workspace", default="TBENCHSTATS")
+    args = parser.parse_args()
+
+    random.seed(0)
+    with make_app().app_context():
+        drop(args.workspace)
+        try:
+            ensure_indexes(args.workspace)
+            ts = time.perf_counter()
+            count = seed(args.workspace, (make_op(random.choice(KARMA_TYPES), f"S{random.randrange(args.subjects)}",
+                                                  random.choice((1, 1, 1, -1)), f"U{random.randrange(args.gifters)}")
+                                          for _ in range(args.ops)))
+            print(f"seeded {count} operations in {time.perf_counter() - ts:.0f}s")
+
+            totals = TotalsController()
+            stats, median, worst = timed(lambda: totals.get_stats_from_ops(args.workspace), args.repeat)
+            print(f"$facet over the operations: median {median * 1000:.0f}ms, max {worst * 1000:.0f}ms")
+
+            ts = time.perf_counter()
+            totals.rebuild([args.workspace])
+            print(f"built the counters in {time.perf_counter() - ts:.0f}s")
+
+            counted, median, worst = timed(lambda: totals.get_stats(args.workspace), args.repeat)
+            print(f"counters: median {median * 1000:.1f}ms, max {worst * 1000:.1f}ms")
+            assert counted == stats, (counted, stats)
+        finally:
+            drop(args.workspace)
+
+
+if __name__ == '__main__':
+    main()
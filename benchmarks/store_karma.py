@@ -0,0 +1,72 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Storing the karma of a message with 1, 5 and 20 subjects: one `store_karmas`
+  call per message, against one `store_karma` call per subject.
+
+  MONGODB=mongodb://localhost:27017 python benchmarks/store_karma.py --messages 1000
+
+  The workspace's counters are built first, so the counter writes are timed
+  too.  That waits out 2 * KARMA_TOTALS_CHECK_INTERVAL seconds twice.
+"""
+
+import argparse
+import random
+import time
+
+from common import drop, ensure_indexes, make_app
+
+from karmabot.controller.karma import KarmaController
+from karmabot.controller.totals import TotalsController
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subjects", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--workspace", default="TBENCHSTORE")
+    args = parser.parse_args()
+
+    random.seed(0)
+    with make_app().app_context():
+        drop(args.workspace)
+        try:
+            ensure_indexes(args.workspace)
+            TotalsController().rebuild([args.workspace])
+            karma = KarmaController()
+            print(f"{'subjects':>8} {'batched ops/s':>14} {'per subject ops/s':>18}")
+            for subjects in args.subjects:
+                messages = [(f"U{random.randrange(1000)}", [("user", f"S{random.randrange(10000)}", 1) for _ in range(subjects)])
+                            for _ in range(args.messages)]
+
+                ts = time.perf_counter()
+                for gifter, gifts in messages:
+                    karma.store_karmas(args.workspace, gifter, gifts)
+                batched = time.perf_counter() - ts
+
+                ts = time.perf_counter()
+                for gifter, gifts in messages:
+                    for ktype, subject, quantity in gifts:
+                        karma.store_karma(ktype, subject, quantity, gifter, args.workspace)
+                single = time.perf_counter() - ts
+
+                ops = args.messages * subjects
+                print(f"{subjects:>8} {ops / batched:>14.0f} {ops / single:>18.0f}")
+        finally:
+            drop(args.workspace)
+
+
+if __name__ == '__main__':
+    main()
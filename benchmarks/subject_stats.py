@@ -0,0 +1,72 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  `/karma stats <subject>` as a subject's number of gifters grows: the bounded
+  aggregation of `get_subject_stats`, against fetching every gifter's total
+  and keeping the top 5 client-side.
+
+  MONGODB=mongodb://localhost:27017 python benchmarks/subject_stats.py --gifters 10 100 1000 10000 100000
+"""
+
+import argparse
+import random
+
+import bson
+from common import drop, ensure_indexes, make_app, make_op, seed, timed
+
+from karmabot import db
+from karmabot.controller.karma import KarmaController
+
+
+def all_gifters(workspace_id, subject):
+    return list(db.get_database()[workspace_id].aggregate([
+        {"$match": {"type": "user", "subject": subject}},
+        {"$group": {"_id": "$gifter", "total": {"$sum": "$quantity"}}},
+        {"$sort": {"total": -1}}
+    ]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gifters", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--ops-per-gifter", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workspace", default="TBENCHSUBJECT")
+    args = parser.parse_args()
+
+    random.seed(0)
+    with make_app().app_context():
+        drop(args.workspace)
+        try:
+            ensure_indexes(args.workspace)
+            for gifters in args.gifters:
+                seed(args.workspace, (make_op("user", f"S{gifters}", random.choice((1, 1, 1, -1)), f"U{g}")
+                                      for g in range(gifters) for _ in range(args.ops_per_gifter)))
+
+            karma = KarmaController()
+            print(f"{'gifters':>8} {'bounded':>10} {'payload':>10} {'all gifters':>12} {'payload':>10}")
+            for gifters in args.gifters:
+                subject = f"S{gifters}"
+                stats, bounded, _ = timed(lambda: karma.get_subject_stats(args.workspace, "user", subject), args.repeat)
+                assert stats['gifters'] == gifters
+                everyone, unbounded, _ = timed(lambda: all_gifters(args.workspace, subject), args.repeat)
+                print(f"{gifters:>8} {bounded * 1000:>8.1f}ms {len(bson.encode(stats)):>9}B "
+                      f"{unbounded * 1000:>10.1f}ms {sum(len(bson.encode(g)) for g in everyone):>9}B")
+        finally:
+            drop(args.workspace)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  gunicorn settings for Karmabot.  Workers share their Prometheus metrics
+  through PROMETHEUS_MULTIPROC_DIR, which has to be set before they import
+  karmabot.
+"""
+
+import os
+import shutil
+
+bind = "0.0.0.0:5000"
+accesslog = "-"
+
+prometheus_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    '/dev/shm/karmabot-prometheus' if os.path.isdir('/dev/shm') else '/tmp/karmabot-prometheus')
+
+
+def on_starting(server):
+    # Samples left over from a previous run would be added to this one's
+    shutil.rmtree(prometheus_dir, ignore_errors=True)
+    os.makedirs(prometheus_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
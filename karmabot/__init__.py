@@ -28,6 +28,10 @@ executor = Executor()
 from karmabot.errors import ErrorResponse, InvalidRequestError  # noqa: E402
 from karmabot.blueprint import health  # noqa: E402
 from karmabot.blueprint import slack  # noqa: E402
+from karmabot.commands import migrate_badges, rebuild_totals, verify_indexes  # noqa: E402
+from karmabot.directory import directory  # noqa: E402
+from karmabot.indexes import index_manager  # noqa: E402
+from karmabot.sweeper import ExpirySweeper  # noqa: E402
 
 
 def create_app():
@@ -42,11 +46,27 @@ def create_app():
     app.register_blueprint(slack)
     app.register_blueprint(health)
 
+    app.cli.add_command(rebuild_totals)
+    app.cli.add_command(migrate_badges)
+    app.cli.add_command(verify_indexes)
+
     app.logger.setLevel(app.config.get("LOG_LEVEL", "WARNING"))
 
     app.config['EXECUTOR_PROPAGATE_EXCEPTIONS'] = True
     executor.init_app(app)
 
+    if app.config.get('KARMA_VERIFY_INDEXES'):
+        with app.app_context():
+            index_manager.ensure_all()
+            index_manager.verify()
+    else:
+        index_manager.start(app)
+
+    directory.start(app)
+
+    if app.config.get('KARMA_SWEEPER'):
+        ExpirySweeper(app).start()
+
     @app.errorhandler(ErrorResponse)
     @app.errorhandler(InvalidRequestError)
     def error_handler(error):
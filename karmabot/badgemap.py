@@ -0,0 +1,189 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Where badges are stored, and an in-process map of who has which badge, so
+  karma replies don't query for badges.
+"""
+
+import datetime
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+from karmabot import db
+from karmabot import prometheus
+from karmabot import settings
+from karmabot.metrics import log_metrics
+
+BADGES_COLLECTION = "karma_badges"
+BADGE_INFO_COLLECTION = "karma_badge_info"
+BADGE_VERSIONS_COLLECTION = "karma_badge_versions"
+MIGRATIONS_COLLECTION = "karma_migrations"
+
+# Badges used to be stored in the workspace collection, next to the karma operations
+LEGACY_TYPES = {BADGES_COLLECTION: "badge", BADGE_INFO_COLLECTION: "badge_info"}
+
+_migrated = set()
+
+
+def badges_migrated(workspace_id):
+    """
+        Whether a workspace's badges have moved out of its karma operation
+        collection.  Workspaces with no badges there count as migrated.
+    """
+    if workspace_id in _migrated:
+        return True
+
+    mongodb = db.get_database()
+    migrated = mongodb[MIGRATIONS_COLLECTION].find_one({"_id": f"badges:{workspace_id}"}) is not None
+    if not migrated and not mongodb[workspace_id].find_one({"type": {"$in": list(LEGACY_TYPES.values())}}, {"_id": 1}):
+        mark_badges_migrated(workspace_id)
+        migrated = True
+    if migrated:
+        _migrated.add(workspace_id)
+    return migrated
+
+
+def mark_badges_migrated(workspace_id):
+    db.get_database()[MIGRATIONS_COLLECTION].update_one(
+        {"_id": f"badges:{workspace_id}"},
+        {"$setOnInsert": {"date": datetime.datetime.utcnow()}},
+        upsert=True)
+    _migrated.add(workspace_id)
+
+
+def badge_source(workspace_id, name):
+    """
+        Where to read badges (BADGES_COLLECTION) or badge info
+        (BADGE_INFO_COLLECTION) of a workspace from.
+
+        Returns:
+            (tuple) (collection, filter selecting the workspace's documents)
+    """
+    mongodb = db.get_database()
+    if badges_migrated(workspace_id):
+        return mongodb[name], {"workspace": workspace_id}
+    return mongodb[workspace_id], {"type": LEGACY_TYPES[name]}
+
+
+class BadgeMap(object):
+    """
+        Badges per workspace and user.
+
+        A workspace is loaded the first time it is asked for, then updated
+        write-through as badges are given, taken away and deleted.  Every write
+        also bumps the workspace's version stamp in MongoDB; each process
+        compares the stamp with the version it loaded at most every
+        KARMA_BADGE_CHECK_INTERVAL seconds, and reloads the workspace when
+        another process has changed it.
+    """
+
+    def __init__(self):
+        # workspace_id -> {"version": int, "checked": timestamp, "users": {subject: [badge]}}
+        self._workspaces = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, workspace_id, subject):
+        loaded = self._workspaces.get(workspace_id)
+        if loaded and loaded['checked'] + settings.KARMA_BADGE_CHECK_INTERVAL < time.time():
+            if self._version(workspace_id) != loaded['version']:
+                loaded = None
+            else:
+                loaded['checked'] = time.time()
+            self._log_hit_rate()
+
+        prometheus.cache_lookup('badges', bool(loaded))
+        if loaded:
+            self._hits += 1
+        else:
+            self._misses += 1
+            loaded = self.load(workspace_id)
+        return list(loaded['users'].get(subject, []))
+
+    def load(self, workspace_id):
+        version = self._version(workspace_id)
+        users = {}
+        collection, query = badge_source(workspace_id, BADGES_COLLECTION)
+        for r in collection.find(query, {"_id": 0, "subject": 1, "badge": 1}):
+            users.setdefault(r['subject'], []).append(r['badge'])
+
+        loaded = {"version": version, "checked": time.time(), "users": users}
+        with self._lock:
+            self._workspaces[workspace_id] = loaded
+        return loaded
+
+    def invalidate(self, workspace_id):
+        with self._lock:
+            self._workspaces.pop(workspace_id, None)
+
+    def add(self, workspace_id, subject, badge):
+        self._write(workspace_id, lambda users: users.setdefault(subject, []).append(badge))
+
+    def remove(self, workspace_id, subject, badge):
+        def remove_from(users):
+            badges = users.get(subject, [])
+            while badge in badges:
+                badges.remove(badge)
+            if not badges:
+                users.pop(subject, None)
+        self._write(workspace_id, remove_from)
+
+    def remove_badge(self, workspace_id, badge):
+        def remove_from(users):
+            for subject in list(users):
+                users[subject] = [b for b in users[subject] if b != badge]
+                if not users[subject]:
+                    del users[subject]
+        self._write(workspace_id, remove_from)
+
+    def _write(self, workspace_id, change):
+        """
+            Apply a change that has already been written to MongoDB, and bump
+            the version stamp.  If the stamp had moved on since this process
+            loaded the workspace, the workspace is dropped so the next read
+            reloads it.
+        """
+        r = db.get_database()[BADGE_VERSIONS_COLLECTION].find_one_and_update(
+            {"_id": workspace_id},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+
+        with self._lock:
+            loaded = self._workspaces.get(workspace_id)
+            if not loaded:
+                return
+            if loaded['version'] + 1 != r['version']:
+                del self._workspaces[workspace_id]
+                return
+            change(loaded['users'])
+            loaded['version'] = r['version']
+
+    @staticmethod
+    def _version(workspace_id):
+        r = db.get_database()[BADGE_VERSIONS_COLLECTION].find_one({"_id": workspace_id})
+        return r['version'] if r else 0
+
+    def _log_hit_rate(self):
+        hits, misses = self._hits, self._misses
+        self._hits = self._misses = 0
+        if hits + misses:
+            log_metrics('karmabot_badge_cache', None, 'hit_rate', hits / (hits + misses))
+
+
+badge_map = BadgeMap()
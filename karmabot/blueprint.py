@@ -21,12 +21,15 @@ import json
 import time
 import re
 
-from flask import abort, current_app, g, jsonify, request, Blueprint
+from flask import abort, current_app, g, jsonify, request, Blueprint, Response
 
 from karmabot.controller.karma import KarmaController
 from karmabot.controller.badges import BadgesController
-from karmabot import executor
+from karmabot import db, executor, prometheus, tracing
 from karmabot.metrics import timeit, log_metrics
+from karmabot.directory import directory
+from karmabot.usercache import user_cache
+from karmabot.usergroups import usergroups
 
 health = Blueprint("health", __name__, url_prefix='/')
 slack = Blueprint("slack", __name__, url_prefix='/slack_events/v1')
@@ -55,16 +58,35 @@ def get_badges_controller():
 @health.route("/", methods=["GET"])
 @health.route("/health", methods=["GET"])
 def get_health():
+    prometheus.executor_queue.set(executor._work_queue.qsize())
     log_metrics("threads", None, "queue_size", executor._work_queue.qsize())
     log_metrics("threads", None, "count", len(executor._threads))
+    log_metrics("karmabot_mongo_pool", None, "in_use", db.pool_listener.in_use)
     if executor._work_queue.qsize() > (1.5 * len(executor._threads)):
         return "QUEUE FULL", 503
     return "OK", 200
 
 
-@timeit('karmabot_event_requests')
+@health.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+        Prometheus metrics, for every worker of this Karmabot instance.
+    """
+    prometheus.executor_queue.set(executor._work_queue.qsize())
+    output, content_type = prometheus.exposition()
+    return Response(output, content_type=content_type)
+
+
+@slack.after_request
+def track_executor_queue(response):
+    prometheus.executor_queue.set(executor._work_queue.qsize())
+    return response
+
+
 @slack.route('/karmabot_dev-v1_events', methods=['POST'])
 @slack.route('/karmabot-v1_events', methods=['POST'])
+@prometheus.request_time.labels('events').time()
+@timeit('karmabot_event_requests')
 def slack_event():
     """
         Handle incoming Slack events.
@@ -86,6 +108,9 @@ def slack_event():
         return jsonify({'challenge': eventw['challenge']})
     else:
         log_metrics('karmabot_events_passed', None, 'count', 1)
+        prometheus.events.labels(eventw['event']['type']).inc()
+        trace = tracing.Trace(eventw['event']['type'], eventw.get('team_id'))
+        eventw["trace_id"] = trace.id
 
         if eventw['event']['type'] == "message":
             if 'subtype' in eventw['event']:
@@ -96,7 +121,7 @@ def slack_event():
                 log_metrics('karmabot_events_passed', None, 'count', 1)
                 eventw["rec_time"] = time.time()
                 karma_controller = get_karma_controller()
-                executor.submit(karma_controller.handle_event, eventw)
+                executor.submit(tracing.traced(trace, karma_controller.handle_event), eventw)
             else:
                 current_app.logger.debug("Not match: %s" % eventw['event']['text'])
         elif eventw['event']['type'] == "app_mention":
@@ -105,16 +130,26 @@ def slack_event():
                 log_metrics('karmabot_events_passed', None, 'count', 1)
                 eventw["rec_time"] = time.time()
                 karma_controller = get_karma_controller()
-                executor.submit(karma_controller.handle_mention, eventw)
+                executor.submit(tracing.traced(trace, karma_controller.handle_mention), eventw)
+        elif eventw['event']['type'] in ("user_change", "team_join"):
+            user_cache.push(eventw['team_id'], eventw['event']['user'])
+            executor.submit(directory.update, eventw['team_id'], eventw['event']['user'])
+        elif eventw['event']['type'] in ("subteam_created", "subteam_updated"):
+            usergroups.update(eventw['team_id'], eventw['event']['subteam'])
+        elif eventw['event']['type'] == "subteam_members_changed":
+            event = eventw['event']
+            usergroups.members_changed(eventw['team_id'], event['subteam_id'],
+                                       event.get('added_users', []), event.get('removed_users', []))
 
         else:
             current_app.logger.error("Unknown event type: %s" % eventw['event']['type'])
         return jsonify({})
 
 
-@timeit('karmabot_command_requests')
 @slack.route('/karmabot_dev-v1_commands', methods=['POST'])
 @slack.route('/karmabot-v1_commands', methods=['POST'])
+@prometheus.request_time.labels('commands').time()
+@timeit('karmabot_command_requests')
 def slack_command():
     """
         Handle incoming Slack commands.
@@ -134,14 +169,16 @@ def slack_command():
         abort(403)
     else:
         log_metrics('karmabot_commands_passed', None, 'count', 1)
+        prometheus.commands.labels(command['command']).inc()
+        trace = tracing.Trace(command['command'], command.get('team_id'))
         current_app.logger.debug(command['command'])
         if command['command'] == '/karma':
             karma_controller = get_karma_controller()
-            executor.submit(karma_controller.handle_command, command)
+            executor.submit(tracing.traced(trace, karma_controller.handle_command), command)
 
         elif command['command'] == '/badge':
             badges_controller = get_badges_controller()
-            executor.submit(badges_controller.handle_command, command)
+            executor.submit(tracing.traced(trace, badges_controller.handle_command), command)
 
         else:
             current_app.logger.info(f"Ignoring unknown command {command['command']}")
@@ -149,9 +186,10 @@ def slack_command():
         return '', 200
 
 
-@timeit('karmabot_interactive_requests')
 @slack.route('/karmabot_dev-v1_interactions', methods=['POST'])
 @slack.route('/karmabot-v1_interactions', methods=['POST'])
+@prometheus.request_time.labels('interactions').time()
+@timeit('karmabot_interactive_requests')
 def slack_interaction():
     """
         Handle incoming Slack interactions
@@ -174,22 +212,24 @@ def slack_interaction():
         abort(403)
     else:
         badges_controller = get_badges_controller()
+        trace = tracing.Trace(interaction['type'], interaction.get('team', {}).get('id'))
         if interaction['type'] == "dialog_submission":
             if interaction['callback_id'] == 'karma-badge-create-0':
-                executor.submit(badges_controller.cmd_badge_create_complete, interaction)
+                executor.submit(tracing.traced(trace, badges_controller.cmd_badge_create_complete), interaction)
             elif interaction['callback_id'].startswith('karma-badge-update-'):
-                executor.submit(badges_controller.cmd_badge_update_complete, interaction)
+                executor.submit(tracing.traced(trace, badges_controller.cmd_badge_update_complete), interaction)
             else:
                 current_app.logger.warning(f"Unknown callback_id {interaction['callback_id']}")
         elif interaction['type'] == "interactive_message":
             if interaction['callback_id'] == 'karma-badge-delete-0':
-                executor.submit(badges_controller.cmd_badge_delete_complete, interaction)
+                executor.submit(tracing.traced(trace, badges_controller.cmd_badge_delete_complete), interaction)
             else:
                 current_app.logger.warning(f"Unknown callback_id {interaction['callback_id']}")
         else:
             current_app.logger.warning(f"Unknown interaction type: {interaction['type']}")
 
         log_metrics('karmabot_interactions_passed', None, 'count', 1)
+        prometheus.interactions.labels(interaction['type']).inc()
 
         return '', 200
 
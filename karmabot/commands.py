@@ -0,0 +1,78 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Maintenance commands, run with `flask --app "karmabot:create_app()" <command>`
+"""
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from karmabot.controller.badges import BadgesController
+from karmabot.controller.totals import TotalsController
+from karmabot.db import workspace_ids
+from karmabot.indexes import index_manager
+from karmabot.leaderboard import leaderboards
+
+
+@click.command('rebuild-totals')
+@click.argument('workspaces', nargs=-1)
+@with_appcontext
+def rebuild_totals(workspaces):
+    """Recompute karma totals and rollups from the raw karma operations."""
+    totals = TotalsController()
+    if not workspaces:
+        workspaces = workspace_ids(totals.mongodb)
+
+    rebuilt = totals.rebuild(list(workspaces))
+    for workspace_id in workspaces:
+        if workspace_id in rebuilt:
+            leaderboards.invalidate(workspace_id)
+            click.echo(f"{workspace_id}: {rebuilt[workspace_id]} subjects")
+        else:
+            click.echo(f"{workspace_id}: not rebuilt, another process is rebuilding it")
+    current_app.logger.info(f"Rebuilt karma totals for {len(rebuilt)} of {len(workspaces)} workspaces")
+
+
+@click.command('verify-indexes')
+@click.argument('workspaces', nargs=-1)
+@with_appcontext
+def verify_indexes(workspaces):
+    """Create missing indexes, and fail if any query would scan a collection."""
+    index_manager.ensure_shared()
+    for workspace_id in workspaces:
+        index_manager.ensure_workspace(workspace_id)
+    if not workspaces:
+        index_manager.ensure_all()
+
+    index_manager.verify(list(workspaces) or None)
+    click.echo("All query shapes use an index")
+
+
+@click.command('migrate-badges')
+@click.argument('workspaces', nargs=-1)
+@click.option('--batch', default=1000, help='Documents to copy and delete at a time.')
+@with_appcontext
+def migrate_badges(workspaces, batch):
+    """Move badges out of the karma operation collections."""
+    badges = BadgesController()
+    if not workspaces:
+        workspaces = workspace_ids(badges.mongodb)
+
+    index_manager.ensure_shared()
+    for workspace_id in workspaces:
+        count = badges.migrate(workspace_id, batch)
+        click.echo(f"{workspace_id}: {count} badge documents")
+    current_app.logger.info(f"Migrated badges for {len(workspaces)} workspaces")
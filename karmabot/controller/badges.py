@@ -14,18 +14,27 @@
 
 import datetime
 from flask import current_app
+from pymongo import UpdateOne
+from karmabot import db
 from karmabot import regex
 from karmabot import settings
+from karmabot.directory import directory
+from karmabot.badgemap import BADGE_INFO_COLLECTION, BADGES_COLLECTION, LEGACY_TYPES
+from karmabot.badgemap import badge_map, badge_source, badges_migrated, mark_badges_migrated
+from karmabot.indexes import index_manager
 from karmabot.service import slack as slack_client
-from pymongo import MongoClient
+from karmabot.tracing import span
+from karmabot.usercache import user_cache
+from karmabot.usergroups import usergroups
 
 
 class BadgesController(object):
 
     def __init__(self):
-        self.mongodb = MongoClient(current_app.config.get('MONGODB'))['karmabot']
+        self.mongodb = db.get_database()
 
     def handle_command(self, command):
+        index_manager.ensure_workspace(command['team_id'])
         if not command['text']:
             return self.cmd_badge_show(command)
 
@@ -50,19 +59,15 @@ class BadgesController(object):
         current_app.logger.info('handle_command fallthrough: didnt match any command')
         return self.cmd_badge_help(command)
 
-    def get_badges(self, workspace_id, subject):
-        collection = self.mongodb[workspace_id]
-        results = collection.find({"type": "badge", "subject": subject})
-
-        badges = []
-        for r in results:
-            badges.append(r['badge'])
-
-        return badges
+    @staticmethod
+    @span()
+    def get_badges(workspace_id, subject):
+        return badge_map.get(workspace_id, subject)
 
+    @span()
     def get_badge_users(self, workspace_id, badge):
-        collection = self.mongodb[workspace_id]
-        results = collection.find({"type": "badge", "badge": badge})
+        collection, query = badge_source(workspace_id, BADGES_COLLECTION)
+        results = collection.find(dict(query, badge=badge))
 
         users = []
         for r in results:
@@ -70,26 +75,23 @@ class BadgesController(object):
 
         return users
 
+    @span()
     def delete_badge(self, workspace_id, badge):
-        collection = self.mongodb[workspace_id]
-        collection.delete_many({
-            'type': 'badge',
-            'badge': badge
-        })
-        collection.delete_many({
-            'type': 'badge_info',
-            'badge': badge
-        })
+        self._delete(workspace_id, BADGES_COLLECTION, {'badge': badge})
+        self._delete(workspace_id, BADGE_INFO_COLLECTION, {'badge': badge})
+        badge_map.remove_badge(workspace_id, badge)
 
+    @span()
     def get_badge_info(self, workspace_id, badge):
-        collection = self.mongodb[workspace_id]
-        results = collection.find({"type": "badge_info", "badge": badge})
+        collection, query = badge_source(workspace_id, BADGE_INFO_COLLECTION)
+        results = collection.find(dict(query, badge=badge))
 
         for r in results:
             return r
 
         return None
 
+    @span()
     def can_badge(self, workspace_id, user_id, badge):
         badge = self.get_badge_info(workspace_id, badge)
         current_app.logger.debug(badge)
@@ -99,37 +101,119 @@ class BadgesController(object):
         if user_id == badge['owner']:
             return True
 
-        group_members = slack_client.user_group_members(workspace_id, badge['owner'])
-        if not group_members['ok']:
+        if badge['owner'][0] != "S":
+            # Owned by a single user
             return False
 
-        for user in group_members['users']:
-            if user_id == user:
-                return True
-
-        return True
+        return usergroups.is_member(workspace_id, badge['owner'], user_id)
 
+    @span()
     def store_badge(self, workspace_id, subject, gifter, badge):
         now = datetime.datetime.utcnow()
         data = {
-            'type': 'badge',
             'subject': subject,
             'badge': badge,
             'gifter': gifter,
             'date': now
         }
-        collection = self.mongodb[workspace_id]
-        collection.insert_one(data)
+        self._insert(workspace_id, BADGES_COLLECTION, data)
+        badge_map.add(workspace_id, subject, badge)
 
+    @span()
     def remove_badge(self, workspace_id, subject, badge):
-        collection = self.mongodb[workspace_id]
-        collection.delete_many({
-            'type': 'badge',
+        self._delete(workspace_id, BADGES_COLLECTION, {
             'badge': badge,
             'subject': subject
         })
+        badge_map.remove(workspace_id, subject, badge)
+
+    def _insert(self, workspace_id, name, data):
+        """
+            Badges are written to their own collection, and until the workspace
+            is migrated also to the workspace collection (with the same `_id`)
+            so the old read path stays complete.
+        """
+        doc = dict(data, workspace=workspace_id)
+        self.mongodb[name].insert_one(doc)
+        if not badges_migrated(workspace_id):
+            self.mongodb[workspace_id].insert_one(dict(data, _id=doc['_id'], type=LEGACY_TYPES[name]))
+
+    def _replace(self, workspace_id, name, _id, data):
+        self.mongodb[name].replace_one({'_id': _id}, dict(data, workspace=workspace_id), upsert=True)
+        if not badges_migrated(workspace_id):
+            self.mongodb[workspace_id].replace_one({'_id': _id}, dict(data, type=LEGACY_TYPES[name]))
+
+    def _delete(self, workspace_id, name, query):
+        self.mongodb[name].delete_many(dict(query, workspace=workspace_id))
+        if not badges_migrated(workspace_id):
+            self.mongodb[workspace_id].delete_many(dict(query, type=LEGACY_TYPES[name]))
+
+    def migrate(self, workspace_id, batch=1000):
+        """
+            Move a workspace's badges out of its karma operation collection.
+
+            Badges are copied over in batches while both collections are
+            written to, then reads switch to the badge collections and the
+            old documents are deleted.
+
+            A copy never overwrites a document that a concurrent write already
+            put in the badge collections.  A batch is checked against the old
+            documents once it is copied, and copies of any that were deleted
+            in the meantime are deleted again.
+
+            Returns:
+                (int) the number of documents moved
+        """
+        collection = self.mongodb[workspace_id]
+        legacy = {"type": {"$in": list(LEGACY_TYPES.values())}}
+        names = {ktype: name for name, ktype in LEGACY_TYPES.items()}
+
+        moved = 0
+        last_id = None
+        while True:
+            query = dict(legacy, _id={"$gt": last_id}) if last_id else legacy
+            docs = list(collection.find(query).sort("_id", 1).limit(batch))
+            if not docs:
+                break
+
+            requests = {name: [] for name in LEGACY_TYPES}
+            copied = {name: [] for name in LEGACY_TYPES}
+            for doc in docs:
+                name = names[doc.pop('type')]
+                _id = doc.pop('_id')
+                requests[name].append(UpdateOne({'_id': _id}, {'$setOnInsert': dict(doc, workspace=workspace_id)}, upsert=True))
+                copied[name].append(_id)
+                last_id = _id
+            for name, r in requests.items():
+                if r:
+                    self.mongodb[name].bulk_write(r, ordered=False)
+
+            ids = [_id for c in copied.values() for _id in c]
+            remaining = {doc['_id'] for doc in collection.find({'_id': {'$in': ids}}, {'_id': 1})}
+            for name, c in copied.items():
+                deleted = [_id for _id in c if _id not in remaining]
+                if deleted:
+                    self.mongodb[name].delete_many({'_id': {'$in': deleted}})
+
+            moved += len(docs)
+
+        mark_badges_migrated(workspace_id)
+        badge_map.invalidate(workspace_id)
+
+        while True:
+            ids = [doc['_id'] for doc in collection.find(legacy, {'_id': 1}).limit(batch)]
+            if not ids:
+                break
+            collection.delete_many({'_id': {'$in': ids}})
+
+        if 'type_1_badge_1' in collection.index_information():
+            collection.drop_index('type_1_badge_1')
+
+        current_app.logger.info(f"Migrated {moved} badge documents for {workspace_id}")
+        return moved
 
     @staticmethod
+    @span()
     def cmd_badge_help(command):
         message = {
                 'response_type': 'ephemeral',
@@ -162,16 +246,14 @@ class BadgesController(object):
         slack_client.command_reply(command['team_id'], command['response_url'], message)
 
     @staticmethod
+    @span()
     def cmd_badge_create_request(command):
 
-        user_info_r = slack_client.get_userinfo(command['team_id'], command['user_id'])
-        if user_info_r.status != 200:
-            current_app.logger.warning(f"Got an unknown userinfo response: {user_info_r.status}")
+        user_info = user_cache.get(command['team_id'], command['user_id'])
+        if not user_info:
             return
 
-        user_info = user_info_r.json
-        current_app.logger.debug(user_info)
-        if not user_info['user']['is_admin']:
+        if not user_info['is_admin']:
             message = {
                 "response_type": "ephemeral",
                 "attachments": [{
@@ -213,18 +295,17 @@ class BadgesController(object):
         slack_client.dialog_open(command['team_id'], command['trigger_id'], dialog)
         return
 
+    @span()
     def cmd_badge_create_complete(self, interaction):
         data = interaction['submission']
         current_app.logger.debug(f"submitted data: {interaction}")
         errors = False
 
-        user_info_r = slack_client.get_userinfo(interaction['team']['id'], interaction['user']['id'])
-        if user_info_r.status != 200:
-            current_app.logger.warning(f"Got an unknown userinfo response: {user_info_r.status}")
+        user_info = user_cache.get(interaction['team']['id'], interaction['user']['id'])
+        if not user_info:
             return
 
-        user_info = user_info_r.json
-        if not user_info['user']['is_admin']:
+        if not user_info['is_admin']:
             message = {
                 "response_type": "ephemeral",
                 "attachments": [{
@@ -263,12 +344,12 @@ class BadgesController(object):
         if data['owner'][0] == '@':
             data['owner'] = data['owner'][1:]
 
-        user = slack_client.lookup_usergroup(interaction['team']['id'], data['owner'])
+        user = usergroups.lookup(interaction['team']['id'], data['owner'])
         owner = None
         if user:
             owner = user['id']
         else:
-            user = slack_client.lookup_user(interaction['team']['id'], data['owner'])
+            user = directory.lookup_user(interaction['team']['id'], data['owner'])
             if user:
                 owner = user['id']
             else:
@@ -287,15 +368,13 @@ class BadgesController(object):
 
         now = datetime.datetime.utcnow()
         data = {
-            'type': 'badge_info',
             'badge': data['badge'],
             'owner': owner,
             'owner_display': data['owner'],
             'description': data['description'],
             'date': now
         }
-        collection = self.mongodb[interaction['team']['id']]
-        collection.insert_one(data)
+        self._insert(interaction['team']['id'], BADGE_INFO_COLLECTION, data)
 
         current_app.logger.debug("data[owner] '{owner}'")
         owner_escaped = f"<!subteam^{owner}>"
@@ -332,16 +411,14 @@ class BadgesController(object):
 
         slack_client.command_reply(interaction['team']['id'], interaction['response_url'], message)
 
+    @span()
     def cmd_badge_delete_request(self, command):
 
-        user_info_r = slack_client.get_userinfo(command['team_id'], command['user_id'])
-        if user_info_r.status != 200:
-            current_app.logger.warning(f"Got an unknown userinfo response: {user_info_r.status}")
+        user_info = user_cache.get(command['team_id'], command['user_id'])
+        if not user_info:
             return
 
-        user_info = user_info_r.json
-        current_app.logger.debug(user_info)
-        if not user_info['user']['is_admin']:
+        if not user_info['is_admin']:
             message = {
                 "response_type": "ephemeral",
                 "attachments": [{
@@ -414,15 +491,14 @@ class BadgesController(object):
         return
 
     @staticmethod
+    @span()
     def cmd_badge_delete_complete(self, interaction):
 
-        user_info_r = slack_client.get_userinfo(interaction['team']['id'], interaction['user']['id'])
-        if user_info_r.status != 200:
-            current_app.logger.warning(f"Got an unknown userinfo response: {user_info_r.status}")
+        user_info = user_cache.get(interaction['team']['id'], interaction['user']['id'])
+        if not user_info:
             return
 
-        user_info = user_info_r.json
-        if not user_info['user']['is_admin']:
+        if not user_info['is_admin']:
             message = {
                 "response_type": "ephemeral",
                 "attachments": [{
@@ -453,14 +529,13 @@ class BadgesController(object):
 
         return
 
+    @span()
     def cmd_badge_update_request(self, command):
-        user_info_r = slack_client.get_userinfo(command['team_id'], command['user_id'])
-        if user_info_r.status != 200:
-            current_app.logger.warning(f"Got an unknown userinfo response: {user_info_r.status}")
+        user_info = user_cache.get(command['team_id'], command['user_id'])
+        if not user_info:
             return
 
-        user_info = user_info_r.json
-        if not user_info['user']['is_admin']:
+        if not user_info['is_admin']:
             message = {
                 "response_type": "ephemeral",
                 "attachments": [{
@@ -528,18 +603,17 @@ class BadgesController(object):
         current_app.logger.debug(slack_client.dialog_open(command['team_id'], command['trigger_id'], dialog))
         return
 
+    @span()
     def cmd_badge_update_complete(self, interaction):
         data = interaction['submission']
         current_app.logger.debug("submitted data:", interaction)
         errors = False
 
-        user_info_r = slack_client.get_userinfo(interaction['team']['id'], interaction['user']['id'])
-        if user_info_r.status != 200:
-            current_app.logger.warning(f"Got an unknown userinfo response: {user_info_r.status}")
+        user_info = user_cache.get(interaction['team']['id'], interaction['user']['id'])
+        if not user_info:
             return
 
-        user_info = user_info_r.json
-        if not user_info['user']['is_admin']:
+        if not user_info['is_admin']:
             message = {
                 "response_type": "ephemeral",
                 "attachments": [{
@@ -567,12 +641,12 @@ class BadgesController(object):
         if data['owner'][0] == '@':
             data['owner'] = data['owner'][1:]
 
-        user = slack_client.lookup_usergroup(interaction['team']['id'], data['owner'])
+        user = usergroups.lookup(interaction['team']['id'], data['owner'])
         owner = None
         if user:
             owner = user['id']
         else:
-            user = slack_client.lookup_user(interaction['team']['id'], data['owner'])
+            user = directory.lookup_user(interaction['team']['id'], data['owner'])
             if user:
                 owner = user['id']
             else:
@@ -591,15 +665,15 @@ class BadgesController(object):
 
         now = datetime.datetime.utcnow()
         data = {
-            'type': 'badge_info',
             'badge': badge,
             'owner': owner,
             'owner_display': data['owner'],
             'description': data['description'],
             'date': now
         }
-        collection = self.mongodb[interaction['team']['id']]
-        collection.replace_one({'type': 'badge_info', 'badge': badge}, data)
+        badge_info = self.get_badge_info(interaction['team']['id'], badge)
+        if badge_info:
+            self._replace(interaction['team']['id'], BADGE_INFO_COLLECTION, badge_info['_id'], data)
 
         owner_escaped = f"<!subgroup^{owner}>"
         if owner[0] != "S":
@@ -645,9 +719,10 @@ class BadgesController(object):
 
         slack_client.command_reply(interaction['team']['id'], interaction['response_url'], message)
 
+    @span()
     def cmd_badge_list(self, command):
-        collection = self.mongodb[command['team_id']]
-        results = collection.find({"type": "badge_info"})
+        collection, query = badge_source(command['team_id'], BADGE_INFO_COLLECTION)
+        results = collection.find(query)
 
         badges = []
         for r in results:
@@ -664,6 +739,7 @@ class BadgesController(object):
         slack_client.command_reply(command['team_id'], command['response_url'], message)
         return
 
+    @span()
     def cmd_badge_show(self, command):
         # /badge show @jane.doe
         # /badge show :emoji:
@@ -753,11 +829,12 @@ class BadgesController(object):
 
         return
 
+    @span()
     def get_top_badges(self, workspace_id, limit):
-        collection = self.mongodb[workspace_id]
+        collection, query = badge_source(workspace_id, BADGES_COLLECTION)
 
         pipeline = [
-            {"$match": {"type": "badge"}},
+            {"$match": query},
             {"$group": {"_id": "$badge", "count": {"$sum": 1}}},
             {"$sort": {"total": -1}},
             {"$limit": limit}
@@ -768,12 +845,13 @@ class BadgesController(object):
             msg = f'{msg}\n{entry["_id"]}  {entry["count"]}'
         return msg
 
+    @span()
     def cmd_badge_stats(self, command):
         workspace_id = command['team_id']
-        collection = self.mongodb[workspace_id]
-
-        badge_info_count = collection.find({"type": "badge_info"}).count()
-        badge_count = collection.find({"type": "badge"}).count()
+        collection, query = badge_source(workspace_id, BADGE_INFO_COLLECTION)
+        badge_info_count = collection.count_documents(query)
+        collection, query = badge_source(workspace_id, BADGES_COLLECTION)
+        badge_count = collection.count_documents(query)
         top_badges = self.get_top_badges(command['team_id'], 5)
         message = {
             'response_type': 'ephemeral',
@@ -807,6 +885,7 @@ class BadgesController(object):
 
         return
 
+    @span()
     def cmd_badge_user(self, command):
         # /badge @jane.doe with :emoji:
         # /badge @jane.doe without :emoji:
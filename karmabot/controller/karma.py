@@ -15,24 +15,43 @@
 import datetime
 import time
 import re
+from karmabot import db
 from karmabot import regex
 from karmabot import settings
+from karmabot.controller import rollups
 from karmabot.controller.badges import BadgesController
-from karmabot.metrics import log_metrics
+from karmabot.controller.totals import TotalsController, karma_filter
+from karmabot.indexes import index_manager
+from karmabot.leaderboard import leaderboards
+from karmabot.metrics import log_histogram, log_metrics
+from karmabot.ratelimit import limiter
+from karmabot.tracing import span
+from karmabot.usercache import user_cache
 from flask import current_app
+from pymongo.write_concern import WriteConcern
 from karmabot.service import slack as slack_client
-from pymongo import MongoClient
+
+# Things with a fixed amount of karma
+CONSTANTS = {
+    ("thing", u'\u03c0'): "3.14159265358979323846264338327950288419716939937510582",
+    ("thing", u'\u2107'): "2.71828182845904523536028747135266249775724709369995957",
+}
 
 
 class KarmaController(object):
 
     def __init__(self):
-        self.mongodb = MongoClient(current_app.config.get('MONGODB'))['karmabot']
+        self.mongodb = db.get_database()
         self.badges = BadgesController()
+        self.totals = TotalsController()
+        self.rollups = rollups.RollupsController()
+        w = settings.KARMA_WRITE_CONCERN
+        self.write_concern = WriteConcern(w=int(w) if w.isdigit() else w)
 
     def handle_event(self, eventw):
         late = time.time() - float(eventw['rec_time'])
-        log_metrics('karmabot_event_latency', None, 'time_elapsed', int(late * 1000))
+        log_histogram('karmabot_event_latency', None, 'time_elapsed', int(late * 1000000000))
+        index_manager.ensure_workspace(eventw['team_id'])
 
         current_app.logger.debug(f"{eventw['event']['type']}")
         if eventw['event']['type'] != 'message':
@@ -43,40 +62,27 @@ class KarmaController(object):
 
             if self.blacklisted(eventw['team_id'], eventw['event']['user']):
                 return
-            rlc = self.ratelimit_count(eventw['team_id'], eventw['event']['user'])
-            if rlc > settings.KARMA_RATE_LIMIT:
-                msg = f"Slow down there, partner! You only get to use karma {settings.KARMA_RATE_LIMIT} times per hour. Wait a little while and try again."  # noqa E501
-                self.karma_error_reply(eventw, msg)
-                return
         else:
             # Not a message from a user; ignore bots, etc
             current_app.logger.info("No user provided in the event")
             return
-        self.karma_it(eventw, rlc)
+        self.karma_it(eventw)
         return
 
-    def ratelimit_count(self, workspace_id, gifter):
-        collection = self.mongodb[workspace_id]
-        d = datetime.datetime.utcnow() + datetime.timedelta(hours=-1)
-        count = collection.find(
-            {
-                "$and": [
-                    {"date": {"$gt": d}},
-                    {"gifter": {"$eq": gifter}}
-                ]
-            }).count()
-        return count
-
     def handle_command(self, command):
         current_app.logger.info(command['text'])
+        index_manager.ensure_workspace(command['team_id'])
 
         if not command['text']:
             log_metrics('karmabot_command', {"command": "none"}, 'count', 1)
             return self.cmd_karma(command)
 
         # this needs to be checked before `if args[0] == "top"`
-        if ' '.join(command['text'].split()) == 'top channel members':
-            return self.get_top_channel_members(command)
+        match = regex.channel_members_re.match(command['text'])
+        if match:
+            log_metrics('karmabot_command', {"command": "top_channel_members"}, 'count', 1)
+            limit = int(match.group('limit') or 10)
+            return self.get_top_channel_members(command, min(max(limit, 1), settings.KARMA_CHANNEL_TOP_MAX))
 
         args = command['text'].split()
         if args[0] == "stats":
@@ -109,6 +115,7 @@ class KarmaController(object):
 
     def handle_mention(self, eventw):
         command = eventw
+        index_manager.ensure_workspace(eventw['team_id'])
         if 'user' in eventw['event']:
             current_app.logger.debug(f"Got a mention from {eventw['event']['user']}")
             if self.blacklisted(eventw['team_id'], eventw['event']['user']):
@@ -147,129 +154,89 @@ class KarmaController(object):
         return self.cmd_karma_help(command)
 
     def store_karma(self, ktype, subject, quantity, gifter, workspace_id):
+        self.store_karmas(workspace_id, gifter, [(ktype, subject, quantity)])
+
+    @span()
+    def store_karmas(self, workspace_id, gifter, gifts):
+        """
+            Store all the karma a gifter gave in one message with a single
+            insert, and update the totals and rollups with one bulk write each.
+
+            Args:
+                gifts: [(ktype, subject, quantity)]
+        """
+        if not gifts:
+            return
+
         now = datetime.datetime.utcnow()
         expires = now + datetime.timedelta(days=settings.KARMA_TTL)
-        data = {
+        ops = [{
             'type': ktype,
             'subject': subject,
             'quantity': quantity,
             'gifter': gifter,
             'date': now,
             'expires': expires
-        }
-        collection = self.mongodb[workspace_id]
-        collection.insert_one(data)
-
-    def get_karma(self, workspace_id, ktype, subject):
-        if ktype == "thing" and subject == u'\u03c0':
-            return "3.14159265358979323846264338327950288419716939937510582"
-        if ktype == "thing" and subject == u'\u2107':
-            return "2.71828182845904523536028747135266249775724709369995957"
-
-        collection = self.mongodb[workspace_id]
-        pipeline = [
-            {
-                "$match": {
-                    "subject": subject,
-                    "type": ktype
-                }
-            },
-            {
-                "$group": {
-                    "_id": "subject",
-                    "total": {
-                        "$sum": "$quantity"
-                    }
-                }
-            }
-        ]
-
-        results = collection.aggregate(pipeline)
-        # TODO: how do we handle errors here?
-        l_results = list(results)
-        if len(l_results) == 0:
-            return 0
-        return l_results[0]['total']
-
-    def get_type_karma(self, workspace_id, ktype):
-        collection = self.mongodb[workspace_id]
-        pipeline = [
-            {
-                "$match": {
-                    "type": ktype
-                }
-            },
-            {
-                "$group": {
-                    "_id": ktype,
-                    "total": {
-                        "$sum": "$quantity"
-                    }
-                }
-            }
-        ]
-
-        results = collection.aggregate(pipeline)
-        # TODO: how do we handle errors here?
-        l_results = list(results)
-        if len(l_results) == 0:
-            return 0
-        return l_results[0]['total']
-
-    def get_all_karma(self, workspace_id):
-        collection = self.mongodb[workspace_id]
-        pipeline = [
-            {
-                "$group": {
-                    "_id": "all",
-                    "total": {
-                        "$sum": "$quantity"
-                    }
-                }
-            }
-        ]
+        } for ktype, subject, quantity in gifts]
 
-        results = collection.aggregate(pipeline)
-        # TODO: how do we handle errors here?
-        l_results = list(results)
-        if len(l_results) == 0:
-            return 0
-        return l_results[0]['total']
+        collection = self.mongodb[workspace_id].with_options(write_concern=self.write_concern)
+        collection.insert_many(ops, ordered=False)
+        self.totals.increment(workspace_id, ops)
+        self.rollups.add(workspace_id, ops)
+        for ktype, subject, quantity in gifts:
+            leaderboards.apply(workspace_id, ktype, subject, quantity, 1)
 
-    def get_karma_gifter_count(self, workspace_id):
-        collection = self.mongodb[workspace_id]
-        return len(collection.distinct("gifter"))
-
-    def get_subject_count(self, workspace_id, ktype):
-        collection = self.mongodb[workspace_id]
-        pipeline = [
-            {"$group": {"_id": {"type": "$type", "subject": "$subject"}}},
-            {"$count": "total_subjects"}
-        ]
+    @span()
+    def get_karma(self, workspace_id, ktype, subject):
+        if (ktype, subject) in CONSTANTS:
+            return CONSTANTS[(ktype, subject)]
 
-        if ktype:
-            pipeline.insert(0, {"$match": {"type": ktype}})
+        return self.totals.get_total(workspace_id, ktype, subject)
 
-        results = collection.aggregate(pipeline)
-        r = results.next()
-        return r['total_subjects']
+    @span()
+    def get_karmas(self, workspace_id, subjects):
+        """
+            get_karma for a list of (ktype, subject), in one query.
+        """
+        totals = self.totals.get_totals(workspace_id, [s for s in subjects if s not in CONSTANTS])
+        return [CONSTANTS[s] if s in CONSTANTS else totals.get(s, 0) for s in subjects]
 
     @staticmethod
+    @span()
     def karma_error_reply(eventw, message):
         slack_client.post_message(workspace=eventw['team_id'],
                                   channel=eventw['event']['channel'],
                                   parse="full",
                                   text=message)
 
-    def karma_success_reply(self, eventw, ktype, subject_id, subject_display, quantity):
-        karma = self.get_karma(eventw['team_id'], ktype, subject_id)
+    @span()
+    def karma_success_reply(self, eventw, gifts):
+        """
+            Reply to every karma gift in an event with a single message.
 
-        badges = ""
-        if ktype == "user":
-            badges = "".join(self.badges.get_badges(eventw['team_id'], subject_id))
+            Args:
+                gifts: [(ktype, subject_id, subject_display, quantity)]
+        """
+        if not gifts:
+            return
 
-        if karma == 42:
-            badges = f"{badges}:dolphin:"
+        karmas = self.get_karmas(eventw['team_id'], [(ktype, subject_id) for ktype, subject_id, _, _ in gifts])
+
+        attachments = []
+        for (ktype, subject_id, subject_display, quantity), karma in zip(gifts, karmas):
+            badges = ""
+            if ktype == "user":
+                badges = "".join(self.badges.get_badges(eventw['team_id'], subject_id))
+
+            if karma == 42:
+                badges = f"{badges}:dolphin:"
+
+            attachments.append({
+                'fallback': f"{subject_display} has {karma} karma. ({ktype}) {badges}",
+                'color': settings.KARMA_COLOR,
+                "text": f"{subject_display} has {karma} karma. ({ktype}) {badges}",
+                "footer": f"<@{eventw['event']['user']}> gave {quantity} karma to the {ktype} {subject_display}"
+            })
 
         thread_ts = None
         if 'thread_ts' in eventw['event']:
@@ -277,14 +244,7 @@ class KarmaController(object):
 
         message = {
             'channel': eventw['event']['channel'],
-            'attachments': [
-                {
-                    'fallback': f"{subject_display} has {karma} karma. ({ktype}) {badges}",
-                    'color': settings.KARMA_COLOR,
-                    "text": f"{subject_display} has {karma} karma. ({ktype}) {badges}",
-                    "footer": f"<@{eventw['event']['user']}> gave {quantity} karma to the {ktype} {subject_display}"
-                }
-            ],
+            'attachments': attachments,
             'thread_ts': thread_ts
 
         }
@@ -294,7 +254,7 @@ class KarmaController(object):
 
         return
 
-    def karma_it(self, eventw, rate_limit_count):
+    def karma_it(self, eventw):
         # Ignore ``` ... ```  and ` .. ` blocks
         text = re.sub(regex.code_block_re, "", eventw['event']['text'])
         text = re.sub(regex.pre_block_re, "", text)
@@ -302,14 +262,10 @@ class KarmaController(object):
         current_app.logger.debug(f"final text: {text}")
 
         subject_list = set()
+        ops = []
+        gifts = []
 
         for match in regex.big_match_karma_re.finditer(text):
-            rate_limit_count += 1
-            if rate_limit_count > settings.KARMA_RATE_LIMIT:
-                msg = f"Slow down there, partner! You only get to use karma {settings.KARMA_RATE_LIMIT} times per hour. Wait a little while and try again."  # noqa E501
-                self.karma_error_reply(eventw, msg)
-                return
-
             karma = match.group('karma')
             if karma.startswith("+"):
                 quantity = len(karma) - 1
@@ -349,6 +305,7 @@ class KarmaController(object):
             subject_list.add(subject)
 
             if ktype == "user" and eventw['event']['user'] == subject:
+                self.give_karma(eventw, ops, gifts)
                 if quantity > 0:
                     self.karma_error_reply(eventw, "Don't be so vain")
                 else:
@@ -356,14 +313,32 @@ class KarmaController(object):
                 return
 
             if not (ktype == "thing" and subject == u'\u03c0'):
-                self.store_karma(ktype=ktype, subject=subject, quantity=quantity, gifter=eventw['event']['user'],
-                                 workspace_id=eventw['team_id'])
+                if not limiter.consume(eventw['team_id'], eventw['event']['user']):
+                    self.give_karma(eventw, ops, gifts)
+                    msg = f"Slow down there, partner! You only get to use karma {settings.KARMA_RATE_LIMIT} times per hour. Wait a little while and try again."  # noqa E501
+                    self.karma_error_reply(eventw, msg)
+                    return
+
+                ops.append((ktype, subject, quantity))
                 current_app.logger.info(
                     f"giving {subject} {quantity} karma from {eventw['event']['user']} in {eventw['team_id']}")
 
-            self.karma_success_reply(eventw, ktype=ktype, subject_display=display, subject_id=subject,
-                                     quantity=quantity)
+            gifts.append((ktype, subject, display, quantity))
+
+        self.give_karma(eventw, ops, gifts)
+
+    def give_karma(self, eventw, ops, gifts):
+        """
+            Store the karma collected from an event, and reply to it.
+
+            Args:
+                ops: [(ktype, subject, quantity)] to store
+                gifts: [(ktype, subject_id, subject_display, quantity)] to reply to
+        """
+        self.store_karmas(eventw['team_id'], eventw['event']['user'], ops)
+        self.karma_success_reply(eventw, gifts)
 
+    @span()
     def cmd_karma(self, command):
         karma = self.get_karma(command['team_id'], "user", command['user_id'])
         msg = f"Your Karma is {karma}"
@@ -376,6 +351,7 @@ class KarmaController(object):
         }
         self.respond(message, command)
 
+    @span()
     def cmd_karma_help(self, command):
         message = {
             'response_type': 'ephemeral',
@@ -413,15 +389,18 @@ class KarmaController(object):
                              "`/karma top groups` - Show the top 10 groups\n"
                              "`/karma top channels` - Show the top 10 channels\n"
                              "`/karma top things` - Show the top 10 things\n"
-                             "`/karma top channel members` - Show the top 10 members of a channel\n"
+                             "`/karma top this week` - Show the top 10 subjects for `today`, `this week`, `this month` or `last 7d` (`h`ours, `d`ays, `w`eeks)\n"  # noqa E501
+                             "`/karma top channel members [N]` - Show the top 10 (or N) members of a channel\n"
                              "`/karma stats` - Show some interesting statstics about Karma\n"
-                             "`/karma stats thing` - Show some interesting statstics about `thing`\n")
+                             "`/karma stats thing` - Show some interesting statstics about `thing`\n"
+                             "`/karma stats thing last 7d` - Show statstics about `thing` for a time window\n")
                 }
             ]
         }
 
         self.respond(message, command)
 
+    @span()
     def cmd_karma_show(self, command):
         # Remove the "show " from the command text
         subject = command['text'][5:]
@@ -477,72 +456,27 @@ class KarmaController(object):
 
         self.respond(message, command)
 
+    @span()
     def cmd_karma_subject_stats(self, command, subject_display):
         workspace_id = command['team_id']
-        collection = self.mongodb[workspace_id]
-
-        ktype = "thing"
-        subject = subject_display
-
-        f = True
-
-        match = regex.user_re.match(subject_display)
-        if f and match:
-            subject = match.group(1)
-            ktype = "user"
-            f = False
-
-        match = regex.channel_re.match(subject_display)
-        if f and match:
-            subject = match.group(1)
-            ktype = "channel"
-
-        match = regex.user_group_re.match(subject_display)
-        if f and match:
-            subject = match.group(1)
-            ktype = "group"
-
-        match = regex.quoted1_thing_re.match(subject_display)
-        if f and match:
-            subject = match.group("qthing1")
-            ktype = "thing"
-
-        match = regex.quoted2_thing_re.match(subject_display)
-        if f and match:
-            subject = match.group("qthing2")
-            ktype = "thing"
-
-        match = regex.squoted1_thing_re.match(subject_display)
-        if f and match:
-            subject = match.group("sqthing1")
-            ktype = "thing"
-
-        match = regex.squoted2_thing_re.match(subject_display)
-        if f and match:
-            subject = match.group("sqthing2")
-            ktype = "thing"
 
-        match = regex.squoted3_thing_re.match(subject_display)
-        if f and match:
-            subject = match.group("sqthing3")
-            ktype = "thing"
+        subject_display, since, window = rollups.parse_window(subject_display)
+        if since and not subject_display.strip():
+            return self.cmd_karma_stats(command, since, window)
+        if since:
+            return self.cmd_karma_subject_window_stats(command, subject_display, since, window)
 
-        match = regex.squoted4_thing_re.match(subject_display)
-        if f and match:
-            subject = match.group("sqthing4")
-            ktype = "thing"
+        ktype, subject = self.parse_subject(subject_display)
 
         current_app.logger.info(f"show karma stats for subject: {subject} type: {ktype}")
 
-        karma_ops = collection.find({"subject": subject, "type": ktype}).count()
-
-        gifters = self.get_gifters(workspace_id, ktype, subject)
-        karma = self.get_karma(workspace_id, ktype, subject)
+        stats = self.get_subject_stats(workspace_id, ktype, subject)
+        karma_ops = stats['ops']
+        karma = stats['total']
         karma_avg = (karma / karma_ops) if karma_ops != 0 else 0
-        top_5_gifters = gifters[:5]
 
         t5g_msg = ""
-        for g in top_5_gifters:
+        for g in stats['top_gifters']:
             t5g_msg = f"{t5g_msg}{g[1]} <@{g[0]}>\n"
 
         gifts_msg = None
@@ -593,7 +527,7 @@ class KarmaController(object):
                         },
                         {
                             "title": "Total Gifters",
-                            "value": f"{len(gifters)}",
+                            "value": f"{stats['gifters']}",
                             "short": True
                         },
                         {
@@ -612,7 +546,121 @@ class KarmaController(object):
         self.respond(message, command)
         return
 
+    @staticmethod
+    def parse_subject(subject_display):
+        ktype = "thing"
+        subject = subject_display
+
+        f = True
+
+        match = regex.user_re.match(subject_display)
+        if f and match:
+            subject = match.group(1)
+            ktype = "user"
+            f = False
+
+        match = regex.channel_re.match(subject_display)
+        if f and match:
+            subject = match.group(1)
+            ktype = "channel"
+
+        match = regex.user_group_re.match(subject_display)
+        if f and match:
+            subject = match.group(1)
+            ktype = "group"
+
+        match = regex.quoted1_thing_re.match(subject_display)
+        if f and match:
+            subject = match.group("qthing1")
+            ktype = "thing"
+
+        match = regex.quoted2_thing_re.match(subject_display)
+        if f and match:
+            subject = match.group("qthing2")
+            ktype = "thing"
+
+        match = regex.squoted1_thing_re.match(subject_display)
+        if f and match:
+            subject = match.group("sqthing1")
+            ktype = "thing"
+
+        match = regex.squoted2_thing_re.match(subject_display)
+        if f and match:
+            subject = match.group("sqthing2")
+            ktype = "thing"
+
+        match = regex.squoted3_thing_re.match(subject_display)
+        if f and match:
+            subject = match.group("sqthing3")
+            ktype = "thing"
+
+        match = regex.squoted4_thing_re.match(subject_display)
+        if f and match:
+            subject = match.group("sqthing4")
+            ktype = "thing"
+
+        return ktype, subject
+
+    @span()
+    def cmd_karma_subject_window_stats(self, command, subject_display, since, window):
+        workspace_id = command['team_id']
+        ktype, subject = self.parse_subject(subject_display)
+
+        current_app.logger.info(f"show karma stats for subject: {subject} type: {ktype} since: {since}")
+
+        karma, karma_ops = self.rollups.get_subject(workspace_id, ktype, subject, since)
+        karma_avg = (karma / karma_ops) if karma_ops != 0 else 0
+
+        fields = [
+            {
+                'title': 'Type',
+                'value': ktype,
+                'short': True
+            },
+            {
+                "title": "Avg Karma Per Op",
+                "value": karma_avg,
+                "short": True
+            },
+            {
+                "title": "Karma Value",
+                "value": karma,
+                "short": True
+            },
+            {
+                "title": "Karma Operations",
+                "value": karma_ops,
+                "short": True
+            }
+        ]
+        if ktype == "user":
+            given, given_ops = self.rollups.get_gifter(workspace_id, subject, since)
+            fields.append({
+                "title": "Karma Given",
+                "value": f"{given_ops} operations for a sum of {given}",
+                "short": False
+            })
+
+        message = {
+            'response_type': 'ephemeral',
+            'attachments': [
+                {
+                    "fallback": f"*Interesting Karma Stats for {subject_display} ({window}):*",
+                    "color": settings.KARMA_COLOR,
+                    "pretext": f"Interesting Karma Stats for {subject_display} ({window}):",
+                    "fields": fields
+                }
+            ]
+        }
+
+        self.respond(message, command)
+        return
+
+    @span()
     def get_top_karma(self, workspace_id, gifter=None, ktype=None, direction=-1, limit=10):
+        if not gifter:
+            return self.format_top_karma(leaderboards.standings(workspace_id, ktype=ktype, direction=direction, limit=limit))
+
         collection = self.mongodb[workspace_id]
 
         pipeline = [
@@ -621,77 +669,80 @@ class KarmaController(object):
             {"$limit": limit}
         ]
 
-        if not gifter and not ktype:
-            pipeline.insert(0, {"$match": {"$or": [
-                {"type": "thing"},
-                {"type": "user"},
-                {"type": "channel"},
-                {"type": "group"}
-            ]}})
-        if gifter and not ktype:
-            pipeline.insert(0, {"$match": {"gifter": gifter, "$or": [
-                {"type": "thing"},
-                {"type": "user"},
-                {"type": "channel"},
-                {"type": "group"}
-            ]}})
-        elif ktype and not gifter:
-            pipeline.insert(0, {"$match": {"type": ktype}})
-        elif ktype and gifter:
+        if not ktype:
+            pipeline.insert(0, {"$match": dict(karma_filter(workspace_id), gifter=gifter)})
+        else:
             pipeline.insert(0, {"$match": {"gifter": gifter, "type": ktype}})
 
         r = collection.aggregate(pipeline)
+        return self.format_top_karma((e["_id"]["type"], e["_id"]["subject"], e["total"]) for e in r)
 
+    @staticmethod
+    def format_top_karma(standings):
         msg = ""
-        for entry in r:
-            if entry["_id"]["type"] == "user":
-                msg = f'{msg}\n{entry["total"]}  <@{entry["_id"]["subject"]}> (user)'
-            elif entry["_id"]["type"] == "channel":
-                msg = f'{msg}\n{entry["total"]}  <#{entry["_id"]["subject"]}> (channel)'
-            elif entry["_id"]["type"] == "thing":
-                msg = f'{msg}\n{entry["total"]}  {entry["_id"]["subject"]} (thing)'
-            elif entry["_id"]["type"] == "group":
-                msg = f'{msg}\n{entry["total"]}  <!subteam^{entry["_id"]["subject"]}> (group)'
+        for ktype, subject, total in standings:
+            if ktype == "user":
+                msg = f'{msg}\n{total}  <@{subject}> (user)'
+            elif ktype == "channel":
+                msg = f'{msg}\n{total}  <#{subject}> (channel)'
+            elif ktype == "thing":
+                msg = f'{msg}\n{total}  {subject} (thing)'
+            elif ktype == "group":
+                msg = f'{msg}\n{total}  <!subteam^{subject}> (group)'
             else:
-                msg = f'{msg}\n{entry["total"]}  {entry["_id"]["subject"]} (?)'
+                msg = f'{msg}\n{total}  {subject} (?)'
 
         return msg
 
-    def get_gifters(self, workspace_id, ktype, subject):
+    @span()
+    def get_subject_stats(self, workspace_id, ktype, subject, top=5):
+        """
+            Operation count, karma sum, number of gifters and the top gifters
+            of a subject, all computed server-side in one query.
+
+            Returns:
+                (dict) {"ops": int, "total": int, "gifters": int, "top_gifters": [(gifter, total)]}
+        """
         collection = self.mongodb[workspace_id]
-        gifters = []
         pipeline = [
             {"$match": {"type": ktype, "subject": subject}},
-            {"$group": {"_id": "$gifter", "total": {"$sum": "$quantity"}}},
-            {"$sort": {"total": -1}}
+            {"$group": {"_id": "$gifter", "total": {"$sum": "$quantity"}, "ops": {"$sum": 1}}},
+            {"$facet": {
+                "summary": [{"$group": {"_id": None, "total": {"$sum": "$total"}, "ops": {"$sum": "$ops"}, "gifters": {"$sum": 1}}}],
+                "top_gifters": [{"$sort": {"total": -1}}, {"$limit": top}]
+            }}
         ]
-        results = collection.aggregate(pipeline)
-
-        for result in results:
-            gifters.append((result['_id'], result['total']))
-
-        return gifters
+        r = next(collection.aggregate(pipeline))
+
+        summary = r['summary'][0] if r['summary'] else {"total": 0, "ops": 0, "gifters": 0}
+        return {
+            "ops": summary['ops'],
+            "total": summary['total'],
+            "gifters": summary['gifters'],
+            "top_gifters": [(g['_id'], g['total']) for g in r['top_gifters']]
+        }
 
-    def cmd_karma_stats(self, command):
+    @span()
+    def cmd_karma_stats(self, command, since=None, window=None):
         workspace_id = command['team_id']
-        collection = self.mongodb[workspace_id]
-
-        total_count = collection.find({"$or": [
-            {"type": "thing"},
-            {"type": "user"},
-            {"type": "channel"},
-            {"type": "group"}
-        ]}).count()
-        thing_count = collection.find({"type": "thing"}).count()
-        user_count = collection.find({"type": "user"}).count()
-        channel_count = collection.find({"type": "channel"}).count()
-        group_count = collection.find({"type": "group"}).count()
-
-        total_karma = self.get_all_karma(workspace_id)
-        thing_karma = self.get_type_karma(workspace_id, "thing")
-        user_karma = self.get_type_karma(workspace_id, "user")
-        channel_karma = self.get_type_karma(workspace_id, "channel")
-        group_karma = self.get_type_karma(workspace_id, "group")
+        if since:
+            stats = self.rollups.get_stats(workspace_id, since)
+        else:
+            stats = self.totals.get_stats(workspace_id)
+            window = f"last {settings.KARMA_TTL} days"
+        types = stats['types']
+
+        total_count = sum(t['ops'] for t in types.values())
+        thing_count = types['thing']['ops']
+        user_count = types['user']['ops']
+        channel_count = types['channel']['ops']
+        group_count = types['group']['ops']
+
+        total_karma = sum(t['total'] for t in types.values())
+        thing_karma = types['thing']['total']
+        user_karma = types['user']['total']
+        channel_karma = types['channel']['total']
+        group_karma = types['group']['total']
 
         total_avg = (total_karma / total_count) if total_count != 0 else 0
         thing_avg = (thing_karma / thing_count) if thing_count != 0 else 0
@@ -699,16 +750,16 @@ class KarmaController(object):
         channel_avg = (channel_karma / channel_count) if channel_count != 0 else 0
         group_avg = (group_karma / group_count) if group_count != 0 else 0
 
-        gifters = self.get_karma_gifter_count(workspace_id)
-        subjects = self.get_subject_count(workspace_id, None)
+        gifters = stats['gifters']
+        subjects = stats['subjects']
 
         message = {
             'response_type': 'ephemeral',
             'attachments': [
                 {
-                    "fallback": f"*Interesting Karma Stats (last {settings.KARMA_TTL} days):*",
+                    "fallback": f"*Interesting Karma Stats ({window}):*",
                     "color": settings.KARMA_COLOR,
-                    "pretext": f"Interesting Karma Stats (last {settings.KARMA_TTL} days):",
+                    "pretext": f"Interesting Karma Stats ({window}):",
                     "fields": [
                         {
                             "title": "All Karma",
@@ -757,9 +808,11 @@ class KarmaController(object):
         self.respond(message, command)
         return
 
+    @span()
     def cmd_karma_top(self, command, direction=-1):
 
-        args = command['text'].split()
+        text, since, window = rollups.parse_window(command['text'])
+        args = text.split()
 
         header = "Top"
         if direction == 1:
@@ -781,7 +834,12 @@ class KarmaController(object):
                 header = f"{header} Thing"
         header = f"{header} Karma Standings"
 
-        toplist = self.get_top_karma(command['team_id'], ktype=ktype, direction=direction)
+        if since:
+            header = f"{header} ({window})"
+            standings = self.rollups.get_top(command['team_id'], since, ktype=ktype, direction=direction)
+            toplist = self.format_top_karma(standings)
+        else:
+            toplist = self.get_top_karma(command['team_id'], ktype=ktype, direction=direction)
 
         message = {
             'response_type': 'ephemeral',
@@ -803,6 +861,7 @@ class KarmaController(object):
         return
 
     @staticmethod
+    @span()
     def cmd_leave(command):
         user = command['user_id']
         channel = command['channel_id']
@@ -812,16 +871,14 @@ class KarmaController(object):
             slack_client.post_message(command['team_id'], channel, f"Left at <@{user}>'s request.", 'none')
 
     @staticmethod
+    @span()
     def blacklisted(workspace_id, user_id):
         # Maybe someday be able to blacklist specific users
         if user_id == "USLACKBOT":
             return True
 
-        userinfo_r = slack_client.get_userinfo(workspace_id, user_id)
-        if userinfo_r.status != 200:
-            return False
-        userinfo = userinfo_r.json
-        if userinfo['user']['is_bot']:
+        userinfo = user_cache.get(workspace_id, user_id)
+        if userinfo and userinfo['is_bot']:
             return True
 
         return False
@@ -835,22 +892,18 @@ class KarmaController(object):
             message['response_type'] = ''
             slack_client.post_attachment(command['team_id'], message)
 
-    def get_top_channel_members(self, command):
-        channel_members = slack_client.get_all_channel_members(command['team_id'], command['channel_id'])
-        current_app.logger.debug(f"channel_members: {channel_members}")
+    @span()
+    def get_top_channel_members(self, command, limit=10):
+        workspace_id = command['team_id']
+        channel_members = slack_client.get_all_channel_members(workspace_id, command['channel_id'])
+        current_app.logger.debug(f"channel_members: {len(channel_members)}")
 
-        collection = self.mongodb[command['team_id']]
-        q = [{"subject": uid} for uid in channel_members]
-        pipeline = [
-            {"$match": {"$or": q}},
-            {"$group": {"_id": {"type": "$type", "subject": "$subject"}, "total": {"$sum": "$quantity"}}},
-            {"$sort": {"total": -1}},
-            {"$limit": 10}
-        ]
-        results = collection.aggregate(pipeline)
-        top_members = []
-        for u in results:
-            top_members.append(f"{u['total']} <@{u['_id']['subject']}>")
+        top = self.totals.get_top_subjects(workspace_id, "user", channel_members, limit)
+        top_members = [f"{total} <@{subject}>" for subject, total in top]
+
+        title = "Top User Karma for this Channel"
+        if limit != 10:
+            title = f"Top {limit} User Karma for this Channel"
         message = {
             'response_type': 'ephemeral',
             'attachments': [
@@ -858,7 +911,7 @@ class KarmaController(object):
                     "color": settings.KARMA_COLOR,
                     "fields": [
                         {
-                            "title": "Top User Karma for this Channel",
+                            "title": title,
                             "value": '\n'.join(top_members),
                             "short": False
                         }
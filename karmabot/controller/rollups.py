@@ -0,0 +1,280 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+from collections import defaultdict
+from karmabot import db
+from karmabot.controller.totals import KARMA_TYPES, TotalsController, counters_marker, karma_filter, rollups_built
+from karmabot import regex
+from karmabot import settings
+from pymongo import UpdateOne
+
+HOUR = datetime.timedelta(hours=1)
+DAY = datetime.timedelta(days=1)
+
+# collection -> (the fields besides `workspace` and `bucket` that identify a rollup, bucket size)
+ROLLUPS = {
+    "karma_rollup_subject_hourly": (("type", "subject"), HOUR),
+    "karma_rollup_subject_daily": (("type", "subject"), DAY),
+    "karma_rollup_gifter_hourly": (("gifter",), HOUR),
+    "karma_rollup_gifter_daily": (("gifter",), DAY),
+}
+
+
+def bucket_start(date, size):
+    if size == DAY:
+        return date.replace(hour=0, minute=0, second=0, microsecond=0)
+    return date.replace(minute=0, second=0, microsecond=0)
+
+
+def parse_window(text, now=None):
+    """
+        Split a trailing time window (`last 7d`, `last 12h`, `last 2w`, `today`,
+        `this week`, `this month`) off a command.
+
+        Returns:
+            (tuple) (text without the window, window start or None, window description or None)
+    """
+    match = regex.window_re.search(text)
+    if not match:
+        return text, None, None
+
+    now = now or datetime.datetime.utcnow()
+    today = bucket_start(now, DAY)
+    if match.group('count'):
+        count = int(match.group('count'))
+        unit = match.group('unit')
+        since = now - {"h": HOUR, "d": DAY, "w": 7 * DAY}[unit] * count
+        label = f"last {count}{unit}"
+    else:
+        label = " ".join(match.group('period').split())
+        if label == "today":
+            since = today
+        elif label == "this week":
+            since = today - today.weekday() * DAY
+        else:
+            since = today.replace(day=1)
+
+    return text[:match.start()], since, label
+
+
+class RollupsController(object):
+    """
+        Folds karma operations into hourly and daily buckets per (type, subject)
+        and per gifter, so time-windowed statistics read a handful of bucket
+        documents instead of every operation.
+
+        A bucket expires KARMA_TTL days after it ends, together with the last
+        operation that could be in it.
+
+        Like the totals, rollups are only added to from the marker's
+        `count_from` on, and the operations before that are added up into
+        them by `TotalsController.rebuild`.  Until then (`rollups_built`),
+        reads add up the operations instead.
+    """
+
+    def __init__(self):
+        self.mongodb = db.get_database()
+
+    def add(self, workspace_id, ops):
+        """
+            Add karma operations to their buckets, with one bulk write per rollup collection.
+        """
+        marker = counters_marker(workspace_id)
+        count_from = marker and marker.get('count_from')
+        if not count_from:
+            return
+        ops = [op for op in ops if op['date'] >= count_from]
+
+        for name, (fields, size) in ROLLUPS.items():
+            deltas = defaultdict(lambda: [0, 0])
+            for op in ops:
+                delta = deltas[(bucket_start(op['date'], size),) + tuple(op[f] for f in fields)]
+                delta[0] += op['quantity']
+                delta[1] += 1
+
+            requests = []
+            for (bucket, *values), (total, count) in deltas.items():
+                key = dict(zip(fields, values), workspace=workspace_id, bucket=bucket)
+                requests.append(UpdateOne(
+                    key,
+                    {
+                        "$inc": {"total": total, "ops": count},
+                        "$setOnInsert": {"expires": bucket + size + datetime.timedelta(days=settings.KARMA_TTL)}
+                    },
+                    upsert=True))
+            if requests:
+                self.mongodb[name].bulk_write(requests, ordered=False)
+
+    def clear(self, workspace_id):
+        for name in ROLLUPS:
+            self.mongodb[name].delete_many({"workspace": workspace_id})
+
+    def rebuild(self, workspace_id, count_from, current):
+        """
+            Add up the operations dated before `count_from` into their buckets,
+            checking `current(workspace_id)` before each write.
+
+            Returns:
+                (int) number of buckets written, or None if the rebuild was lost
+                part way
+        """
+        count = 0
+        for name, (fields, size) in ROLLUPS.items():
+            parts = {"year": {"$year": "$date"}, "month": {"$month": "$date"}, "day": {"$dayOfMonth": "$date"}}
+            if size == HOUR:
+                parts["hour"] = {"$hour": "$date"}
+            pipeline = [
+                {"$match": dict(karma_filter(workspace_id), date={"$not": {"$gte": count_from}})},
+                {"$group": {
+                    "_id": dict({f: f"${f}" for f in fields}, **parts),
+                    "total": {"$sum": "$quantity"},
+                    "ops": {"$sum": 1}
+                }}
+            ]
+            collection = self.mongodb[name]
+
+            requests = []
+            for r in self.mongodb[workspace_id].aggregate(pipeline, allowDiskUse=True):
+                bucket = datetime.datetime(r['_id']['year'], r['_id']['month'], r['_id']['day'], r['_id'].get('hour', 0))
+                key = dict({f: r['_id'].get(f) for f in fields}, workspace=workspace_id, bucket=bucket)
+                requests.append(UpdateOne(
+                    key,
+                    {
+                        "$inc": {"total": r['total'], "ops": r['ops']},
+                        "$setOnInsert": {"expires": bucket + size + datetime.timedelta(days=settings.KARMA_TTL)}
+                    },
+                    upsert=True))
+                count += 1
+                if len(requests) >= 1000:
+                    if not current(workspace_id):
+                        return None
+                    collection.bulk_write(requests, ordered=False)
+                    requests = []
+            if requests:
+                if not current(workspace_id):
+                    return None
+                collection.bulk_write(requests, ordered=False)
+        return count
+
+    @staticmethod
+    def _collection(scope, since, now=None):
+        """
+            Hourly buckets for windows up to two days, daily buckets beyond that.
+        """
+        now = now or datetime.datetime.utcnow()
+        size = HOUR if now - since <= 2 * DAY else DAY
+        return f"karma_rollup_{scope}_{'hourly' if size == HOUR else 'daily'}", bucket_start(since, size)
+
+    def get_subject(self, workspace_id, ktype, subject, since):
+        """
+            Returns:
+                (tuple) (karma, operations) for the subject since the start of the window
+        """
+        name, start = self._collection("subject", since)
+        if not rollups_built(workspace_id):
+            return self._sum_ops(workspace_id, {"type": ktype, "subject": subject, "date": {"$gte": start}})
+
+        pipeline = [
+            {"$match": {"workspace": workspace_id, "type": ktype, "subject": subject, "bucket": {"$gte": start}}},
+            {"$group": {"_id": None, "total": {"$sum": "$total"}, "ops": {"$sum": "$ops"}}}
+        ]
+        for r in self.mongodb[name].aggregate(pipeline):
+            return r['total'], r['ops']
+        return 0, 0
+
+    def get_gifter(self, workspace_id, gifter, since):
+        """
+            Returns:
+                (tuple) (karma, operations) given by the gifter since the start of the window
+        """
+        name, start = self._collection("gifter", since)
+        if not rollups_built(workspace_id):
+            return self._sum_ops(workspace_id, dict(karma_filter(workspace_id), gifter=gifter, date={"$gte": start}))
+
+        pipeline = [
+            {"$match": {"workspace": workspace_id, "gifter": gifter, "bucket": {"$gte": start}}},
+            {"$group": {"_id": None, "total": {"$sum": "$total"}, "ops": {"$sum": "$ops"}}}
+        ]
+        for r in self.mongodb[name].aggregate(pipeline):
+            return r['total'], r['ops']
+        return 0, 0
+
+    def _sum_ops(self, workspace_id, match):
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": None, "total": {"$sum": "$quantity"}, "ops": {"$sum": 1}}}
+        ]
+        for r in self.mongodb[workspace_id].aggregate(pipeline):
+            return r['total'], r['ops']
+        return 0, 0
+
+    def get_stats(self, workspace_id, since):
+        """
+            Like TotalsController.get_stats, for karma given since the start of the window.
+
+            Returns:
+                (dict) {"types": {ktype: {"ops": int, "total": int}}, "gifters": int, "subjects": int}
+        """
+        name, start = self._collection("subject", since)
+        if not rollups_built(workspace_id):
+            return TotalsController().get_stats_from_ops(workspace_id, since=start)
+
+        pipeline = [
+            {"$match": {"workspace": workspace_id, "bucket": {"$gte": start}}},
+            {"$facet": {
+                "types": [{"$group": {"_id": "$type", "ops": {"$sum": "$ops"}, "total": {"$sum": "$total"}}}],
+                "subjects": [{"$group": {"_id": {"type": "$type", "subject": "$subject"}}}, {"$count": "count"}]
+            }}
+        ]
+        r = next(self.mongodb[name].aggregate(pipeline))
+
+        name, start = self._collection("gifter", since)
+        pipeline = [
+            {"$match": {"workspace": workspace_id, "bucket": {"$gte": start}}},
+            {"$group": {"_id": "$gifter"}},
+            {"$count": "count"}
+        ]
+        gifters = next(self.mongodb[name].aggregate(pipeline), {"count": 0})
+
+        types = {t['_id']: t for t in r['types']}
+        return {
+            "types": {t: {"ops": types.get(t, {}).get('ops', 0), "total": types.get(t, {}).get('total', 0)}
+                      for t in KARMA_TYPES},
+            "gifters": gifters['count'],
+            "subjects": r['subjects'][0]['count'] if r['subjects'] else 0
+        }
+
+    def get_top(self, workspace_id, since, ktype=None, direction=-1, limit=10):
+        """
+            Returns:
+                (list) [(ktype, subject, total)] for karma given since the start of the window
+        """
+        name, start = self._collection("subject", since)
+        if rollups_built(workspace_id):
+            match = {"workspace": workspace_id, "bucket": {"$gte": start}}
+            total = "$total"
+        else:
+            name = workspace_id
+            match = dict(karma_filter(workspace_id), date={"$gte": start})
+            total = "$quantity"
+        if ktype:
+            match["type"] = ktype
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": {"type": "$type", "subject": "$subject"}, "total": {"$sum": total}}},
+            {"$sort": {"total": direction}},
+            {"$limit": limit}
+        ]
+        return [(r['_id']['type'], r['_id']['subject'], r['total']) for r in self.mongodb[name].aggregate(pipeline)]
@@ -0,0 +1,419 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import heapq
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from karmabot import db
+from karmabot import settings
+from karmabot.badgemap import MIGRATIONS_COLLECTION, badges_migrated
+from karmabot.leases import Lease, renewing
+from karmabot.metrics import log_metrics
+from pymongo import DESCENDING, UpdateOne
+
+KARMA_TYPES = ["thing", "user", "channel", "group"]
+
+# Materialized counters, shared by all workspaces
+TOTALS_COLLECTION = "karma_totals"
+TYPE_TOTALS_COLLECTION = "karma_type_totals"
+GIFTER_TOTALS_COLLECTION = "karma_gifter_totals"
+
+# collection -> the fields (besides `workspace`) that identify a counter
+COUNTERS = {
+    TOTALS_COLLECTION: ("type", "subject"),
+    TYPE_TOTALS_COLLECTION: ("type",),
+    GIFTER_TOTALS_COLLECTION: ("gifter",),
+}
+
+# How long a store may take between dating its operations and incrementing the counters, in seconds
+IN_FLIGHT = 5
+
+# How long the lease on a workspace's rebuild lasts unless it is renewed, in seconds
+REBUILD_LEASE = 60
+
+# workspace_id -> (checked timestamp, counters marker or None)
+_markers = {}
+
+
+def counters_marker(workspace_id):
+    """
+        The `totals:<workspace>` document in MIGRATIONS_COLLECTION, which says
+        from which operation `date` on the counters are incremented
+        (`count_from`), and whether the operations before that have been
+        added up into them (`built`).  Re-read every KARMA_TOTALS_CHECK_INTERVAL
+        seconds, so a rebuild started by another process is noticed.
+    """
+    checked = _markers.get(workspace_id)
+    if checked and checked[0] + settings.KARMA_TOTALS_CHECK_INTERVAL > time.time():
+        return checked[1]
+
+    marker = db.get_database()[MIGRATIONS_COLLECTION].find_one({"_id": f"totals:{workspace_id}"})
+    _markers[workspace_id] = (time.time(), marker)
+    return marker
+
+
+def counters_built(workspace_id):
+    marker = counters_marker(workspace_id)
+    return bool(marker and marker.get('built'))
+
+
+def rollups_built(workspace_id):
+    """
+        Whether the rollups were built along with the counters, which rebuilds
+        from before there were rollups didn't do.
+    """
+    marker = counters_marker(workspace_id)
+    return bool(marker and marker.get('built') and marker.get('rollups'))
+
+
+def karma_filter(workspace_id):
+    """
+        Selects the karma operations of a workspace collection, which holds
+        badges too until they are migrated.
+    """
+    if badges_migrated(workspace_id):
+        return {}
+    return {"type": {"$in": KARMA_TYPES}}
+
+
+class TotalsController(object):
+    """
+        Maintains the materialized karma counters, so reads don't have to
+        aggregate every karma operation of a workspace.
+
+        Each counter document holds the `total` karma and number of `ops`:
+          * karma_totals: per (workspace, type, subject)
+          * karma_type_totals: per (workspace, type)
+          * karma_gifter_totals: per (workspace, gifter)
+
+        Counters are incremented by `store_karma` and decremented by the
+        expiry sweeper when it deletes the operations.  Until a workspace's
+        counters have been built from its existing operations (see
+        `rebuild`), reads add up the operations instead.
+    """
+
+    def __init__(self):
+        self.mongodb = db.get_database()
+
+    def increment(self, workspace_id, ops):
+        """
+            Add karma operations to the counters, with one bulk write per counter collection.
+
+            Args:
+                workspace_id (str): The workspace the operations belong to
+                ops (list): The stored operation documents
+        """
+        marker = counters_marker(workspace_id)
+        count_from = marker and marker.get('count_from')
+        if not count_from:
+            # Nothing is counted until a rebuild says from when on
+            return
+        self._apply(workspace_id, [op for op in ops if op['date'] >= count_from], 1)
+
+    def decrement(self, workspace_id, ops):
+        """
+            Remove karma operations from the counters.
+
+            Args:
+                workspace_id (str): The workspace the operations belonged to
+                ops (list): The deleted operation documents
+        """
+        for name in self._apply(workspace_id, ops, -1):
+            self.mongodb[name].delete_many({"workspace": workspace_id, "ops": {"$lte": 0}})
+
+    def _apply(self, workspace_id, ops, sign):
+        """
+            Returns:
+                (list) the counter collections that were updated
+        """
+        updated = []
+        for name, fields in COUNTERS.items():
+            deltas = defaultdict(lambda: [0, 0])
+            for op in ops:
+                if op.get('type') not in KARMA_TYPES:
+                    continue
+                delta = deltas[tuple(op.get(f) for f in fields)]
+                delta[0] += sign * op.get('quantity', 0)
+                delta[1] += sign
+            if not deltas:
+                continue
+
+            requests = []
+            for values, (total, count) in deltas.items():
+                key = dict(zip(fields, values), workspace=workspace_id)
+                requests.append(UpdateOne(key, {"$inc": {"total": total, "ops": count}}, upsert=sign > 0))
+            self.mongodb[name].bulk_write(requests, ordered=False)
+            updated.append(name)
+        return updated
+
+    def get_total(self, workspace_id, ktype, subject):
+        if not counters_built(workspace_id):
+            return self.get_totals_from_ops(workspace_id, [(ktype, subject)]).get((ktype, subject), 0)
+
+        r = self.mongodb[TOTALS_COLLECTION].find_one(
+            {"workspace": workspace_id, "type": ktype, "subject": subject},
+            {"_id": 0, "total": 1})
+        if not r:
+            return 0
+        return r['total']
+
+    def get_totals(self, workspace_id, subjects):
+        """
+            Returns:
+                (dict) {(ktype, subject): total} for the (ktype, subject) pairs that have a total
+        """
+        if not subjects:
+            return {}
+        if not counters_built(workspace_id):
+            return self.get_totals_from_ops(workspace_id, subjects)
+
+        results = self.mongodb[TOTALS_COLLECTION].find(
+            {"workspace": workspace_id, "$or": [{"type": ktype, "subject": subject} for ktype, subject in subjects]},
+            {"_id": 0, "type": 1, "subject": 1, "total": 1})
+        return {(r['type'], r['subject']): r['total'] for r in results}
+
+    def get_totals_from_ops(self, workspace_id, subjects):
+        pipeline = [
+            {"$match": {"$or": [{"type": ktype, "subject": subject} for ktype, subject in subjects]}},
+            {"$group": {"_id": {"type": "$type", "subject": "$subject"}, "total": {"$sum": "$quantity"}}}
+        ]
+        return {(r['_id']['type'], r['_id']['subject']): r['total']
+                for r in self.mongodb[workspace_id].aggregate(pipeline)}
+
+    def get_top_subjects(self, workspace_id, ktype, subjects, limit=10):
+        """
+            The subjects with the highest totals out of a (possibly very large)
+            list.  Subjects are looked up KARMA_CHANNEL_CHUNK at a time with an
+            indexed `$in`, chunks run concurrently, and each chunk's top `limit`
+            are merged here.
+
+            Returns:
+                (list) [(subject, total)], highest total first
+        """
+        built = counters_built(workspace_id)
+        size = settings.KARMA_CHANNEL_CHUNK
+        chunks = [subjects[i:i + size] for i in range(0, len(subjects), size)]
+
+        def top_of(chunk):
+            ts = time.time()
+            if built:
+                results = list(self.mongodb[TOTALS_COLLECTION]
+                               .find({"workspace": workspace_id, "type": ktype, "subject": {"$in": chunk}},
+                                     {"_id": 0, "subject": 1, "total": 1})
+                               .sort("total", DESCENDING).limit(limit))
+            else:
+                results = list(self.mongodb[workspace_id].aggregate([
+                    {"$match": {"type": ktype, "subject": {"$in": chunk}}},
+                    {"$group": {"_id": "$subject", "total": {"$sum": "$quantity"}}},
+                    {"$sort": {"total": DESCENDING}},
+                    {"$limit": limit},
+                    {"$project": {"_id": 0, "subject": "$_id", "total": 1}}
+                ]))
+            log_metrics('karmabot_top_subjects', {'workspace': workspace_id}, 'chunk_time_elapsed',
+                        int((time.time() - ts) * 1000))
+            return results
+
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(chunks), settings.KARMA_CHANNEL_WORKERS)) as pool:
+                partials = list(pool.map(top_of, chunks))
+        else:
+            partials = [top_of(chunk) for chunk in chunks]
+
+        top = heapq.nlargest(limit, (r for partial in partials for r in partial), key=lambda r: r['total'])
+        return [(r['subject'], r['total']) for r in top]
+
+    def get_stats(self, workspace_id):
+        """
+            Operation counts and karma sums per type, plus the number of
+            distinct gifters and subjects.  Read from the counters once they
+            are built, otherwise computed from the operations in a single
+            aggregation.
+
+            Returns:
+                (dict) {"types": {ktype: {"ops": int, "total": int}}, "gifters": int, "subjects": int}
+        """
+        if not counters_built(workspace_id):
+            return self.get_stats_from_ops(workspace_id)
+
+        types = {r['type']: r for r in self.mongodb[TYPE_TOTALS_COLLECTION].find({"workspace": workspace_id})}
+
+        return {
+            "types": {t: {"ops": types.get(t, {}).get('ops', 0), "total": types.get(t, {}).get('total', 0)}
+                      for t in KARMA_TYPES},
+            "gifters": self.mongodb[GIFTER_TOTALS_COLLECTION].count_documents({"workspace": workspace_id}),
+            "subjects": self.mongodb[TOTALS_COLLECTION].count_documents({"workspace": workspace_id})
+        }
+
+    def get_stats_from_ops(self, workspace_id, since=None):
+        match = karma_filter(workspace_id)
+        if since:
+            match = dict(match, date={"$gte": since})
+        pipeline = [
+            {"$match": match},
+            {"$facet": {
+                "types": [{"$group": {"_id": "$type", "ops": {"$sum": 1}, "total": {"$sum": "$quantity"}}}],
+                "gifters": [{"$group": {"_id": "$gifter"}}, {"$count": "count"}],
+                "subjects": [{"$group": {"_id": {"type": "$type", "subject": "$subject"}}}, {"$count": "count"}]
+            }}
+        ]
+        r = next(self.mongodb[workspace_id].aggregate(pipeline, allowDiskUse=True))
+
+        types = {t['_id']: t for t in r['types']}
+        return {
+            "types": {t: {"ops": types.get(t, {}).get('ops', 0), "total": types.get(t, {}).get('total', 0)}
+                      for t in KARMA_TYPES},
+            "gifters": r['gifters'][0]['count'] if r['gifters'] else 0,
+            "subjects": r['subjects'][0]['count'] if r['subjects'] else 0
+        }
+
+    def rebuild(self, workspace_ids):
+        """
+            Build the counters of some workspaces from their karma operations,
+            while karma keeps being given.
+
+              1. Stop counting, wait until every process has noticed, and
+                 clear the counters.  Reads add up the operations meanwhile.
+              2. Pick a `count_from` date a little in the future, from which on
+                 every process increments the counters again.
+              3. Once it has passed, add up the operations dated before it and
+                 `$inc` them into the counters, and into the rollups'
+                 hourly and daily buckets.
+
+            A rebuild holds a lease on each workspace (`totals:<workspace>` in
+            LOCKS_COLLECTION), renewed until it is done, and workspaces whose
+            lease another process holds are skipped.  Each step, and each
+            write to the counters, is only made while the lease is held and
+            the marker still carries this rebuild's id.
+
+            Returns:
+                (dict) {workspace_id: number of subjects with a total}, for the
+                workspaces that were rebuilt
+        """
+        markers = self.mongodb[MIGRATIONS_COLLECTION]
+        settle = 2 * settings.KARMA_TOTALS_CHECK_INTERVAL + IN_FLIGHT
+        rebuild_id = uuid.uuid4().hex
+
+        leases = {}
+        for workspace_id in workspace_ids:
+            lease = Lease(f"totals:{workspace_id}", REBUILD_LEASE)
+            if lease.acquire():
+                leases[workspace_id] = lease
+            else:
+                current_app.logger.info(f"Karma totals for {workspace_id} are being rebuilt by another process")
+
+        def current(workspace_id):
+            return leases[workspace_id].held and self._is_current(workspace_id, rebuild_id)
+
+        # Imported here, as the rollups are built on the totals
+        from karmabot.controller.rollups import RollupsController
+        rollups = RollupsController()
+
+        counts = {}
+        try:
+            with renewing(*leases.values()):
+                workspace_ids = list(leases)
+                for workspace_id in workspace_ids:
+                    markers.replace_one({"_id": f"totals:{workspace_id}"},
+                                        {"rebuild": rebuild_id, "count_from": None, "built": False}, upsert=True)
+                    _markers.pop(workspace_id, None)
+                time.sleep(settle)
+
+                workspace_ids = [w for w in workspace_ids if current(w)]
+                for workspace_id in workspace_ids:
+                    for name in COUNTERS:
+                        self.mongodb[name].delete_many({"workspace": workspace_id})
+                    rollups.clear(workspace_id)
+                count_from = datetime.datetime.utcnow() + datetime.timedelta(seconds=settle)
+                workspace_ids = [w for w in workspace_ids if self._advance(w, rebuild_id, {"count_from": count_from})]
+                time.sleep(settle + IN_FLIGHT)
+
+                for workspace_id in workspace_ids:
+                    built = {}
+                    for name, fields in COUNTERS.items():
+                        built[name] = self._rebuild_counter(workspace_id, name, fields, count_from, current)
+                        if built[name] is None:
+                            break
+                    else:
+                        built['rollups'] = rollups.rebuild(workspace_id, count_from, current)
+                        if built['rollups'] is not None and current(workspace_id) and \
+                                self._advance(workspace_id, rebuild_id,
+                                              {"built": True, "rollups": True, "date": datetime.datetime.utcnow()}):
+                            counts[workspace_id] = built
+                            current_app.logger.info(f"Rebuilt karma totals for {workspace_id}: {built}")
+                            continue
+                    current_app.logger.warning(f"Lost the rebuild of the karma totals for {workspace_id}, giving up")
+        finally:
+            for lease in leases.values():
+                lease.release()
+        return {w: c[TOTALS_COLLECTION] for w, c in counts.items()}
+
+    def _is_current(self, workspace_id, rebuild_id):
+        return self.mongodb[MIGRATIONS_COLLECTION].count_documents(
+            {"_id": f"totals:{workspace_id}", "rebuild": rebuild_id}) > 0
+
+    def _advance(self, workspace_id, rebuild_id, fields):
+        r = self.mongodb[MIGRATIONS_COLLECTION].update_one({"_id": f"totals:{workspace_id}", "rebuild": rebuild_id},
+                                                           {"$set": fields})
+        _markers.pop(workspace_id, None)
+        if not r.matched_count:
+            current_app.logger.warning(f"Another rebuild of the karma totals for {workspace_id} started, giving up")
+        return r.matched_count > 0
+
+    def _rebuild_counter(self, workspace_id, name, fields, count_from, current):
+        """
+            Add up the operations dated before `count_from` into a counter
+            collection, checking `current(workspace_id)` before each write.
+
+            Returns:
+                (int) number of counters written, or None if the rebuild was
+                lost part way
+        """
+        pipeline = [
+            {"$match": dict(karma_filter(workspace_id), date={"$not": {"$gte": count_from}})},
+            {"$group": {
+                "_id": {f: f"${f}" for f in fields},
+                "total": {"$sum": "$quantity"},
+                "ops": {"$sum": 1}
+            }}
+        ]
+        collection = self.mongodb[name]
+
+        requests = []
+        count = 0
+        for r in self.mongodb[workspace_id].aggregate(pipeline, allowDiskUse=True):
+            # Operations from count_from on have been incremented already
+            requests.append(UpdateOne(self._key(workspace_id, fields, r['_id']),
+                                      {"$inc": {"total": r['total'], "ops": r['ops']}}, upsert=True))
+            count += 1
+            if len(requests) >= 1000:
+                if not current(workspace_id):
+                    return None
+                collection.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            if not current(workspace_id):
+                return None
+            collection.bulk_write(requests, ordered=False)
+        return count
+
+    @staticmethod
+    def _key(workspace_id, fields, doc):
+        key = {"workspace": workspace_id}
+        for f in fields:
+            key[f] = doc.get(f)
+        return key
@@ -0,0 +1,123 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  The MongoDB client shared by every controller in the process.
+"""
+
+import os
+import threading
+import time
+
+from flask import current_app
+from pymongo import MongoClient, monitoring
+
+from karmabot.metrics import log_metrics
+from karmabot.querylog import command_listener
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """
+        Tracks how long threads wait to check out a connection, and how many
+        connections are checked out right now.
+    """
+
+    def __init__(self):
+        self.in_use = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.in_use += 1
+        started = getattr(self._local, 'started', None)
+        if started is not None:
+            wait = time.perf_counter() - started
+            log_metrics('karmabot_mongo_pool', None, 'checkout_wait_us', int(wait * 1000000))
+
+    def connection_check_out_failed(self, event):
+        log_metrics('karmabot_mongo_pool', {'reason': str(event.reason)}, 'checkout_failed', 1)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+
+pool_listener = PoolListener()
+
+
+def get_client():
+    """
+        Get the process-wide MongoClient, creating it on first use.
+
+        MongoClient is not fork-safe, so a forked process (e.g. a gunicorn
+        worker) gets its own client instead of inheriting its parent's.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                config = current_app.config
+                pool_listener.in_use = 0
+                command_listener.app = current_app._get_current_object()
+                _client = MongoClient(config.get('MONGODB'),
+                                      maxPoolSize=config.get('MONGODB_MAX_POOL_SIZE'),
+                                      connectTimeoutMS=config.get('MONGODB_CONNECT_TIMEOUT'),
+                                      serverSelectionTimeoutMS=config.get('MONGODB_SERVER_SELECTION_TIMEOUT'),
+                                      event_listeners=[pool_listener, command_listener])
+                _client_pid = pid
+    return _client
+
+
+def get_database():
+    return get_client()['karmabot']
+
+
+def workspace_ids(mongodb):
+    """
+        Workspace collections are named after the workspace ID; everything else
+        karmabot stores is prefixed with `karma_`.
+    """
+    return [name for name in mongodb.list_collection_names()
+            if not name.startswith("karma_") and not name.startswith("system.")]
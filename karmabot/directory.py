@@ -0,0 +1,268 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  A directory of the users in each workspace, so finding a user by name
+  doesn't page through `users.list`.
+"""
+
+import datetime
+import threading
+import time
+
+from pymongo import ReplaceOne
+
+from flask import current_app
+
+from karmabot import db
+from karmabot import settings
+from karmabot.leases import Lease, renewing
+from karmabot.metrics import log_metrics
+from karmabot.service import slack as slack_client
+
+USERS_COLLECTION = "karma_users"
+DIRECTORIES_COLLECTION = "karma_user_directories"
+
+USER_FLAGS = ("is_bot", "is_admin", "deleted")
+
+# How long the lease on a workspace's crawl lasts unless it is renewed, in seconds
+CRAWL_LEASE = 120
+# How often a process waiting for another one's crawl checks for the snapshot, in seconds
+CRAWL_POLL = 1
+
+
+class UserDirectory(object):
+    """
+        Per workspace, maps user names to IDs and IDs to (name, flags).
+
+        A workspace is loaded from its snapshot in USERS_COLLECTION, or crawled
+        from `users.list` the first time it is needed.  After that it is kept
+        up to date by `team_join` and `user_change` events, which are written
+        through to the snapshot.  Snapshots older than KARMA_DIRECTORY_REFRESH
+        seconds are crawled again in the background, to catch up on events
+        that were missed.
+
+        Only one process crawls a workspace at a time, holding the
+        `directory:<workspace>` lease.  The others wait for its snapshot and
+        load that.
+    """
+
+    def __init__(self):
+        # workspace_id -> {"names": {name: id}, "users": {id: (name, *USER_FLAGS)}}
+        self._workspaces = {}
+        self._lock = threading.Lock()
+        # workspace_id -> lock held while loading it
+        self._loading = {}
+
+    def start(self, app):
+        """
+            Load (or crawl) every known workspace in the background.
+        """
+        def run():
+            with app.app_context():
+                for workspace_id in db.workspace_ids(db.get_database()):
+                    try:
+                        self._get(workspace_id)
+                    except Exception as ex:
+                        app.logger.warning(f"Unable to load the user directory for {workspace_id}: {ex}")
+
+        threading.Thread(target=run, name="karmabot-user-directory", daemon=True).start()
+
+    def lookup_user(self, workspace_id, name):
+        """
+            Returns:
+                (dict) {"id", "name", *USER_FLAGS} for the user with that name, or None
+        """
+        directory = self._get(workspace_id)
+        user_id = directory['names'].get(name)
+        if not user_id:
+            return None
+        return self._user(user_id, directory['users'][user_id])
+
+    def get_user(self, workspace_id, user_id):
+        """
+            Like lookup_user, by ID.  Only answers from a directory that is
+            already loaded, so it never waits for a crawl.
+        """
+        directory = self._workspaces.get(workspace_id)
+        if not directory or user_id not in directory['users']:
+            return None
+        return self._user(user_id, directory['users'][user_id])
+
+    def update(self, workspace_id, user):
+        """
+            Add or update a user from a Slack user object, e.g. from a
+            `team_join` or `user_change` event.
+        """
+        entry = self._entry(user)
+        with self._lock:
+            directory = self._workspaces.get(workspace_id)
+            if directory:
+                previous = directory['users'].get(user['id'])
+                if previous and directory['names'].get(previous[0]) == user['id']:
+                    del directory['names'][previous[0]]
+                directory['users'][user['id']] = entry
+                directory['names'][entry[0]] = user['id']
+
+        db.get_database()[USERS_COLLECTION].replace_one(
+            {"_id": f"{workspace_id}:{user['id']}"},
+            self._document(workspace_id, user['id'], entry),
+            upsert=True)
+
+    def _get(self, workspace_id):
+        directory = self._workspaces.get(workspace_id)
+        if directory:
+            return directory
+
+        with self._lock:
+            loading = self._loading.setdefault(workspace_id, threading.Lock())
+        with loading:
+            directory = self._workspaces.get(workspace_id)
+            if directory:
+                return directory
+
+            snapshot = self._snapshot(workspace_id)
+            if snapshot:
+                directory = self._load(workspace_id)
+                age = (datetime.datetime.utcnow() - snapshot['built']).total_seconds()
+                if age > settings.KARMA_DIRECTORY_REFRESH:
+                    app = current_app._get_current_object()
+                    threading.Thread(target=self._crawl_in_background, args=(app, workspace_id, snapshot['built']),
+                                     name="karmabot-user-directory-refresh", daemon=True).start()
+            else:
+                directory = self._crawl_once(workspace_id, None)
+                if directory is None:
+                    # Another process's crawl failed; the next lookup tries again
+                    directory = {"names": {}, "users": {}}
+            return directory
+
+    @staticmethod
+    def _snapshot(workspace_id):
+        return db.get_database()[DIRECTORIES_COLLECTION].find_one({"_id": workspace_id})
+
+    def _crawl_once(self, workspace_id, built):
+        """
+            Crawl the workspace, unless another process is crawling it already.
+            Then wait for that crawl to store a snapshot newer than `built` and
+            load it.
+
+            Returns:
+                (dict) the directory, or None if the other process's crawl
+                didn't store a snapshot
+        """
+        lease = Lease(f"directory:{workspace_id}", CRAWL_LEASE)
+        waited = False
+        while True:
+            snapshot = self._snapshot(workspace_id)
+            if snapshot and (built is None or snapshot['built'] > built):
+                return self._load(workspace_id)
+            if lease.acquire():
+                break
+            waited = True
+            time.sleep(CRAWL_POLL)
+
+        try:
+            if waited:
+                # The crawl we waited for ended without a snapshot
+                return None
+            with renewing(lease):
+                return self.crawl(workspace_id)
+        finally:
+            lease.release()
+
+    def _load(self, workspace_id):
+        directory = {"names": {}, "users": {}}
+        for r in db.get_database()[USERS_COLLECTION].find({"workspace": workspace_id}):
+            entry = (r['name'],) + tuple(r.get(f, False) for f in USER_FLAGS)
+            directory['users'][r['id']] = entry
+            directory['names'][r['name']] = r['id']
+
+        with self._lock:
+            self._workspaces[workspace_id] = directory
+        return directory
+
+    def _crawl_in_background(self, app, workspace_id, built):
+        with app.app_context():
+            try:
+                self._crawl_once(workspace_id, built)
+            except Exception as ex:
+                app.logger.warning(f"Unable to refresh the user directory for {workspace_id}: {ex}")
+
+    def crawl(self, workspace_id):
+        """
+            Page through `users.list`, replace the workspace's directory and
+            snapshot with the result, and return the directory.  An incomplete
+            crawl is returned but not kept.
+        """
+        ts = time.time()
+        built = datetime.datetime.utcnow()
+        collection = db.get_database()[USERS_COLLECTION]
+        directory = {"names": {}, "users": {}}
+
+        cursor = ""
+        seen = set()
+        complete = False
+        while True:
+            r = slack_client.get_users(workspace_id, cursor)
+            if not r or not r['ok']:
+                current_app.logger.warning(f"Unable to list users for {workspace_id}")
+                break
+
+            requests = []
+            for user in r['members']:
+                entry = self._entry(user)
+                directory['users'][user['id']] = entry
+                directory['names'][entry[0]] = user['id']
+                requests.append(ReplaceOne({"_id": f"{workspace_id}:{user['id']}"},
+                                           dict(self._document(workspace_id, user['id'], entry), built=built),
+                                           upsert=True))
+            if requests:
+                collection.bulk_write(requests, ordered=False)
+
+            seen.add(cursor)
+            cursor = r.get('response_metadata', {}).get('next_cursor')
+            if not cursor or cursor in seen:
+                complete = True
+                break
+
+        if complete:
+            # Users that weren't listed this time are gone
+            collection.delete_many({"workspace": workspace_id, "built": {"$lt": built}})
+            db.get_database()[DIRECTORIES_COLLECTION].replace_one(
+                {"_id": workspace_id}, {"built": built, "users": len(directory['users'])}, upsert=True)
+            with self._lock:
+                self._workspaces[workspace_id] = directory
+
+        log_metrics('karmabot_user_directory', {'workspace': workspace_id}, 'users', len(directory['users']))
+        log_metrics('karmabot_user_directory', {'workspace': workspace_id}, 'time_elapsed', int((time.time() - ts) * 1000))
+        return directory
+
+    @staticmethod
+    def _entry(user):
+        return (user['name'],) + tuple(user.get(f, False) for f in USER_FLAGS)
+
+    @staticmethod
+    def _document(workspace_id, user_id, entry):
+        doc = {"workspace": workspace_id, "id": user_id, "name": entry[0]}
+        doc.update(zip(USER_FLAGS, entry[1:]))
+        return doc
+
+    @staticmethod
+    def _user(user_id, entry):
+        user = {"id": user_id, "name": entry[0]}
+        user.update(zip(USER_FLAGS, entry[1:]))
+        return user
+
+
+directory = UserDirectory()
@@ -0,0 +1,213 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Declares the indexes every query in karmabot depends on, and makes sure they exist.
+"""
+
+import datetime
+import threading
+
+from flask import current_app
+from pymongo import ASCENDING, IndexModel
+
+from karmabot import db
+from karmabot import settings
+from karmabot.badgemap import BADGE_INFO_COLLECTION, BADGES_COLLECTION
+from karmabot.directory import USERS_COLLECTION
+from karmabot.controller.rollups import ROLLUPS
+from karmabot.controller.totals import COUNTERS, GIFTER_TOTALS_COLLECTION, TOTALS_COLLECTION, TYPE_TOTALS_COLLECTION
+from karmabot.ratelimit import RATELIMIT_COLLECTION
+
+# Indexes on every workspace collection
+WORKSPACE_INDEXES = [
+    # get_subject_stats
+    IndexModel([("type", ASCENDING), ("subject", ASCENDING)]),
+    # rate limiter seeding, get_top_karma for a gifter
+    IndexModel([("gifter", ASCENDING), ("date", ASCENDING)]),
+]
+
+# The index on `expires`: a plain one for the expiry sweeper, or a TTL index
+# that expires karma when the sweeper is off
+EXPIRES_INDEX = IndexModel([("expires", ASCENDING)])
+EXPIRES_TTL_INDEX = IndexModel([("expires", ASCENDING)], expireAfterSeconds=0)
+
+# Indexes on the collections shared by all workspaces
+SHARED_INDEXES = {
+    name: [IndexModel([("workspace", ASCENDING)] + [(f, ASCENDING) for f in fields], unique=True)]
+    for name, fields in COUNTERS.items()
+}
+for name, (fields, size) in ROLLUPS.items():
+    SHARED_INDEXES[name] = [
+        IndexModel([("workspace", ASCENDING)] + [(f, ASCENDING) for f in fields] + [("bucket", ASCENDING)], unique=True),
+        IndexModel([("expires", ASCENDING)], expireAfterSeconds=0)
+    ]
+    if "subject" in fields:
+        # get_top with a time window
+        SHARED_INDEXES[name].append(IndexModel([("workspace", ASCENDING), ("bucket", ASCENDING)]))
+SHARED_INDEXES[BADGES_COLLECTION] = [
+    # get_badges
+    IndexModel([("workspace", ASCENDING), ("subject", ASCENDING)]),
+    # get_badge_users, get_top_badges
+    IndexModel([("workspace", ASCENDING), ("badge", ASCENDING)]),
+]
+# get_badge_info, cmd_badge_list
+SHARED_INDEXES[BADGE_INFO_COLLECTION] = [IndexModel([("workspace", ASCENDING), ("badge", ASCENDING)])]
+# loading a user directory
+SHARED_INDEXES[USERS_COLLECTION] = [IndexModel([("workspace", ASCENDING)])]
+# Rate limit counters are only needed until their window has passed
+SHARED_INDEXES[RATELIMIT_COLLECTION] = [IndexModel([("expires", ASCENDING)], expireAfterSeconds=0)]
+
+
+class QueryPlanError(Exception):
+    """
+        Raised when a query the controllers depend on would scan a whole collection.
+    """
+
+
+def query_shapes(workspace_id):
+    """
+        Every query shape the controllers run, as (name, collection, filter).
+        Aggregations are listed by their leading `$match`.
+    """
+    now = datetime.datetime.utcnow()
+    return [
+        ("get_karma", TOTALS_COLLECTION, {"workspace": workspace_id, "type": "user", "subject": "U0"}),
+        ("get_totals", TOTALS_COLLECTION,
+         {"workspace": workspace_id, "$or": [{"type": "user", "subject": "U0"}, {"type": "thing", "subject": "thing"}]}),
+        ("get_top_subjects", TOTALS_COLLECTION, {"workspace": workspace_id, "type": "user", "subject": {"$in": ["U0", "U1"]}}),
+        ("get_stats", TYPE_TOTALS_COLLECTION, {"workspace": workspace_id}),
+        ("get_stats", GIFTER_TOTALS_COLLECTION, {"workspace": workspace_id}),
+        ("get_stats", TOTALS_COLLECTION, {"workspace": workspace_id}),
+        ("get_rollup_subject", "karma_rollup_subject_daily",
+         {"workspace": workspace_id, "type": "thing", "subject": "thing", "bucket": {"$gte": now}}),
+        ("get_rollup_gifter", "karma_rollup_gifter_daily", {"workspace": workspace_id, "gifter": "U0", "bucket": {"$gte": now}}),
+        ("get_rollup_top", "karma_rollup_subject_hourly", {"workspace": workspace_id, "bucket": {"$gte": now}}),
+        ("get_rollup_stats", "karma_rollup_gifter_daily", {"workspace": workspace_id, "bucket": {"$gte": now}}),
+        ("load_user_directory", USERS_COLLECTION, {"workspace": workspace_id}),
+        ("ratelimit_seed", workspace_id, {"gifter": "U0", "date": {"$gt": now}}),
+        ("get_badges", BADGES_COLLECTION, {"workspace": workspace_id}),
+        ("get_badge_users", BADGES_COLLECTION, {"workspace": workspace_id, "badge": ":badge:"}),
+        ("get_badge_info", BADGE_INFO_COLLECTION, {"workspace": workspace_id, "badge": ":badge:"}),
+        ("get_subject_stats", workspace_id, {"type": "thing", "subject": "thing"}),
+        ("get_top_karma", workspace_id, {"gifter": "U0", "type": "thing"}),
+        ("expiry_sweep", workspace_id, {"expires": {"$lte": now}}),
+    ]
+
+
+class IndexManager(object):
+
+    def __init__(self):
+        self._ready = set()
+        self._lock = threading.Lock()
+
+    def start(self, app):
+        """
+            Ensure indexes in the background, so a large index build doesn't
+            hold up startup.
+        """
+        def run():
+            with app.app_context():
+                try:
+                    self.ensure_all()
+                except Exception as ex:
+                    app.logger.warning(f"Unable to ensure indexes: {ex}")
+
+        threading.Thread(target=run, name="karmabot-index-manager", daemon=True).start()
+
+    def ensure_all(self):
+        mongodb = db.get_database()
+        self.ensure_shared()
+        for workspace_id in db.workspace_ids(mongodb):
+            self.ensure_workspace(workspace_id)
+
+    def ensure_shared(self):
+        mongodb = db.get_database()
+        for name, indexes in SHARED_INDEXES.items():
+            if name not in self._ready:
+                mongodb[name].create_indexes(indexes)
+                self._ready.add(name)
+
+    def ensure_workspace(self, workspace_id):
+        """
+            Create any missing indexes for a workspace.  Cheap once a workspace
+            has been seen by this process.
+        """
+        if workspace_id in self._ready:
+            return
+
+        with self._lock:
+            if workspace_id in self._ready:
+                return
+            collection = db.get_database()[workspace_id]
+            self._ensure_expires_index(collection)
+            collection.create_indexes(WORKSPACE_INDEXES)
+            self._ready.add(workspace_id)
+            current_app.logger.info(f"Ensured indexes for workspace {workspace_id}")
+
+    @staticmethod
+    def _ensure_expires_index(collection):
+        """
+            Where the expiry sweeper runs it owns expiration, so a TTL index on
+            `expires` (as the README used to recommend) is replaced with a
+            plain one.  Without the sweeper, whatever index is there is kept,
+            and a workspace without one gets a TTL index, so karma still
+            expires.
+        """
+        existing = {name: index for name, index in collection.index_information().items()
+                    if index['key'] == [("expires", 1)]}
+        if not settings.KARMA_SWEEPER:
+            if not existing:
+                collection.create_indexes([EXPIRES_TTL_INDEX])
+            return
+
+        for name, index in existing.items():
+            if 'expireAfterSeconds' in index:
+                current_app.logger.warning(f"Dropping TTL index {name} on {collection.name}")
+                collection.drop_index(name)
+        collection.create_indexes([EXPIRES_INDEX])
+
+    def verify(self, workspace_ids=None):
+        """
+            Explain every query shape against each workspace, and raise
+            QueryPlanError if any of them would do a collection scan.
+        """
+        mongodb = db.get_database()
+        if workspace_ids is None:
+            workspace_ids = db.workspace_ids(mongodb)
+
+        failures = []
+        for workspace_id in workspace_ids:
+            for name, collection, query in query_shapes(workspace_id):
+                plan = mongodb[collection].find(query).explain()
+                if 'COLLSCAN' in _plan_stages(plan['queryPlanner']['winningPlan']):
+                    failures.append(f"{name} on {collection}")
+
+        if failures:
+            raise QueryPlanError(f"Queries fall back to COLLSCAN: {', '.join(failures)}")
+        current_app.logger.info(f"Verified query plans for {len(workspace_ids)} workspaces")
+
+
+def _plan_stages(plan):
+    stages = [plan.get('stage')]
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages.extend(_plan_stages(plan[key]))
+    for key in ('inputStages', 'shards'):
+        for p in plan.get(key, []):
+            stages.extend(_plan_stages(p.get('winningPlan', p)))
+    return stages
+
+
+index_manager = IndexManager()
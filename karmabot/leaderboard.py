@@ -0,0 +1,216 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  In-process top/bottom karma standings, so `/karma top` doesn't touch the database.
+"""
+
+import heapq
+import threading
+import time
+from itertools import islice
+
+from flask import current_app
+
+from karmabot import db
+from karmabot import settings
+from karmabot.controller.totals import KARMA_TYPES, TOTALS_COLLECTION, counters_built
+from karmabot.metrics import log_metrics
+
+# Stale heap entries tolerated on top of one per subject before the heaps are rebuilt
+COMPACT_SLACK = 1000
+
+
+class Leaderboard(object):
+    """
+        The subjects of one type in one workspace, ordered by total.
+
+        Totals live in a dict, with a min-heap and a max-heap of
+        (total, subject) on the side so a change costs O(log n).  An entry
+        is left in the heaps when its subject's total changes and skipped
+        when it reaches the top; the heaps are rebuilt once they are more
+        than half stale.
+    """
+
+    def __init__(self, entries=()):
+        # subject -> [total, ops]
+        self._subjects = {}
+        for subject, total, ops in entries:
+            self._subjects[subject] = [total, ops]
+        self._rebuild_heaps()
+
+    def __len__(self):
+        return len(self._subjects)
+
+    def apply(self, subject, total, ops):
+        """
+            Add `total` karma and `ops` operations to a subject.  A subject is
+            dropped once it has no operations left.
+        """
+        current = self._subjects.get(subject)
+        if not current:
+            current = self._subjects[subject] = [0, 0]
+
+        current[0] += total
+        current[1] += ops
+        if current[1] <= 0:
+            del self._subjects[subject]
+        else:
+            heapq.heappush(self._lowest, (current[0], subject))
+            heapq.heappush(self._highest, (-current[0], subject))
+
+        if max(len(self._lowest), len(self._highest)) > 2 * len(self._subjects) + COMPACT_SLACK:
+            self._rebuild_heaps()
+
+    def top(self, limit):
+        return [(-total, subject) for total, subject in self._peek(self._highest, -1, limit)]
+
+    def bottom(self, limit):
+        return self._peek(self._lowest, 1, limit)
+
+    def _peek(self, heap, sign, limit):
+        """
+            The first `limit` current entries of `heap`.  Stale entries are
+            popped for good, current ones are pushed back.
+        """
+        found = []
+        seen = set()
+        while heap and len(found) < limit:
+            total, subject = heapq.heappop(heap)
+            current = self._subjects.get(subject)
+            if current and current[0] * sign == total and subject not in seen:
+                seen.add(subject)
+                found.append((total, subject))
+        for entry in found:
+            heapq.heappush(heap, entry)
+        return found
+
+    def _rebuild_heaps(self):
+        self._lowest = [(total, subject) for subject, (total, ops) in self._subjects.items()]
+        self._highest = [(-total, subject) for total, subject in self._lowest]
+        heapq.heapify(self._lowest)
+        heapq.heapify(self._highest)
+
+
+class LeaderboardIndex(object):
+    """
+        Leaderboards per workspace and type.
+
+        Loaded from the karma totals the first time a workspace is asked for,
+        then kept up to date by the totals as karma is given and expires.  Other
+        processes update their own copies, so each workspace is reloaded after
+        KARMA_LEADERBOARD_REFRESH seconds to pick up their changes.  The reload
+        runs in the background, and the standings it replaces are served
+        until it is done.
+    """
+
+    def __init__(self):
+        # workspace_id -> (loaded timestamp, {ktype: Leaderboard})
+        self._workspaces = {}
+        # workspace_ids being reloaded in the background
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def load(self, workspace_id):
+        ts = time.time()
+        entries = {ktype: [] for ktype in KARMA_TYPES}
+        mongodb = db.get_database()
+        if counters_built(workspace_id):
+            results = mongodb[TOTALS_COLLECTION].find({"workspace": workspace_id},
+                                                      {"_id": 0, "type": 1, "subject": 1, "total": 1, "ops": 1})
+        else:
+            results = mongodb[workspace_id].aggregate([
+                {"$match": {"type": {"$in": KARMA_TYPES}}},
+                {"$group": {"_id": {"type": "$type", "subject": "$subject"},
+                            "total": {"$sum": "$quantity"}, "ops": {"$sum": 1}}},
+                {"$project": {"_id": 0, "type": "$_id.type", "subject": "$_id.subject", "total": 1, "ops": 1}}
+            ], allowDiskUse=True)
+        for r in results:
+            if r['type'] in entries:
+                entries[r['type']].append((r['subject'], r['total'], r['ops']))
+        boards = {ktype: Leaderboard(e) for ktype, e in entries.items()}
+        elapsed = time.time() - ts
+
+        with self._lock:
+            self._workspaces[workspace_id] = (ts, boards)
+
+        log_metrics('karmabot_leaderboard', {'workspace': workspace_id}, 'subjects', sum(len(b) for b in boards.values()))
+        log_metrics('karmabot_leaderboard', {'workspace': workspace_id}, 'time_elapsed', int(elapsed * 1000))
+        return boards
+
+    def refresh(self, workspace_id):
+        """
+            Reload a workspace on a background thread, unless that is already
+            under way.
+        """
+        with self._lock:
+            if workspace_id in self._refreshing:
+                return
+            self._refreshing.add(workspace_id)
+        app = current_app._get_current_object()
+        threading.Thread(target=self._refresh_in_background, args=(app, workspace_id),
+                         name="karmabot-leaderboard-refresh", daemon=True).start()
+
+    def _refresh_in_background(self, app, workspace_id):
+        with app.app_context():
+            try:
+                self.load(workspace_id)
+            except Exception as ex:
+                app.logger.warning(f"Unable to refresh the leaderboards for {workspace_id}: {ex}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(workspace_id)
+
+    def invalidate(self, workspace_id):
+        with self._lock:
+            self._workspaces.pop(workspace_id, None)
+
+    def apply(self, workspace_id, ktype, subject, total, ops):
+        """
+            Update a loaded leaderboard; workspaces that aren't loaded yet will
+            see the change when they are.
+        """
+        with self._lock:
+            loaded = self._workspaces.get(workspace_id)
+            if loaded and ktype in loaded[1]:
+                loaded[1][ktype].apply(subject, total, ops)
+
+    def standings(self, workspace_id, ktype=None, direction=-1, limit=10):
+        """
+            Returns:
+                (list) [(ktype, subject, total)] with the highest totals first when
+                `direction` is -1, or the lowest first when it is 1
+        """
+        loaded = self._workspaces.get(workspace_id)
+        if not loaded:
+            boards = self.load(workspace_id)
+        else:
+            if loaded[0] + settings.KARMA_LEADERBOARD_REFRESH < time.time():
+                self.refresh(workspace_id)
+            boards = loaded[1]
+
+        if ktype:
+            boards = {ktype: boards[ktype]} if ktype in boards else {}
+
+        with self._lock:
+            if direction == -1:
+                ranked = [[(total, t, subject) for total, subject in b.top(limit)] for t, b in boards.items()]
+            else:
+                ranked = [[(total, t, subject) for total, subject in b.bottom(limit)] for t, b in boards.items()]
+
+        merged = heapq.merge(*ranked, key=lambda e: e[0], reverse=(direction == -1))
+        return [(t, subject, total) for total, t, subject in islice(merged, limit)]
+
+
+leaderboards = LeaderboardIndex()
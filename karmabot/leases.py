@@ -0,0 +1,106 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Leases in MongoDB, so only one Karmabot process at a time does a piece of
+  background work.
+"""
+
+import datetime
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import current_app
+from pymongo.errors import DuplicateKeyError
+
+from karmabot import db
+
+LOCKS_COLLECTION = "karma_locks"
+
+
+class Lease(object):
+    """
+        A document in LOCKS_COLLECTION that lapses `ttl` seconds after it was
+        last taken, so a process that dies doesn't hold it for good.  Taking
+        it again before then renews it.
+
+        `held` turns False a third of the `ttl` before the lease could lapse,
+        so the holder stops before anyone else can take over.
+    """
+
+    def __init__(self, name, ttl, owner=None):
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._until = 0
+
+    @property
+    def held(self):
+        return time.monotonic() < self._until
+
+    def acquire(self):
+        """
+            Returns:
+                (bool) whether this process holds the lease now
+        """
+        ts = time.monotonic()
+        now = datetime.datetime.utcnow()
+        try:
+            db.get_database()[LOCKS_COLLECTION].find_one_and_update(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires": now + datetime.timedelta(seconds=self.ttl)}},
+                upsert=True)
+        except DuplicateKeyError:
+            self._until = 0
+            return False
+        self._until = ts + self.ttl * 2 / 3
+        return True
+
+    def release(self):
+        self._until = 0
+        db.get_database()[LOCKS_COLLECTION].delete_one({"_id": self.name, "owner": self.owner})
+
+
+@contextmanager
+def renewing(*leases):
+    """
+        Renew some leases from a background thread for the duration of the
+        block, every third of their `ttl`.  A lease that is lost isn't
+        renewed again.
+    """
+    app = current_app._get_current_object()
+    done = threading.Event()
+
+    def renew():
+        with app.app_context():
+            while not done.wait(min(lease.ttl for lease in leases) / 3):
+                for lease in leases:
+                    if not lease.held:
+                        continue
+                    try:
+                        if not lease.acquire():
+                            app.logger.warning(f"Lost the lease {lease.name}")
+                    except Exception as ex:
+                        app.logger.warning(f"Unable to renew the lease {lease.name}: {ex}")
+
+    if leases:
+        threading.Thread(target=renew, name="karmabot-lease-renewal", daemon=True).start()
+    try:
+        yield
+    finally:
+        done.set()
@@ -12,9 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import deque
 from functools import wraps
 from urllib.parse import urlparse
 from influxdb.line_protocol import make_lines
+import atexit
+import math
+import threading
 import time
 import socket
 import os
@@ -22,6 +26,19 @@ import os
 METRICS_URI = os.environ.get('METRICS_URI', 'tcp://localhost:8094')
 METRICS_HOST = urlparse(METRICS_URI).hostname
 METRICS_PORT = urlparse(METRICS_URI).port
+METRICS_BUFFER_SIZE = int(os.environ.get('METRICS_BUFFER_SIZE', 10000))
+METRICS_BATCH_SIZE = int(os.environ.get('METRICS_BATCH_SIZE', 500))
+METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 1000))
+METRICS_HISTOGRAM_INTERVAL = int(os.environ.get('METRICS_HISTOGRAM_INTERVAL', 10000))
+
+# Keep UDP datagrams under a typical MTU
+UDP_PAYLOAD = 1400
+SEND_TIMEOUT = 5
+
+# Histogram buckets: values below 2**SUB_BUCKET_BITS are exact, above that
+# each power of two is split into 2**(SUB_BUCKET_BITS - 1) buckets (< 1% error)
+SUB_BUCKET_BITS = 7
+PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
 
 
 class timeit(object):
@@ -34,33 +51,296 @@ class timeit(object):
 
         @wraps(f)
         def timed(*args, **kwargs):
-            ts = time.time()
-            result = f(*args, **kwargs)
-            te = time.time()
-            value = int((te - ts) * 1000)
-            log_metrics(self.measurement, self.tags, self.field, value)
-
-            return result
+            ts = time.perf_counter_ns()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                log_histogram(self.measurement, self.tags, self.field, time.perf_counter_ns() - ts)
         return timed
 
 
-def _get_connection():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((METRICS_HOST, METRICS_PORT))
-    return s
+class Histogram(object):
+    """
+        An HDR-style histogram of non-negative integers, with log-linear
+        buckets so percentiles are within 1% whatever the magnitude.
+    """
+
+    def __init__(self):
+        # bucket index -> count
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        value = max(0, int(value))
+        index = self._index(value)
+        with self._lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        target = max(1, int(math.ceil(q * self.count)))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= target:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    def fields(self, field):
+        fields = {f"{field}_count": self.count, f"{field}_sum": self.sum,
+                  f"{field}_min": self.min, f"{field}_max": self.max}
+        for name, q in PERCENTILES:
+            fields[f"{field}_{name}"] = self.percentile(q)
+        return fields
+
+    @staticmethod
+    def _index(value):
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        half = 1 << (SUB_BUCKET_BITS - 1)
+        return shift * half + (value >> shift)
+
+    @staticmethod
+    def _value(index):
+        """
+            The middle of the range of values that land in bucket `index`
+        """
+        half = 1 << (SUB_BUCKET_BITS - 1)
+        if index < 2 * half:
+            return index
+        shift = index // half - 1
+        return ((index - shift * half) << shift) + (1 << shift) // 2
+
+
+class Histograms(object):
+    """
+        Histograms keyed by (measurement, tags, field).  `points()` hands
+        back a point per histogram and starts the next interval afresh.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, measurement, tags, field, value):
+        key = (measurement, tuple(sorted(tags.items())) if tags else (), field)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.record(value)
+
+    def points(self):
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+        points = []
+        for (measurement, tags, field), histogram in histograms.items():
+            # Let a record() that raced the swap finish
+            with histogram._lock:
+                points.append({
+                    'measurement': measurement,
+                    'tags': dict(tags) or None,
+                    'fields': histogram.fields(field),
+                    'time': time.time_ns()
+                })
+        return points
+
+    def clear(self):
+        with self._lock:
+            self._histograms = {}
+
+
+class Emitter(object):
+    """
+        Buffers points in memory and sends them to Telegraf from a background
+        thread, in batches of up to `batch_size` lines over one persistent
+        connection (TCP, or UDP for a `udp://` METRICS_URI).
+
+        The buffer is flushed every `flush_interval` milliseconds, or as soon
+        as a batch is ready, and `histograms` are added to it every
+        `histogram_interval` milliseconds.  Once `buffer_size` points are waiting, new ones
+        are dropped, and so are batches Telegraf couldn't be reached for.
+        Drops are reported as `karmabot_metrics dropped`.
+    """
+
+    def __init__(self, uri, buffer_size, batch_size, flush_interval, histogram_interval):
+        parts = urlparse(uri)
+        self.udp = parts.scheme == 'udp'
+        self.address = (parts.hostname, parts.port)
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval / 1000
+        self.histogram_interval = histogram_interval / 1000
+        self.histograms = Histograms()
+        self.dropped = 0
+        # deque appends and pops are atomic, so emitting doesn't take a lock
+        self._points = deque()
+        self._wake = threading.Event()
+        self._sock = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def emit(self, point):
+        self.ensure_started()
+        if len(self._points) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self._points.append(point)
+        if len(self._points) >= self.batch_size and not self._wake.is_set():
+            self._wake.set()
+
+    def flush(self, timeout=None):
+        """
+            Send everything that is buffered, stopping early if Telegraf can't
+            be reached.  Returns False if another flush held things up for
+            longer than `timeout` seconds.
+        """
+        if not self._flush_lock.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        try:
+            dropped, self.dropped = self.dropped, 0
+            while True:
+                lines = []
+                while len(lines) < self.batch_size:
+                    try:
+                        point = self._points.popleft()
+                    except IndexError:
+                        break
+                    line = self._line(point)
+                    if line:
+                        lines.append(line)
+                if not lines and not dropped:
+                    break
+                report = [self._line({'measurement': 'karmabot_metrics', 'fields': {'dropped': dropped}})] if dropped else []
+                if not self._send(report + lines):
+                    self.dropped += dropped + len(lines)
+                    break
+                dropped = 0
+        finally:
+            self._flush_lock.release()
+        return True
+
+    def close(self, timeout=SEND_TIMEOUT):
+        if self._pid == os.getpid():
+            self._emit_histograms()
+            self.flush(timeout)
+
+    def ensure_started(self):
+        if self._pid != os.getpid():
+            self._start()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # After a fork, the parent still owns whatever it had buffered
+            self._points.clear()
+            self.histograms.clear()
+            self._sock = None
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="karmabot-metrics", daemon=True).start()
+
+    def _run(self):
+        next_histograms = time.monotonic() + self.histogram_interval
+        while True:
+            self._wake.wait(min(self.flush_interval, max(0, next_histograms - time.monotonic())))
+            self._wake.clear()
+            if time.monotonic() >= next_histograms:
+                next_histograms += self.histogram_interval
+                self._emit_histograms()
+            self.flush()
+
+    def _emit_histograms(self):
+        for point in self.histograms.points():
+            self.emit(point)
+
+    def _line(self, point):
+        try:
+            return make_lines({'points': [point]}, None)
+        except Exception:
+            self.dropped += 1
+            return None
+
+    def _send(self, batch):
+        """
+            Returns:
+                (bool) whether the batch was sent
+        """
+        for attempt in range(2):
+            try:
+                if not self._sock:
+                    self._sock = self._connect()
+                if self.udp:
+                    for payload in self._datagrams(batch):
+                        self._sock.sendto(payload, self.address)
+                else:
+                    self._sock.sendall(''.join(batch).encode())
+                return True
+            except OSError:
+                # Telegraf may have closed an idle connection, so reconnect once
+                self._close_socket()
+        return False
+
+    def _connect(self):
+        if self.udp:
+            return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s = socket.create_connection(self.address, timeout=SEND_TIMEOUT)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return s
+
+    def _close_socket(self):
+        if self._sock:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+
+    @staticmethod
+    def _datagrams(batch):
+        payload = b''
+        for line in batch:
+            line = line.encode()
+            if payload and len(payload) + len(line) > UDP_PAYLOAD:
+                yield payload
+                payload = b''
+            payload += line
+        if payload:
+            yield payload
+
+
+emitter = Emitter(METRICS_URI, METRICS_BUFFER_SIZE, METRICS_BATCH_SIZE, METRICS_FLUSH_INTERVAL,
+                  METRICS_HISTOGRAM_INTERVAL)
+atexit.register(emitter.close)
 
 
 def log_metrics(measurement, tags, field, value):
-    json_body = {'points': [
-        {
-            'measurement': measurement,
-            'tags': tags,
-            'fields': {
-                field: value
-            }
-        }
-    ]}
-    output = make_lines(json_body, None)
-    s = _get_connection()
-    s.send(output.encode())
-    s.close()
+    emitter.emit({
+        'measurement': measurement,
+        'tags': tags,
+        'fields': {
+            field: value
+        },
+        'time': time.time_ns()
+    })
+
+
+def log_histogram(measurement, tags, field, value):
+    """
+        Record `value` (e.g. a latency in nanoseconds) in a histogram that is
+        sent as count, sum, min, max and percentiles every
+        METRICS_HISTOGRAM_INTERVAL milliseconds, rather than as a point of its own.
+    """
+    emitter.ensure_started()
+    emitter.histograms.record(measurement, tags, field, value)
@@ -0,0 +1,59 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Prometheus metrics, served on /metrics.
+
+  Under gunicorn, PROMETHEUS_MULTIPROC_DIR must be set before karmabot is
+  imported (gunicorn.conf.py does this).  Each worker then writes its samples
+  to memory-mapped files in that directory, and whichever worker answers a
+  scrape adds them all up, without touching any other worker.
+"""
+
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import generate_latest, multiprocess
+
+# Mongo commands mostly take (well) under a millisecond
+MONGO_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0)
+
+events = Counter('karmabot_events', 'Slack events received', ['type'])
+commands = Counter('karmabot_commands', 'Slash commands received', ['command'])
+interactions = Counter('karmabot_interactions', 'Interactions received', ['type'])
+request_time = Histogram('karmabot_request_duration_seconds', 'Time taken to answer Slack', ['endpoint'])
+executor_queue = Gauge('karmabot_executor_queue_depth', 'Tasks waiting for an executor thread',
+                       multiprocess_mode='livesum')
+mongo_time = Histogram('karmabot_mongo_command_duration_seconds', 'MongoDB command round trip time',
+                       ['command'], buckets=MONGO_BUCKETS)
+slack_time = Histogram('karmabot_slack_request_duration_seconds', 'Slack API call round trip time', ['method'])
+slack_throttled = Counter('karmabot_slack_throttled', 'Slack API calls answered with a 429', ['method'])
+cache_lookups = Counter('karmabot_cache_lookups', 'In-process cache lookups', ['cache', 'result'])
+
+
+def cache_lookup(cache, hit):
+    cache_lookups.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def exposition():
+    """
+        Returns:
+            (bytes, str) every metric in the text exposition format, and its content type
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,236 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Monitoring of every command karmabot sends to MongoDB, by query shape and
+  by the controller method that sent it, and a log of the slow ones.
+"""
+
+import json
+import queue
+import random
+import re
+import threading
+import time
+
+import bson
+from pymongo import monitoring
+
+from karmabot import prometheus
+from karmabot import settings
+from karmabot import tracing
+from karmabot.metrics import log_histogram, log_metrics
+
+# Commands whose first field names the collection, and where their filter is
+FILTERS = {
+    "find": lambda c: c.get("filter"),
+    "aggregate": lambda c: c.get("pipeline"),
+    "count": lambda c: c.get("query"),
+    "distinct": lambda c: {"key": c.get("key"), "query": c.get("query")},
+    "findAndModify": lambda c: c.get("query"),
+    "update": lambda c: [u.get("q") for u in c.get("updates", [])],
+    "delete": lambda c: [d.get("q") for d in c.get("deletes", [])],
+    "insert": lambda c: None,
+}
+EXPLAINABLE = ("find", "aggregate", "count", "distinct", "findAndModify", "update", "delete")
+
+# How long an explain summary is reused for other slow runs of the same shape, in seconds
+EXPLAIN_TTL = 600
+
+# Encoding a reply again to measure it costs as much as decoding it, so the
+# size is measured for this share of commands, and for every slow one
+REPLY_SIZE_SAMPLE = 0.01
+
+
+def normalize(value):
+    """
+        The shape of a query: its field names and operators, with every value
+        replaced by "?".  Lists of documents (e.g. `$or` or a pipeline) keep
+        one of each distinct shape, so they don't vary with their length.
+    """
+    if isinstance(value, dict):
+        return {k: normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)) and any(isinstance(v, dict) for v in value):
+        shapes = []
+        for v in value:
+            shape = normalize(v)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return "?"
+
+
+def collection_shape(name):
+    """
+        Workspace collections are all alike, so they share a shape.
+    """
+    if not isinstance(name, str):
+        return "?"
+    if name.startswith("karma_") or name.startswith("system."):
+        return name
+    return "<workspace>"
+
+
+def query_shape(command_name, command):
+    """
+        Returns:
+            (str, str) the command's collection and query shape
+    """
+    if command_name == "getMore":
+        return collection_shape(command.get("collection")), command_name
+    if command_name not in FILTERS:
+        return "?", command_name
+    collection = collection_shape(command.get(command_name))
+    query = FILTERS[command_name](command)
+    shape = json.dumps(normalize(query), sort_keys=True) if query is not None else ""
+    return collection, f"{command_name} {shape}".strip()
+
+
+def caller():
+    """
+        The innermost traced controller method, or for background work
+        (e.g. the sweeper) the name of the thread.
+    """
+    name = tracing.current_span()
+    if name:
+        return name
+    return re.sub(r'[-_\d]+$', '', threading.current_thread().name)
+
+
+def reply_docs(reply):
+    if 'cursor' in reply:
+        cursor = reply['cursor']
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    if 'values' in reply:
+        return len(reply['values'])
+    if 'value' in reply:
+        return 1 if reply['value'] else 0
+    return reply.get('n', 0)
+
+
+def plan_summary(plan):
+    """
+        The stages of a winning plan, innermost first, e.g. "IXSCAN(type_1_subject_1) > FETCH"
+    """
+    stages = []
+
+    def walk(p):
+        for key in ('inputStage', 'queryPlan'):
+            if key in p:
+                walk(p[key])
+        for p2 in p.get('inputStages', []):
+            walk(p2)
+        if 'stage' in p:
+            stages.append(f"{p['stage']}({p['indexName']})" if 'indexName' in p else p['stage'])
+    walk(plan)
+    return " > ".join(stages)
+
+
+class CommandListener(monitoring.CommandListener):
+    """
+        Records the duration and documents returned of every command, and
+        the reply size of a REPLY_SIZE_SAMPLE of them, as
+        `karmabot_mongo_command` histograms, tagged with the command,
+        collection, query shape and calling controller method.
+
+        Commands slower than KARMA_SLOW_QUERY milliseconds are logged with an
+        explain summary of their plan.  The explain runs later on a thread of
+        its own, once per shape every EXPLAIN_TTL seconds, so it doesn't slow
+        down the request that ran the query.
+    """
+
+    def __init__(self):
+        self.app = None
+        # request_id -> (collection, shape, caller, command name, command, database)
+        self._started = {}
+        self._slow = queue.Queue(maxsize=100)
+        # (collection, shape) -> (explained timestamp, plan summary)
+        self._explained = {}
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection, shape = query_shape(event.command_name, event.command)
+        command = event.command if event.command_name in EXPLAINABLE else None
+        self._started[event.request_id] = (collection, shape, caller(), event.command_name, command, event.database_name)
+
+    def succeeded(self, event):
+        self._finished(event, event.reply)
+
+    def failed(self, event):
+        self._finished(event, None)
+
+    def _finished(self, event, reply):
+        prometheus.mongo_time.labels(event.command_name).observe(event.duration_micros / 1000000)
+        started = self._started.pop(event.request_id, None)
+        if started is None:
+            return
+        collection, shape, called_by, command_name, command, database = started
+        tags = {'command': command_name, 'collection': collection, 'shape': shape, 'caller': called_by}
+        slow = event.duration_micros >= settings.KARMA_SLOW_QUERY * 1000
+        log_histogram('karmabot_mongo_command', tags, 'duration', event.duration_micros * 1000)
+        size = None
+        if reply is not None:
+            log_histogram('karmabot_mongo_command', tags, 'docs', reply_docs(reply))
+            if slow or random.random() < REPLY_SIZE_SAMPLE:
+                size = len(bson.encode(reply))
+                log_histogram('karmabot_mongo_command', tags, 'bytes', size)
+        else:
+            log_metrics('karmabot_mongo_command', tags, 'failed', 1)
+
+        if slow:
+            self._defer(dict(tags, duration_ms=event.duration_micros / 1000, bytes=size), command, database)
+
+    def _defer(self, slow, command, database):
+        if self.app is None:
+            return
+        try:
+            self._slow.put_nowait((slow, command, database))
+        except queue.Full:
+            return
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._log_slow, args=(self.app,),
+                                                    name="karmabot-slow-queries", daemon=True)
+                    self._worker.start()
+
+    def _log_slow(self, app):
+        # Imported here, as karmabot.db sets this listener up
+        from karmabot import db
+
+        with app.app_context():
+            while True:
+                slow, command, database = self._slow.get()
+                slow['plan'] = self._explain(db.get_client(), (slow['collection'], slow['shape']), command, database)
+                app.logger.warning(f"Slow MongoDB query: {json.dumps(slow, sort_keys=True)}")
+
+    def _explain(self, client, key, command, database):
+        if command is None:
+            return None
+        explained = self._explained.get(key)
+        if explained and explained[0] + EXPLAIN_TTL > time.time():
+            return explained[1]
+
+        command = {k: v for k, v in command.items() if k not in ('lsid', '$clusterTime', '$db', 'txnNumber')}
+        try:
+            plan = client[database].command('explain', command, verbosity='queryPlanner')
+            summary = plan_summary(plan.get('queryPlanner', {}).get('winningPlan', {}))
+        except Exception as ex:
+            summary = f"explain failed: {ex}"
+        self._explained[key] = (time.time(), summary)
+        return summary
+
+
+command_listener = CommandListener()
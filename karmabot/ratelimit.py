@@ -0,0 +1,134 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Karma rate limiting: only KARMA_RATE_LIMIT gifts per gifter per hour.
+"""
+
+import datetime
+import threading
+import time
+from collections import deque
+
+from pymongo import ReturnDocument
+
+from karmabot import db
+from karmabot import settings
+from karmabot.tracing import span
+
+RATELIMIT_COLLECTION = "karma_ratelimit"
+
+
+class RateLimiter(object):
+    """
+        Keeps a sliding window of gift timestamps per (workspace, gifter) in
+        memory.  A window is seeded from the stored karma operations the first
+        time a gifter is seen, after that no queries are needed.
+
+        Each process keeps its own windows, so with several workers a gifter
+        may get up to one limit per worker.  Set KARMA_RATE_LIMIT_SHARED to
+        count gifts in MongoDB instead, at the cost of one update per gift.
+    """
+
+    def __init__(self, window=3600):
+        self.window = window
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+        # (workspace, gifter, bucket) -> count, for the finished buckets in shared mode
+        self._previous = {}
+
+    @span()
+    def consume(self, workspace_id, gifter, tokens=1):
+        """
+            Take `tokens` gifts from the gifter's allowance.
+
+            Returns:
+                (bool) False if the gifter is over the limit, in which case nothing is taken
+        """
+        now = time.time()
+        if settings.KARMA_RATE_LIMIT_SHARED:
+            return self._consume_shared(workspace_id, gifter, tokens, now)
+
+        key = (workspace_id, gifter)
+        with self._lock:
+            window = self._windows.get(key)
+        if window is None:
+            seeded = self._seed(workspace_id, gifter, now)
+            with self._lock:
+                window = self._windows.setdefault(key, seeded)
+
+        with self._lock:
+            self._expire(window, now)
+            if len(window) + tokens > settings.KARMA_RATE_LIMIT:
+                return False
+            window.extend([now] * tokens)
+
+            self._calls += 1
+            if self._calls % 1000 == 0:
+                self._gc(now)
+        return True
+
+    def _seed(self, workspace_id, gifter, now):
+        since = datetime.datetime.utcfromtimestamp(now - self.window)
+        ops = db.get_database()[workspace_id].find(
+            {"gifter": gifter, "date": {"$gt": since}},
+            {"_id": 0, "date": 1}).sort("date", 1)
+        return deque(op['date'].replace(tzinfo=datetime.timezone.utc).timestamp() for op in ops)
+
+    def _expire(self, window, now):
+        cutoff = now - self.window
+        while window and window[0] <= cutoff:
+            window.popleft()
+
+    def _gc(self, now):
+        """
+            Forget gifters with nothing left in their window.
+        """
+        for key in [k for k, w in self._windows.items() if not w or w[-1] <= now - self.window]:
+            del self._windows[key]
+
+    def _consume_shared(self, workspace_id, gifter, tokens, now):
+        """
+            Approximates the sliding window with two fixed windows: all of the
+            current one, plus the part of the previous one that still overlaps.
+        """
+        collection = db.get_database()[RATELIMIT_COLLECTION]
+        bucket = int(now // self.window)
+        overlap = 1 - (now % self.window) / self.window
+
+        previous_key = (workspace_id, gifter, bucket - 1)
+        previous = self._previous.get(previous_key)
+        if previous is None:
+            r = collection.find_one({"_id": f"{workspace_id}:{gifter}:{bucket - 1}"})
+            previous = r['count'] if r else 0
+            with self._lock:
+                if len(self._previous) > 10000:
+                    self._previous.clear()
+                self._previous[previous_key] = previous
+
+        expires = datetime.datetime.utcfromtimestamp((bucket + 2) * self.window)
+        r = collection.find_one_and_update(
+            {"_id": f"{workspace_id}:{gifter}:{bucket}"},
+            {"$inc": {"count": tokens}, "$setOnInsert": {"expires": expires}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+
+        if previous * overlap + r['count'] > settings.KARMA_RATE_LIMIT:
+            collection.update_one({"_id": r['_id']}, {"$inc": {"count": -tokens}})
+            return False
+        return True
+
+
+limiter = RateLimiter()
@@ -41,6 +41,8 @@ code_block_re = re.compile(r'```.+?```', flags=re.DOTALL)
 pre_block_re = re.compile(r'`.+?`')
 # :emoji:
 emoji_re = re.compile(r'(?P<emoji>:[a-zA-Z_0-9]+:)')
+# last 7d, last 12h, last 2w, today, this week, this month
+window_re = re.compile(r'(?:^|\s+)(?:last\s+(?P<count>\d+)\s*(?P<unit>[hdw])|(?P<period>today|this\s+week|this\s+month))\s*$')
 
 big_match = r"(%s|%s|%s|%s|%s|%s|%s|%s|%s|%s)" % (
                     user_group_re.pattern,
@@ -57,3 +59,4 @@ big_match = r"(%s|%s|%s|%s|%s|%s|%s|%s|%s|%s)" % (
 big_match_karma_re = re.compile(r"%s%s" % (big_match, karma_re.pattern), re.UNICODE)
 
 big_match_re = re.compile(big_match, re.UNICODE)
+channel_members_re = re.compile(r'^\s*top\s+channel\s+members(?:\s+(?P<limit>\d+))?\s*$')
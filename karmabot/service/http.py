@@ -0,0 +1,216 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  The HTTP client shared by every Slack API call in the process.
+"""
+
+import http.client
+import json
+import os
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+from flask import current_app
+
+from karmabot.metrics import log_metrics
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+class Response(object):
+    """
+        The parts of a response the Slack service uses: `status`, `content`
+        and the decoded `json` body.
+    """
+
+    def __init__(self, status, headers, content):
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    @property
+    def json(self):
+        return json.loads(self.content)
+
+
+class HTTPClient(object):
+    """
+        Keeps up to `pool_size` idle keep-alive connections per host, so most
+        requests skip the TCP and TLS handshake.  A request that fails on a
+        reused connection (because the server closed it) is retried once on
+        a new one.
+
+        Connections idle for longer than `idle_timeout` seconds are closed
+        rather than reused.
+    """
+
+    def __init__(self, connect_timeout=5.0, read_timeout=10.0, pool_size=10, idle_timeout=60):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._context = ssl.create_default_context()
+        # (scheme, host, port) -> [(connection, last used)]
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers=headers)
+
+    def post(self, url, data=None, headers=None):
+        return self.request('POST', url, data=data, headers=headers)
+
+    def request(self, method, url, data=None, headers=None):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        for attempt in range(2):
+            conn, reused = self._checkout(key)
+            ts = time.perf_counter()
+            try:
+                conn.request(method, path, body=data, headers=headers or {})
+                r = conn.getresponse()
+                content = r.read()
+            except (ConnectionError, http.client.BadStatusLine):
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            elapsed = time.perf_counter() - ts
+
+            if r.will_close:
+                conn.close()
+            else:
+                self._checkin(key, conn)
+
+            log_metrics('karmabot_http', {'host': parts.hostname, 'reused': str(reused).lower()},
+                        'request_time_us', int(elapsed * 1000000))
+            return Response(r.status, {k.lower(): v for k, v in r.getheaders()}, content)
+
+    def _checkout(self, key):
+        """
+            Returns:
+                (tuple) (connection, whether it was reused)
+        """
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if last_used + self.idle_timeout > now:
+                    return conn, True
+                conn.close()
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.connect_timeout, context=self._context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.connect_timeout)
+
+        ts = time.perf_counter()
+        conn.connect()
+        log_metrics('karmabot_http', {'host': host}, 'handshake_time_us', int((time.perf_counter() - ts) * 1000000))
+        conn.sock.settimeout(self.read_timeout)
+        return conn, False
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, last_used in idle:
+                    conn.close()
+            self._idle = {}
+
+
+class HTTP2Client(object):
+    """
+        The same interface as HTTPClient, on top of httpx so requests to a host
+        are multiplexed over one HTTP/2 connection.
+    """
+
+    def __init__(self, connect_timeout=5.0, read_timeout=10.0, pool_size=10):
+        self._client = httpx.Client(http2=True,
+                                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                                    limits=httpx.Limits(max_keepalive_connections=pool_size))
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers=headers)
+
+    def post(self, url, data=None, headers=None):
+        return self.request('POST', url, data=data, headers=headers)
+
+    def request(self, method, url, data=None, headers=None):
+        ts = time.perf_counter()
+        r = self._client.request(method, url, content=data, headers=headers)
+        elapsed = time.perf_counter() - ts
+        log_metrics('karmabot_http', {'host': r.url.host, 'http_version': r.http_version},
+                    'request_time_us', int(elapsed * 1000000))
+        return Response(r.status_code, dict(r.headers), r.content)
+
+    def close(self):
+        self._client.close()
+
+
+def get_client():
+    """
+        Get the process-wide HTTP client, creating it on first use.  Like the
+        MongoClient, a forked process gets its own connections.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                config = current_app.config
+                connect_timeout = config.get('SLACK_CONNECT_TIMEOUT') / 1000
+                read_timeout = config.get('SLACK_READ_TIMEOUT') / 1000
+                pool_size = config.get('SLACK_POOL_SIZE')
+                if config.get('SLACK_HTTP2') and httpx is None:
+                    current_app.logger.warning("SLACK_HTTP2 is set but httpx is not installed, using HTTP/1.1")
+                if config.get('SLACK_HTTP2') and httpx is not None:
+                    _client = HTTP2Client(connect_timeout, read_timeout, pool_size)
+                else:
+                    _client = HTTPClient(connect_timeout, read_timeout, pool_size)
+                _client_pid = pid
+    return _client
@@ -0,0 +1,177 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Paces outbound Slack API calls to stay within Slack's rate limits, and
+  retries the ones Slack throttles anyway.
+"""
+
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from flask import current_app
+
+from karmabot import prometheus, settings
+from karmabot.metrics import log_metrics
+from karmabot.service import http
+from karmabot.tracing import span
+
+# Requests per minute for each of Slack's rate limit tiers
+TIERS = {
+    1: 1,
+    2: 20,
+    3: 50,
+    4: 100,
+}
+
+# The tier of every Web API method karmabot calls.  chat.postMessage isn't
+# tiered (roughly one message per second per channel), so it gets its own rate.
+METHOD_RATES = {
+    "auth.test": TIERS[4],
+    "channels.info": TIERS[3],
+    "channels.kick": TIERS[3],
+    "chat.postMessage": 60,
+    "conversations.members": TIERS[4],
+    "dialog.open": TIERS[4],
+    "im.open": TIERS[3],
+    "usergroups.list": TIERS[2],
+    "usergroups.users.list": TIERS[2],
+    "users.info": TIERS[4],
+    "users.list": TIERS[2],
+}
+DEFAULT_RATE = TIERS[3]
+
+
+class TokenBucket(object):
+    """
+        Allows `rate` requests per minute, in bursts of up to a tenth of that.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate / 60.0
+        self.capacity = max(1.0, rate / 10.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+            Take a token, going into debt if there are none left.
+
+            Returns:
+                (float) how many seconds to wait before using it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            wait = max(0.0, -self.tokens / self.rate, self.blocked_until - now)
+            if wait:
+                self.waiting += 1
+            return wait
+
+    def done_waiting(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def block(self, seconds):
+        """
+            Hold every request back for `seconds`, after a 429 from Slack.
+        """
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0)
+
+
+class Scheduler(object):
+    """
+        A token bucket per (workspace, API method) paces requests before they
+        are sent.  A 429 blocks the bucket for the `Retry-After` Slack asks
+        for, and the request is retried up to SLACK_MAX_RETRIES times with a
+        little jitter so waiting requests don't all retry at once.
+
+        Requests to anything other than the Web API (e.g. response_url
+        replies) aren't paced, but are still retried on a 429.
+    """
+
+    def __init__(self):
+        # (workspace, method) -> TokenBucket
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get(self, workspace, url, headers=None):
+        return self.request(workspace, 'GET', url, headers=headers)
+
+    def post(self, workspace, url, data=None, headers=None):
+        return self.request(workspace, 'POST', url, data=data, headers=headers)
+
+    def request(self, workspace, http_method, url, data=None, headers=None):
+        method = self._api_method(url)
+        bucket = self._bucket(workspace, method) if method else None
+        tags = {'method': method or 'other'}
+
+        for attempt in range(settings.SLACK_MAX_RETRIES + 1):
+            if bucket:
+                wait = bucket.reserve()
+                if wait:
+                    log_metrics('karmabot_slack_scheduler', tags, 'queue_depth', bucket.waiting)
+                    log_metrics('karmabot_slack_scheduler', tags, 'throttle_wait_ms', int(wait * 1000))
+                    with span('Scheduler.throttle_wait'):
+                        time.sleep(wait)
+                    bucket.done_waiting()
+
+            ts = time.perf_counter()
+            result = http.get_client().request(http_method, url, data=data, headers=headers)
+            prometheus.slack_time.labels(tags['method']).observe(time.perf_counter() - ts)
+            if result.status != 429:
+                return result
+
+            retry_after = float(result.headers.get('retry-after', 1))
+            log_metrics('karmabot_slack_scheduler', tags, 'throttled', 1)
+            prometheus.slack_throttled.labels(tags['method']).inc()
+            if bucket:
+                bucket.block(retry_after)
+            if attempt < settings.SLACK_MAX_RETRIES:
+                current_app.logger.info(f"Slack throttled {method or url}, retrying in {retry_after}s")
+                if not bucket:
+                    time.sleep(retry_after + random.uniform(0, 1))
+                else:
+                    time.sleep(random.uniform(0, 1))
+
+        current_app.logger.warning(f"Slack throttled {method or url} {settings.SLACK_MAX_RETRIES + 1} times, giving up")
+        return result
+
+    def _bucket(self, workspace, method):
+        key = (workspace, method)
+        bucket = self._buckets.get(key)
+        if not bucket:
+            with self._lock:
+                bucket = self._buckets.setdefault(key, TokenBucket(METHOD_RATES.get(method, DEFAULT_RATE)))
+        return bucket
+
+    @staticmethod
+    def _api_method(url):
+        parts = urlsplit(url)
+        if parts.hostname == "slack.com" and parts.path.startswith("/api/"):
+            return parts.path[len("/api/"):]
+        return None
+
+
+scheduler = Scheduler()
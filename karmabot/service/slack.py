@@ -13,10 +13,11 @@
 # limitations under the License.
 
 import json
-import urlfetch
 import karmabot
 from flask import current_app
 from karmabot import settings
+from karmabot.service.scheduler import scheduler
+from karmabot.tracing import span
 
 
 _access_token_cache = {}
@@ -25,6 +26,7 @@ _vault = None
 _TTL = 300  # Measured in seconds
 
 
+@span()
 def post_message(workspace, channel, text, parse="full", thread_ts=None):
     json_post = {
         "channel": channel,
@@ -35,6 +37,7 @@ def post_message(workspace, channel, text, parse="full", thread_ts=None):
     return post_attachment(workspace, json_post)
 
 
+@span()
 def get_userinfo(workspace, user_id):
     token = settings.get_bot_token(workspace)
     if not token:
@@ -87,11 +90,12 @@ def get_userinfo(workspace, user_id):
         'User-Agent': f'karmabot/{karmabot.__version__}',
         'Content-Type': 'application/json; charset=utf-8'
     }
-    result = urlfetch.get(url="https://slack.com/api/users.info?user=%s&token=%s" % (user_id, token),
-                          headers=headers)
+    result = scheduler.get(workspace, url="https://slack.com/api/users.info?user=%s&token=%s" % (user_id, token),
+                           headers=headers)
     return result
 
 
+@span()
 def command_reply(workspace, url, message):
     token = settings.get_bot_token(workspace)
     if not token:
@@ -107,12 +111,13 @@ def command_reply(workspace, url, message):
         current_app.logger.info(str(message))
         return '{"ok": true}'
 
-    result = urlfetch.post(url=url,
-                           data=json.dumps(message),
-                           headers=headers)
+    result = scheduler.post(workspace, url=url,
+                            data=json.dumps(message),
+                            headers=headers)
     return result
 
 
+@span()
 def post_attachment(workspace, post):
     token = settings.get_bot_token(workspace)
     if not token:
@@ -128,12 +133,13 @@ def post_attachment(workspace, post):
         current_app.logger.info(str(post))
         return '{"ok": true}'
 
-    result = urlfetch.post(url="https://slack.com/api/chat.postMessage",
-                           data=json.dumps(post),
-                           headers=headers)
+    result = scheduler.post(workspace, url="https://slack.com/api/chat.postMessage",
+                            data=json.dumps(post),
+                            headers=headers)
     return result
 
 
+@span()
 def dialog_open(workspace, trigger_id, dialog):
     token = settings.get_bot_token(workspace)
     if not token:
@@ -155,13 +161,14 @@ def dialog_open(workspace, trigger_id, dialog):
         current_app.logger.info(str(json_post))
         return json.loads('''{"ok": true}''')
 
-    result = urlfetch.post(url="https://slack.com/api/dialog.open",
-                           data=json.dumps(json_post),
-                           headers=headers)
+    result = scheduler.post(workspace, url="https://slack.com/api/dialog.open",
+                            data=json.dumps(json_post),
+                            headers=headers)
     current_app.logger.debug(result.content)
     return json.loads(result.content)
 
 
+@span()
 def auth_test(token):
 
     json_post = {
@@ -185,12 +192,13 @@ def auth_test(token):
                     "user_id": "W12345678"
                 }''')
 
-    result = urlfetch.post(url="https://slack.com/api/auth.test",
-                           data=json.dumps(json_post),
-                           headers=headers)
+    result = scheduler.post(None, url="https://slack.com/api/auth.test",
+                            data=json.dumps(json_post),
+                            headers=headers)
     return json.loads(result.content)
 
 
+@span()
 def get_channelinfo(workspace, channel_id):
     token = settings.get_bot_token(workspace)
     if not token:
@@ -259,19 +267,12 @@ def get_channelinfo(workspace, channel_id):
                             }
                         }''')
 
-    result = urlfetch.get(url="https://slack.com/api/channels.info?channel=%s" % channel_id,
-                          headers=headers)
+    result = scheduler.get(workspace, url="https://slack.com/api/channels.info?channel=%s" % channel_id,
+                           headers=headers)
     return json.loads(result.content)
 
 
-def get_usergroupinfo(workspace, usergroup_id):
-    usergroups = get_usergroups(workspace)
-    for usergroup in usergroups:
-        if usergroup['id'] == usergroup_id:
-            return usergroup
-    return None
-
-
+@span()
 def leave_channel(workspace, channel_id):
     if current_app.config.get('FAKE_SLACK'):
         return json.loads('''{ "ok": true }''')
@@ -299,13 +300,14 @@ def leave_channel(workspace, channel_id):
         'Authorization': f"Bearer {token}"
     }
 
-    result = urlfetch.post(url="https://slack.com/api/channels.kick",
-                           data=json.dumps(json_post),
-                           headers=headers)
+    result = scheduler.post(workspace, url="https://slack.com/api/channels.kick",
+                            data=json.dumps(json_post),
+                            headers=headers)
     current_app.logger.debug(result.content)
     return json.loads(result.content)
 
 
+@span()
 def get_direct_im_channel(workspace, user_id):
     token = settings.get_bot_token(workspace)
     if not token:
@@ -331,13 +333,14 @@ def get_direct_im_channel(workspace, user_id):
                             }
                           }''')
 
-    result = urlfetch.post(url="https://slack.com/api/im.open",
-                           data=json.dumps(json_post),
-                           headers=headers)
+    result = scheduler.post(workspace, url="https://slack.com/api/im.open",
+                            data=json.dumps(json_post),
+                            headers=headers)
     current_app.logger.debug(result.content)
     return json.loads(result.content)
 
 
+@span()
 def user_group_members(workspace, user_group):
     token = settings.get_access_token(workspace)
     if not token:
@@ -358,41 +361,13 @@ def user_group_members(workspace, user_group):
                                 "W123A4BC5"
                             ]
                         }''')
-    result = urlfetch.post(url=f"https://slack.com/api/usergroups.users.list?usergroup={user_group}&include_disabled=false",  # noqa 501
-                           headers=headers)
+    result = scheduler.post(workspace, url=f"https://slack.com/api/usergroups.users.list?usergroup={user_group}&include_disabled=false",  # noqa 501
+                            headers=headers)
     current_app.logger.debug(result.content)
     return json.loads(result.content)
 
 
-def lookup_user(workspace, displayname):
-    users = get_all_users(workspace)
-    current_app.logger.debug(users)
-    for user in users:
-        if user['name'] == displayname:
-            return user
-    return None
-
-
-def get_all_users(workspace):
-    next_cursor = ""
-    r = get_users(workspace, next_cursor)
-
-    if not r['ok']:
-        return []
-
-    users = []
-    users.extend(r['members'])
-    next_cursor = r['response_metadata']['next_cursor']
-    while next_cursor:
-        r = get_users(workspace, next_cursor)
-        if not r['ok']:
-            return []
-        users.extend(r['members'])
-        next_cursor = r['response_metadata']['next_cursor']
-
-    return users
-
-
+@span()
 def get_users(workspace, cursor):
     token = settings.get_bot_token(workspace)
     if not token:
@@ -492,21 +467,14 @@ def get_users(workspace, cursor):
                                     "next_cursor": "dXNlcjpVMEc5V0ZYTlo="
                                 }
                             }''')
-    result = urlfetch.post(url="https://slack.com/api/users.list?cursor=%s&limit=1000" % cursor,
-                           headers=headers)
+    result = scheduler.post(workspace, url="https://slack.com/api/users.list?cursor=%s&limit=1000" % cursor,
+                            headers=headers)
 
     # self.log.debug(result.content)
     return json.loads(result.content)
 
 
-def lookup_usergroup(workspace, displayname):
-    groups = get_usergroups(workspace)
-    for group in groups:
-        if group['handle'] == displayname:
-            return group
-    return None
-
-
+@span()
 def get_usergroups(workspace):
     token = settings.get_access_token(workspace)
     if not token:
@@ -588,8 +556,8 @@ def get_usergroups(workspace):
                                     }
                                 ]
                             }''')
-    result = urlfetch.post(url="https://slack.com/api/usergroups.list?include_count=false&include_users=false",
-                           headers=headers)
+    result = scheduler.post(workspace, url="https://slack.com/api/usergroups.list?include_count=false&include_users=false",
+                            headers=headers)
 
     current_app.logger.debug(result.content)
     response = json.loads(result.content)
@@ -598,6 +566,7 @@ def get_usergroups(workspace):
     return []
 
 
+@span()
 def get_channel_members(workspace, channel, cursor):
     token = settings.get_bot_token(workspace)
     if not token:
@@ -608,13 +577,15 @@ def get_channel_members(workspace, channel, cursor):
         'Content-Type': 'application/json; charset=utf-8',
         'Authorization': f"Bearer {token}"
     }
-    result = urlfetch.post(
+    result = scheduler.post(
+        workspace,
         url="https://slack.com/api/conversations.members?channel=%s&cursor=%s&limit=1000" % (channel, cursor),
         headers=headers
     )
     return result.json
 
 
+@span()
 def get_all_channel_members(workspace, channel):
     next_cursor = ""
     r = get_channel_members(workspace, channel, next_cursor)
@@ -626,12 +597,11 @@ def get_all_channel_members(workspace, channel):
     members.extend(r['members'])
     next_cursor = r['response_metadata']['next_cursor']
     while next_cursor:
-        r = get_channel_members(channel, next_cursor)
+        r = get_channel_members(workspace, channel, next_cursor)
         if not r['ok']:
             return []
         members.extend(r['members'])
         next_cursor = r['response_metadata']['next_cursor']
-        get_channel_members(channel, next_cursor)
 
     current_app.logger.debug(f"members: {members}")
     return members
@@ -15,7 +15,7 @@
 import os
 from flask import current_app
 import hvac
-from datetime import datetime
+from karmabot.tokens import TokenProvider
 
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING')
 
@@ -30,15 +30,71 @@ if USE_VAULT:
 VERIFICATION_TOKEN = os.environ.get('VERIFICATION_TOKEN', '')
 
 MONGODB = os.environ.get('MONGODB', 'mongodb://localhost:27017')
+MONGODB_MAX_POOL_SIZE = int(os.environ.get('MONGODB_MAX_POOL_SIZE', 100))
+MONGODB_CONNECT_TIMEOUT = int(os.environ.get('MONGODB_CONNECT_TIMEOUT', 5000))  # Measured in milliseconds
+MONGODB_SERVER_SELECTION_TIMEOUT = int(os.environ.get('MONGODB_SERVER_SELECTION_TIMEOUT', 5000))  # Measured in milliseconds
+SLACK_CONNECT_TIMEOUT = int(os.environ.get('SLACK_CONNECT_TIMEOUT', 5000))  # Measured in milliseconds
+SLACK_READ_TIMEOUT = int(os.environ.get('SLACK_READ_TIMEOUT', 10000))  # Measured in milliseconds
+SLACK_POOL_SIZE = int(os.environ.get('SLACK_POOL_SIZE', 10))
+SLACK_HTTP2 = os.environ.get('SLACK_HTTP2', "False").lower() in ['true', '1', 't', 'y', 'yes']
+SLACK_MAX_RETRIES = int(os.environ.get('SLACK_MAX_RETRIES', 3))  # Retries of requests Slack rate limits
 FAKE_SLACK = os.environ.get('FAKE_SLACK', "False").lower() in ['true', '1', 't', 'y', 'yes']
 SLACK_EVENTS_ENDPOINT = os.environ.get("SLACK_EVENTS_ENDPOINT", "/slack_events")
 
 # Number of "gifts" per hour (note: quantity in gifts is not considered)
-KARMA_RATE_LIMIT = os.environ.get('KARMA_RATE_LIMIT', 60)
+KARMA_RATE_LIMIT = int(os.environ.get('KARMA_RATE_LIMIT', 60))
+# Count gifts in MongoDB, so the limit holds across all Karmabot processes
+KARMA_RATE_LIMIT_SHARED = os.environ.get('KARMA_RATE_LIMIT_SHARED', "False").lower() in ['true', '1', 't', 'y', 'yes']
+
+# Write concern for storing karma operations, e.g. `1` or `majority`
+KARMA_WRITE_CONCERN = os.environ.get('KARMA_WRITE_CONCERN', '1')
 
 # Number of days karma is good for
 KARMA_TTL = os.environ.get('KARMA_TTL', 90)
 
+# Expired karma is deleted by the expiry sweeper, which keeps the karma totals in sync
+KARMA_SWEEPER = os.environ.get('KARMA_SWEEPER', "True").lower() in ['true', '1', 't', 'y', 'yes']
+KARMA_SWEEP_INTERVAL = int(os.environ.get('KARMA_SWEEP_INTERVAL', 60))  # Measured in seconds
+KARMA_SWEEP_BATCH = int(os.environ.get('KARMA_SWEEP_BATCH', 1000))
+
+# How often each process reloads the top/bottom standings, to pick up karma given through other processes
+KARMA_LEADERBOARD_REFRESH = int(os.environ.get('KARMA_LEADERBOARD_REFRESH', 300))  # Measured in seconds
+
+# `/karma top channel members` looks members up in chunks, running up to KARMA_CHANNEL_WORKERS chunks at once
+KARMA_CHANNEL_CHUNK = int(os.environ.get('KARMA_CHANNEL_CHUNK', 1000))
+KARMA_CHANNEL_WORKERS = int(os.environ.get('KARMA_CHANNEL_WORKERS', 4))
+# The most members `/karma top channel members N` will list
+KARMA_CHANNEL_TOP_MAX = int(os.environ.get('KARMA_CHANNEL_TOP_MAX', 25))
+
+# How often each process checks whether a workspace's karma totals are being rebuilt
+KARMA_TOTALS_CHECK_INTERVAL = int(os.environ.get('KARMA_TOTALS_CHECK_INTERVAL', 10))  # Measured in seconds
+
+# How often each process checks whether another process has changed a workspace's badges
+KARMA_BADGE_CHECK_INTERVAL = int(os.environ.get('KARMA_BADGE_CHECK_INTERVAL', 10))  # Measured in seconds
+
+# How long to cache whether a user is a bot or an admin, and for how many users
+KARMA_USER_CACHE_TTL = int(os.environ.get('KARMA_USER_CACHE_TTL', 3600))  # Measured in seconds
+KARMA_USER_CACHE_SIZE = int(os.environ.get('KARMA_USER_CACHE_SIZE', 10000))
+
+# How old a user directory snapshot can get before it is crawled from Slack again
+KARMA_DIRECTORY_REFRESH = int(os.environ.get('KARMA_DIRECTORY_REFRESH', 86400))  # Measured in seconds
+
+# How long to cache the user groups of a workspace and their members
+KARMA_USERGROUP_TTL = int(os.environ.get('KARMA_USERGROUP_TTL', 3600))  # Measured in seconds
+KARMA_USERGROUP_RETRY = int(os.environ.get('KARMA_USERGROUP_RETRY', 60))  # Measured in seconds
+
+# MongoDB commands slower than this are logged, with a summary of their query plan
+KARMA_SLOW_QUERY = int(os.environ.get('KARMA_SLOW_QUERY', 100))  # Measured in milliseconds
+
+# Explain every controller query at startup, and refuse to start if any of them is a collection scan
+KARMA_VERIFY_INDEXES = os.environ.get('KARMA_VERIFY_INDEXES', "False").lower() in ['true', '1', 't', 'y', 'yes']
+
+# Events, commands and interactions that take longer than KARMA_TRACE_SLOW milliseconds to handle are sampled
+# (KARMA_TRACE_SAMPLE of them) to KARMA_TRACE_FILE, one JSON trace per line.  No file, no sampling.
+KARMA_TRACE_FILE = os.environ.get('KARMA_TRACE_FILE', '')
+KARMA_TRACE_SLOW = int(os.environ.get('KARMA_TRACE_SLOW', 2000))  # Measured in milliseconds
+KARMA_TRACE_SAMPLE = float(os.environ.get('KARMA_TRACE_SAMPLE', 1.0))
+
 # Color to use for stuff
 KARMA_COLOR = os.environ.get('KARMA_COLOR', '#af8b2d')
 
@@ -68,46 +124,23 @@ def _env_get_bot_token(workspace):
 
 
 # vault cache
-_access_token_cache = {}
-_bot_token_cache = {}
-_vault = None
-_TTL = os.environ.get('VAULT_CACHE_TTL', 300)  # Measured in seconds
-
+_TTL = int(os.environ.get('VAULT_CACHE_TTL', 300))  # Measured in seconds
 
-def _vault_get_access_token(workspace):
-    global _access_token_cache, _TTL
-
-    current_app.logger.debug(f"DEBUG: Got request for {workspace} workspace (vault)")
-    n = datetime.now().timestamp()
-    (token, ts) = _access_token_cache.get(workspace, (None, 0))
-    if ts + _TTL > n:
-        return token
 
-    try:
-        token_data = vault.secrets.kv.v1.read_secret(f'{vault_base_path}/access_{workspace}.txt')
-        token = token_data['data']['value']
-        _access_token_cache[workspace] = (token, n)
+def _vault_read(path):
+    token_data = vault.secrets.kv.v1.read_secret(path)
+    return token_data['data']['value']
 
-        return token
-    except Exception as ex:
-        current_app.logger.warning(f"Had a problem getting a token for workspace {workspace}:\n{ex}")
 
+_access_tokens = TokenProvider('access', lambda workspace: _vault_read(f'{vault_base_path}/access_{workspace}.txt'), _TTL)
+_bot_tokens = TokenProvider('bot', lambda workspace: _vault_read(f'{vault_base_path}/bot_{workspace}.txt'), _TTL)
 
-def _vault_get_bot_token(workspace):
-    global _vault, _bot_token_cache, _TTL, vault, vault_base_path
 
+def _vault_get_access_token(workspace):
     current_app.logger.debug(f"DEBUG: Got request for {workspace} workspace (vault)")
-    n = datetime.now().timestamp()
-    (token, ts) = _bot_token_cache.get(workspace, (None, 0))
-    if ts + _TTL > n:
-        return token
-
-    try:
-        token_data = vault.secrets.kv.v1.read_secret(f'{vault_base_path}/bot_{workspace}.txt')
-        token = token_data['data']['value']
-        _bot_token_cache[workspace] = (token, n)
+    return _access_tokens.get(workspace)
 
-        return token
 
-    except Exception as ex:
-        current_app.logger.warning(f"Had a problem getting a token for workspace {workspace}:\n{ex}")
+def _vault_get_bot_token(workspace):
+    current_app.logger.debug(f"DEBUG: Got request for {workspace} workspace (vault)")
+    return _bot_tokens.get(workspace)
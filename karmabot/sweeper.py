@@ -0,0 +1,172 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Background deletion of expired karma operations.
+
+  A TTL index would delete the operations without telling anyone, leaving the
+  materialized totals too high.  Instead the sweeper deletes expired operations
+  in batches and subtracts them from the totals in the same pass.  The index
+  manager replaces any TTL index on `expires` with a plain one.
+"""
+
+import datetime
+import os
+import socket
+import threading
+import time
+import uuid
+
+from pymongo import ASCENDING
+
+from karmabot import settings
+from karmabot.controller.totals import TotalsController, counters_built, counters_marker, rollups_built
+from karmabot.db import workspace_ids
+from karmabot.indexes import index_manager
+from karmabot.leaderboard import leaderboards
+from karmabot.leases import Lease, renewing
+from karmabot.metrics import log_metrics
+
+# How long a batch claimed by a sweeper stays claimed, in seconds
+CLAIM_TTL = 600
+
+
+class ExpirySweeper(object):
+    """
+        Only one process sweeps at a time, holding the `expiry_sweeper` lease,
+        which is renewed for as long as a sweep runs and checked before each
+        batch.
+
+        Each batch of expired operations is claimed first by tagging them
+        with a token, and only the operations this sweeper claimed are
+        deleted and subtracted, so two sweepers can never subtract the same
+        operation.  The claim of a sweeper that died before deleting its
+        batch lapses after CLAIM_TTL seconds.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.interval = settings.KARMA_SWEEP_INTERVAL
+        self.batch_size = settings.KARMA_SWEEP_BATCH
+        self.lease = Lease("expiry_sweeper", self.interval * 3, owner=self.owner)
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self.run, name="karmabot-expiry-sweeper", daemon=True)
+        self._thread.start()
+
+    def run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    if self.lease.acquire():
+                        with renewing(self.lease):
+                            self.sweep_all()
+                except Exception as ex:
+                    self.app.logger.warning(f"Expiry sweep failed: {ex}")
+                    log_metrics('exceptions', {'name': ex.__class__.__name__}, 'count', 1)
+            time.sleep(self.interval)
+
+    def sweep_all(self):
+        totals = TotalsController()
+        workspaces = workspace_ids(totals.mongodb)
+
+        # Workspaces from before the counters and rollups existed (or whose rebuild was
+        # interrupted) get theirs built here, so nobody has to remember to
+        unbuilt = [w for w in workspaces if not rollups_built(w)]
+        if unbuilt:
+            for workspace_id in totals.rebuild(unbuilt):
+                leaderboards.invalidate(workspace_id)
+
+        for workspace_id in workspaces:
+            if not self.lease.held:
+                self.app.logger.warning("Lost the expiry sweeper lease, stopping")
+                return
+            self.sweep(totals, workspace_id)
+
+    def sweep(self, totals, workspace_id):
+        marker = counters_marker(workspace_id)
+        if not counters_built(workspace_id):
+            # Until the counters are built, not every operation has been
+            # counted, so expired ones can't be subtracted
+            self.app.logger.info(f"Not sweeping {workspace_id} until its karma totals are built")
+            return 0
+
+        index_manager.ensure_workspace(workspace_id)
+        collection = totals.mongodb[workspace_id]
+
+        now = datetime.datetime.utcnow()
+        expired = {"expires": {"$lte": now}}
+        oldest = collection.find_one(expired, {"expires": 1}, sort=[("expires", ASCENDING)])
+        if not oldest:
+            return 0
+        lag = (now - oldest['expires']).total_seconds()
+
+        ts = time.time()
+        deleted = 0
+        while True:
+            if not self.lease.held:
+                self.app.logger.warning(f"Lost the expiry sweeper lease, stopping the sweep of {workspace_id}")
+                break
+            current = counters_marker(workspace_id)
+            if not counters_built(workspace_id) or current.get('rebuild') != marker.get('rebuild'):
+                # A rebuild started, and won't include what is subtracted from here on
+                self.app.logger.info(f"Karma totals of {workspace_id} are being rebuilt, stopping its sweep")
+                break
+
+            ops = self.claim(collection, expired)
+            if not ops:
+                break
+            r = collection.delete_many({"_id": {"$in": [op['_id'] for op in ops]}, "sweep": ops[0]['sweep']})
+            if r.deleted_count != len(ops):
+                # Only this sweeper has the token, so something else deleted them
+                self.app.logger.warning(f"Claimed {len(ops)} expired karma operations in {workspace_id} "
+                                        f"but deleted {r.deleted_count}")
+            totals.decrement(workspace_id, ops)
+            for op in ops:
+                leaderboards.apply(workspace_id, op.get('type'), op.get('subject'), -op.get('quantity', 0), -1)
+            deleted += len(ops)
+        elapsed = time.time() - ts
+
+        self.app.logger.info(f"Swept {deleted} expired karma operations from {workspace_id}")
+        log_metrics('karmabot_expiry_sweep', {'workspace': workspace_id}, 'deleted', deleted)
+        log_metrics('karmabot_expiry_sweep', {'workspace': workspace_id}, 'lag', int(lag))
+        log_metrics('karmabot_expiry_sweep', {'workspace': workspace_id}, 'time_elapsed', int(elapsed * 1000))
+        if elapsed > 0:
+            log_metrics('karmabot_expiry_sweep', {'workspace': workspace_id}, 'rate', int(deleted / elapsed))
+        return deleted
+
+    def claim(self, collection, expired):
+        """
+            Tag the next batch of expired operations nobody else has claimed.
+
+            Returns:
+                (list) the operations this sweeper claimed
+        """
+        now = datetime.datetime.utcnow()
+        unclaimed = dict(expired, **{"$or": [{"sweep": {"$exists": False}},
+                                             {"swept": {"$lt": now - datetime.timedelta(seconds=CLAIM_TTL)}}]})
+        ids = [op['_id'] for op in collection.find(unclaimed, {"_id": 1})
+               .sort("expires", ASCENDING)
+               .limit(self.batch_size)]
+        if not ids:
+            return []
+
+        token = uuid.uuid4().hex
+        collection.update_many(dict(unclaimed, _id={"$in": ids}), {"$set": {"sweep": token, "swept": now}})
+        return list(collection.find({"_id": {"$in": ids}, "sweep": token},
+                                    {"type": 1, "subject": 1, "quantity": 1, "gifter": 1, "sweep": 1}))
@@ -0,0 +1,112 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Caches workspace tokens from a slow source (Vault) without ever making
+  more than one request for the same token at a time.
+"""
+
+import threading
+import time
+
+from flask import current_app
+
+from karmabot.metrics import log_metrics
+
+
+class TokenProvider(object):
+    """
+        Tokens per workspace, fetched with `fetch(workspace)`.
+
+        A token is good for `ttl` seconds.  Once it is `refresh_ahead` of the
+        way there it is refreshed in the background while callers keep
+        getting the cached one.  Past the TTL, callers wait up to `stale_wait`
+        seconds for the refresh and otherwise get the last good token, so a
+        slow or unavailable source doesn't stall every Slack call.
+
+        Only one fetch per workspace is in flight at a time; everyone else
+        waits for (or skips) that one.
+    """
+
+    def __init__(self, kind, fetch, ttl, refresh_ahead=0.8, stale_wait=1.0, fetch_wait=10.0):
+        self.kind = kind
+        self.fetch = fetch
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.stale_wait = stale_wait
+        self.fetch_wait = fetch_wait
+        # workspace -> (token, fetched timestamp)
+        self._tokens = {}
+        # workspace -> threading.Event set when the fetch in flight finishes
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, workspace):
+        entry = self._tokens.get(workspace)
+        age = time.time() - entry[1] if entry else None
+
+        if entry and age < self.ttl * self.refresh_ahead:
+            return entry[0]
+
+        done = self._refresh(workspace)
+        if entry and age < self.ttl:
+            return entry[0]
+
+        done.wait(self.stale_wait if entry else self.fetch_wait)
+        fresh = self._tokens.get(workspace)
+        if fresh and fresh is not entry:
+            return fresh[0]
+        if entry:
+            log_metrics('karmabot_tokens', {'kind': self.kind}, 'staleness', int(age))
+            return entry[0]
+        return None
+
+    def invalidate(self, workspace):
+        with self._lock:
+            self._tokens.pop(workspace, None)
+
+    def _refresh(self, workspace):
+        """
+            Start fetching a workspace's token, unless that is already happening.
+
+            Returns:
+                (threading.Event) set once the fetch has finished
+        """
+        with self._lock:
+            done = self._flights.get(workspace)
+            if done:
+                return done
+            done = self._flights[workspace] = threading.Event()
+
+        app = current_app._get_current_object()
+        threading.Thread(target=self._fetch, args=(app, workspace, done),
+                         name=f"karmabot-token-{self.kind}", daemon=True).start()
+        return done
+
+    def _fetch(self, app, workspace, done):
+        with app.app_context():
+            ts = time.time()
+            try:
+                token = self.fetch(workspace)
+                if token:
+                    with self._lock:
+                        self._tokens[workspace] = (token, time.time())
+            except Exception as ex:
+                app.logger.warning(f"Had a problem getting a token for workspace {workspace}:\n{ex}")
+                log_metrics('karmabot_tokens', {'kind': self.kind}, 'failed', 1)
+            finally:
+                log_metrics('karmabot_tokens', {'kind': self.kind}, 'fetch_time_ms', int((time.time() - ts) * 1000))
+                with self._lock:
+                    del self._flights[workspace]
+                done.set()
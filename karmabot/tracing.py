@@ -0,0 +1,160 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Per-request tracing: where the time went between Slack sending us an
+  event and us answering it.
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from functools import wraps
+
+from karmabot import settings
+from karmabot.metrics import log_histogram
+
+_local = threading.local()
+_file_lock = threading.Lock()
+
+
+class Trace(object):
+    """
+        The spans of one Slack event, command or interaction, from when the
+        request arrived until the executor finished with it.
+    """
+
+    def __init__(self, name, workspace_id):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.workspace_id = workspace_id
+        self.started = time.time()
+        self._start = time.perf_counter_ns()
+        # [{"name", "parent", "start_ms", "duration_ms"}], in the order they finished
+        self.spans = []
+        self._stack = []
+
+    def elapsed_ms(self, since=None):
+        return (time.perf_counter_ns() - (self._start if since is None else since)) / 1000000
+
+    def to_dict(self):
+        stages = {}
+        for s in self.spans:
+            stages[s['name']] = stages.get(s['name'], 0) + s['duration_ms']
+        return {
+            "trace_id": self.id,
+            "name": self.name,
+            "workspace": self.workspace_id,
+            "started": self.started,
+            "duration_ms": self.elapsed_ms(),
+            "stages": stages,
+            "spans": self.spans,
+        }
+
+
+class span(object):
+    """
+        Record a span of the current thread's trace, as a context manager or
+        a decorator.  Does nothing when there is no trace.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+
+    def __enter__(self):
+        trace = current()
+        if trace is not None:
+            trace._stack.append((self.name, time.perf_counter_ns()))
+        return self
+
+    def __exit__(self, *exc):
+        trace = current()
+        if trace is not None and trace._stack:
+            name, start = trace._stack.pop()
+            trace.spans.append({
+                "name": name,
+                "parent": trace._stack[-1][0] if trace._stack else None,
+                "start_ms": (start - trace._start) / 1000000,
+                "duration_ms": trace.elapsed_ms(start),
+            })
+        return False
+
+    def __call__(self, f):
+        name = self.name or f.__qualname__
+
+        @wraps(f)
+        def spanned(*args, **kwargs):
+            if current() is None:
+                return f(*args, **kwargs)
+            with span(name):
+                return f(*args, **kwargs)
+        return spanned
+
+
+def current():
+    """
+        Returns:
+            (Trace) the trace of the request this thread is working on, or None
+    """
+    return getattr(_local, 'trace', None)
+
+
+def current_span():
+    """
+        Returns:
+            (str) the name of the innermost span in progress, or None
+    """
+    trace = current()
+    if trace is None or not trace._stack:
+        return None
+    return trace._stack[-1][0]
+
+
+def traced(trace, f):
+    """
+        Wrap `f` to run as part of `trace` on an executor thread, and finish
+        the trace when it returns.  The time it spent waiting for a thread is
+        recorded as the `queued` span.
+    """
+    @wraps(f)
+    def run(*args, **kwargs):
+        trace.spans.append({"name": "queued", "parent": None, "start_ms": 0, "duration_ms": trace.elapsed_ms()})
+        _local.trace = trace
+        try:
+            with span(f.__qualname__):
+                return f(*args, **kwargs)
+        finally:
+            _local.trace = None
+            finish(trace)
+    return run
+
+
+def finish(trace):
+    """
+        Record the time of each stage, and keep a sample of the traces slower
+        than KARMA_TRACE_SLOW.
+    """
+    details = trace.to_dict()
+    for name, duration_ms in details['stages'].items():
+        log_histogram('karmabot_trace_stage', {'trace': trace.name, 'stage': name}, 'time_elapsed',
+                      int(duration_ms * 1000000))
+
+    if (settings.KARMA_TRACE_FILE and details['duration_ms'] >= settings.KARMA_TRACE_SLOW
+            and random.random() < settings.KARMA_TRACE_SAMPLE):
+        line = json.dumps(details) + "\n"
+        with _file_lock:
+            with open(settings.KARMA_TRACE_FILE, 'a') as f:
+                f.write(line)
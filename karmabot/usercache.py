@@ -0,0 +1,136 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  In-process cache of the few user fields karmabot needs, so checking a
+  gifter doesn't cost a `users.info` call per event.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from karmabot import prometheus
+from karmabot import settings
+from karmabot.directory import directory
+from karmabot.service import slack as slack_client
+
+USER_FIELDS = ("is_bot", "is_admin", "deleted")
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class UserCache(object):
+    """
+        User metadata per (workspace, user), kept for KARMA_USER_CACHE_TTL
+        seconds, with the least recently used users evicted beyond
+        KARMA_USER_CACHE_SIZE.
+
+        Misses are answered from the user directory when it has the user,
+        otherwise concurrent misses for the same user wait for a single
+        `users.info` call.  `user_change` events push fresh metadata in, so
+        changes show up without waiting for the TTL.
+    """
+
+    def __init__(self):
+        # (workspace_id, user_id) -> (expires, {field: value})
+        self._entries = OrderedDict()
+        # (workspace_id, user_id) -> _Flight, for lookups in progress
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, workspace_id, user_id):
+        """
+            Returns:
+                (dict) the USER_FIELDS of the user, or None if Slack couldn't tell us
+        """
+        key = (workspace_id, user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                prometheus.cache_lookup('users', True)
+                return entry[1]
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        prometheus.cache_lookup('users', False)
+        if not leader:
+            flight.done.wait(settings.SLACK_READ_TIMEOUT / 1000)
+            return flight.result
+
+        try:
+            flight.result = self._fetch(workspace_id, user_id)
+            if flight.result:
+                self._store(key, flight.result)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def push(self, workspace_id, user):
+        """
+            Update a user from a Slack user object, e.g. from a `user_change` event.
+        """
+        self._store((workspace_id, user['id']), self._fields(user))
+
+    def invalidate(self, workspace_id, user_id):
+        with self._lock:
+            self._entries.pop((workspace_id, user_id), None)
+
+    def _store(self, key, fields):
+        with self._lock:
+            self._entries[key] = (time.time() + settings.KARMA_USER_CACHE_TTL, fields)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.KARMA_USER_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _fields(user):
+        return {f: user.get(f, False) for f in USER_FIELDS}
+
+    def _fetch(self, workspace_id, user_id):
+        user = directory.get_user(workspace_id, user_id)
+        if user:
+            return self._fields(user)
+
+        userinfo_r = slack_client.get_userinfo(workspace_id, user_id)
+        if userinfo_r is None:
+            return None
+        if isinstance(userinfo_r, dict):
+            # FAKE_SLACK
+            userinfo = userinfo_r
+        else:
+            if userinfo_r.status != 200:
+                current_app.logger.warning(f"Got an unknown userinfo response: {userinfo_r.status}")
+                return None
+            userinfo = userinfo_r.json
+
+        if not userinfo.get('ok'):
+            current_app.logger.warning(f"Unable to get userinfo for {user_id}: {userinfo.get('error')}")
+            return None
+        return self._fields(userinfo['user'])
+
+
+user_cache = UserCache()
@@ -0,0 +1,117 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  In-process cache of each workspace's user groups and their members, for
+  badge permissions.
+"""
+
+import threading
+import time
+
+from karmabot import prometheus
+from karmabot import settings
+from karmabot.service import slack as slack_client
+
+
+class UsergroupCache(object):
+    """
+        The user group catalog of each workspace, and the member set of each
+        group, kept for KARMA_USERGROUP_TTL seconds.  `subteam_created`,
+        `subteam_updated` and `subteam_members_changed` events keep both up
+        to date in between.
+
+        `usergroups.list` answers a failure with no groups, so an empty
+        catalog is only kept for KARMA_USERGROUP_RETRY seconds, and a
+        catalog that was fetched before is kept rather than replaced by it.
+    """
+
+    def __init__(self):
+        # workspace_id -> (expires, {"by_id": {id: group}, "by_handle": {handle: group}})
+        self._catalogs = {}
+        # (workspace_id, group_id) -> (expires, set of user IDs)
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def get(self, workspace_id, group_id):
+        return self._catalog(workspace_id)['by_id'].get(group_id)
+
+    def lookup(self, workspace_id, handle):
+        return self._catalog(workspace_id)['by_handle'].get(handle)
+
+    def is_member(self, workspace_id, group_id, user_id):
+        key = (workspace_id, group_id)
+        entry = self._members.get(key)
+        fresh = entry is not None and entry[0] >= time.time()
+        prometheus.cache_lookup('usergroup_members', fresh)
+        if not fresh:
+            r = slack_client.user_group_members(workspace_id, group_id)
+            if not r or not r['ok']:
+                return False
+            entry = (time.time() + settings.KARMA_USERGROUP_TTL, set(r['users']))
+            with self._lock:
+                self._members[key] = entry
+        return user_id in entry[1]
+
+    def update(self, workspace_id, group):
+        """
+            Add or update a group from a `subteam_created` or `subteam_updated` event.
+        """
+        with self._lock:
+            entry = self._catalogs.get(workspace_id)
+            if entry:
+                catalog = entry[1]
+                previous = catalog['by_id'].get(group['id'])
+                if previous:
+                    catalog['by_handle'].pop(previous['handle'], None)
+                catalog['by_id'][group['id']] = group
+                catalog['by_handle'][group['handle']] = group
+            if 'users' in group:
+                self._members[(workspace_id, group['id'])] = (time.time() + settings.KARMA_USERGROUP_TTL,
+                                                              set(group['users']))
+
+    def members_changed(self, workspace_id, group_id, added, removed):
+        """
+            Apply a `subteam_members_changed` event.
+        """
+        with self._lock:
+            entry = self._members.get((workspace_id, group_id))
+            if entry:
+                entry[1].update(added)
+                entry[1].difference_update(removed)
+
+    def _catalog(self, workspace_id):
+        entry = self._catalogs.get(workspace_id)
+        if entry and entry[0] > time.time():
+            prometheus.cache_lookup('usergroups', True)
+            return entry[1]
+        prometheus.cache_lookup('usergroups', False)
+
+        groups = slack_client.get_usergroups(workspace_id)
+        if not groups:
+            catalog = entry[1] if entry else {"by_id": {}, "by_handle": {}}
+            with self._lock:
+                self._catalogs[workspace_id] = (time.time() + settings.KARMA_USERGROUP_RETRY, catalog)
+            return catalog
+
+        catalog = {
+            "by_id": {g['id']: g for g in groups},
+            "by_handle": {g['handle']: g for g in groups}
+        }
+        with self._lock:
+            self._catalogs[workspace_id] = (time.time() + settings.KARMA_USERGROUP_TTL, catalog)
+        return catalog
+
+
+usergroups = UsergroupCache()
@@ -11,15 +11,19 @@ setup(
     include_package_data=True,
     install_requires=[
         'flask',
-        'urlfetch',
         'pymongo',
         'influxdb',
         'flask-executor',
-        'hvac'
+        'hvac',
+        'prometheus_client'
     ],
     extras_require={
         'dev': [
-            'flake8'
+            'flake8',
+            'pytest'
+        ],
+        'http2': [
+            'httpx[http2]'
         ]
     }
 )
@@ -1,3 +1,3 @@
 #!/bin/sh
 
-exec /usr/local/bin/gunicorn -b 0.0.0.0:5000 --access-logfile - "karmabot:create_app()"
+exec /usr/local/bin/gunicorn -c /app/gunicorn.conf.py "karmabot:create_app()"
@@ -0,0 +1,120 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  HTTPClient against a local HTTPS stub: keep-alive reuse and the retry on
+  a connection the server has closed.
+"""
+
+import shutil
+import ssl
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from karmabot.service.http import HTTPClient
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # Drop the connection without saying so, like an idle timeout on Slack's side
+        self.close_connection = self.server.drop_after_response
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    if not shutil.which("openssl"):
+        pytest.skip("openssl is needed to make a certificate for the stub")
+    path = tmp_path_factory.mktemp("tls")
+    cert, key = path / "cert.pem", path / "key.pem"
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+                    "-keyout", str(key), "-out", str(cert)], check=True, capture_output=True)
+    return cert, key
+
+
+@pytest.fixture
+def server(certificate):
+    cert, key = certificate
+    httpd = ThreadingHTTPServer(("localhost", 0), StubHandler)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.connections = 0
+    httpd.drop_after_response = False
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def client(certificate):
+    client = HTTPClient(connect_timeout=5, read_timeout=5, pool_size=2)
+    client._context = ssl.create_default_context(cafile=str(certificate[0]))
+    yield client
+    client.close()
+
+
+def url(server):
+    return f"https://localhost:{server.server_address[1]}/api/test"
+
+
+def test_connection_is_reused(server, client):
+    for _ in range(5):
+        r = client.get(url(server))
+        assert r.status == 200
+        assert r.json == {"ok": True}
+    assert server.connections == 1
+
+
+def test_idle_connection_expires(server, client):
+    client.idle_timeout = 0
+    client.get(url(server))
+    client.get(url(server))
+    assert server.connections == 2
+
+
+def test_stale_connection_is_retried(server, client):
+    server.drop_after_response = True
+    client.get(url(server))
+    # The pooled connection was closed by the server, so the request is sent again on a new one
+    r = client.get(url(server))
+    assert r.status == 200
+    assert server.connections == 2
+
+
+def test_new_connection_failure_is_not_retried(client):
+    with pytest.raises(ConnectionError):
+        client.get("https://localhost:1/api/test")
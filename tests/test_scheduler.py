@@ -0,0 +1,131 @@
+# Copyright (c) 2019 Target Brands, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Scheduler against a local stub that throttles with 429 and Retry-After.
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from flask import Flask
+
+from karmabot import settings
+from karmabot.service import http
+from karmabot.service import scheduler as scheduler_module
+from karmabot.service.scheduler import Scheduler
+
+RETRY_AFTER = 0.5
+METHOD = "users.info"
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(time.monotonic())
+            throttle = self.server.throttle > 0
+            self.server.throttle -= 1
+        body = b'{"ok": false, "error": "ratelimited"}' if throttle else b'{"ok": true}'
+        self.send_response(429 if throttle else 200)
+        if throttle:
+            self.send_header("Retry-After", str(RETRY_AFTER))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("localhost", 0), ThrottlingHandler)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.throttle = 0
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def scheduler(app, monkeypatch):
+    client = http.HTTPClient(connect_timeout=5, read_timeout=5)
+    monkeypatch.setattr(http, "get_client", lambda: client)
+    monkeypatch.setattr(settings, "SLACK_MAX_RETRIES", 2)
+    # No jitter, so the waits below are exact
+    monkeypatch.setattr(scheduler_module.random, "uniform", lambda a, b: 0)
+    scheduler = Scheduler()
+    # Pace the stub like a Slack API method
+    monkeypatch.setattr(scheduler, "_api_method", lambda url: METHOD)
+    yield scheduler
+    client.close()
+
+
+def url(server):
+    return f"http://localhost:{server.server_address[1]}/api/{METHOD}"
+
+
+def test_retries_after_429(server, scheduler):
+    server.throttle = 1
+    r = scheduler.get("T1", url(server))
+    assert r.status == 200
+    assert len(server.requests) == 2
+    assert server.requests[1] - server.requests[0] >= RETRY_AFTER
+
+
+def test_429_blocks_the_bucket(app, server, scheduler):
+    server.throttle = 1
+    done = threading.Event()
+
+    def throttled():
+        with app.app_context():
+            scheduler.get("T1", url(server))
+        done.set()
+
+    threading.Thread(target=throttled, daemon=True).start()
+    while not server.requests:
+        time.sleep(0.01)
+    time.sleep(0.1)
+
+    bucket = scheduler._buckets[("T1", METHOD)]
+    assert bucket.blocked_until > time.monotonic()
+    # Another request for the same method waits out the block too
+    assert bucket.reserve() > 0
+    bucket.done_waiting()
+    # ...but not one for another workspace
+    assert scheduler._bucket("T2", METHOD).reserve() == 0
+    assert done.wait(5)
+
+
+def test_gives_up_after_max_retries(server, scheduler):
+    server.throttle = 10
+    ts = time.monotonic()
+    r = scheduler.get("T1", url(server))
+    assert r.status == 429
+    assert len(server.requests) == settings.SLACK_MAX_RETRIES + 1
+    assert time.monotonic() - ts >= settings.SLACK_MAX_RETRIES * RETRY_AFTER